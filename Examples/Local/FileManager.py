@@ -9,6 +9,21 @@ import shutil
 import base64
 import zipfile
 import cv2
+from urllib.parse import quote
+from sessionIndex import SessionIndex
+
+from utilsVisualizer import loadVisualizerData
+from utilsZip import iterZip, writeZip
+
+# Session subfolders served by the media endpoint of the local server.
+MEDIA_FOLDERS = ['Videos', 'VisualizerVideos', 'VisualizerJsons']
+
+
+def is_path_segment(name: str) -> bool:
+    """
+    Whether name is a single file or folder name, ie it cannot point outside of the folder it is joined to.
+    """
+    return name not in ('', '.', '..') and '/' not in name and '\\' not in name and os.sep not in name
 
 
 class FileManager:
@@ -19,6 +34,9 @@ class FileManager:
     def __init__(self, base_directory: str):
         self.base_directory = base_directory
         print(base_directory)
+        # Sessions and trials, updated on writes and checked against the files on lookups.
+        os.makedirs(base_directory, exist_ok=True)
+        self.index = SessionIndex(base_directory)
 
 
     def create_cam_directory(self, session: Session, cam_index: int):
@@ -31,6 +49,7 @@ class FileManager:
         os.makedirs(session_path, exist_ok=True)
         for index,cam in enumerate(session.iphoneModel):
             self.create_cam_directory(session = session, cam_index = index)
+        self.index.update_session(str(session.uuid))
         
         return session_path
 
@@ -43,6 +62,7 @@ class FileManager:
     def save_session_metadata(self, session: Session):
         metadata_path = os.path.join(self.base_directory, str(session.uuid), 'sessionMetadata.yaml')
         session.save_metadata(metadata_file=metadata_path)
+        self.index.update_session(str(session.uuid))
 
         return metadata_path
 
@@ -67,6 +87,8 @@ class FileManager:
                     if not os.listdir(videos_folder):  # Returns True if empty
                         print(f"Removing empty folder: {videos_folder}")
                         shutil.rmtree(folder_path)  # Remove the folder and all its contents
+                        self.index.remove_session(folder_name)
+        self.index.save()
 
     def delete_session(self, session: Session)-> bool:
         """
@@ -84,6 +106,8 @@ class FileManager:
         if os.path.exists(session_path):
             # Remove the session directory and its contents
             shutil.rmtree(session_path)
+            self.index.remove_session(str(session.uuid))
+            self.index.save()
             print(f"Session folder {session_path} and all its contents have been deleted.")
             return True
         else:
@@ -95,7 +119,8 @@ class FileManager:
         Finds and loads the visualizer JSON file for a given trial and session.
 
         This function constructs the path to the visualizer JSON file using the session and trial UUIDs.
-        It then reads the content of the JSON file and returns it as a dictionary.
+        It then reads the content of the JSON file and returns it as a dictionary. If only the
+        compact binary visualizer file exists, it is loaded in the same (JSON) schema.
 
         Args:
             session (Session): An instance of the Session class containing session details, including a UUID.
@@ -118,72 +143,55 @@ class FileManager:
         #print(f'Path to visualizer JSON is: {visualiser_path}')
     
         # Read and return the JSON content
-        with open(visualiser_path, 'r') as file:
-            visualizer_data = json.load(file)
+        visualizer_data = loadVisualizerData(visualiser_path)
     
         return visualizer_data
 
     def find_sessions(self)-> dict:
+        """
+        Returns a summary of the metadata of each session, by session folder name. Served from the session index.
+        """
         sessions_dict = {}  # Dictionary to hold metadata for each UUID folder
-
-        # Iterate through each folder in the root directory
-        for folder_name in os.listdir(self.base_directory):
-            folder_path = os.path.join(self.base_directory, folder_name)
-            print(folder_path)
-            yaml.add_constructor(tag="tag:yaml.org,2002:python/object:uuid.UUID", constructor=uuid_constructor)
-
-            # Check if the folder name matches a UUID pattern
-            if os.path.isdir(folder_path):
-                # Construct the path to sessionMetadata.yaml
-                metadata_file_path = os.path.join(folder_path, 'sessionMetadata.yaml')
-
-                # Check if sessionMetadata.yaml exists
-                if os.path.isfile(metadata_file_path):
-                    # Open and read the YAML file
-                    with open(metadata_file_path, 'r') as file:
-                        # Add the constructor for the UUID tag in YAML
-                        metadata = yaml.safe_load(file)
-                        # Extract specific lines or fields (modify as per your requirements)
-                        # Assuming the YAML file has fields like 'session_name' and 'created_date'
-                        session_info = {
-                            "sessionName": metadata.get("sessionName", ""),
-                            "subjectName": metadata.get("subjectName", ""),
-                            "sessionDate": metadata.get("sessionDate", ""),
-                            "sessionID": metadata.get("sessionID", ""),
-                            "mass": metadata.get("mass_kg", ""),
-                            "height": metadata.get("height_m", "")
-                            # Add other fields here as needed
-                        }
-
-                        # Add the extracted metadata to the sessions_dict with folder_name as key
-                        sessions_dict[folder_name] = session_info
+        for folder_name, metadata in self.index.get_all_metadata().items():
+            session_info = {
+                "sessionName": metadata.get("sessionName", ""),
+                "subjectName": metadata.get("subjectName", ""),
+                "sessionDate": metadata.get("sessionDate", ""),
+                "sessionID": metadata.get("sessionID", ""),
+                "mass": metadata.get("mass_kg", ""),
+                "height": metadata.get("height_m", "")
+                # Add other fields here as needed
+            }
+            sessions_dict[folder_name] = session_info
 
         return sessions_dict
     
     def load_sessions(self) -> dict:
         sessions_dict = {}  # Dictionary to hold sessions for each UUID folder
+        for folder_name, metadata in self.index.get_all_metadata().items():
+            sessions_dict[folder_name] = Session.from_dict(metadata=metadata, fallbackID=folder_name)
+        return sessions_dict
 
-        # Iterate through each folder in the root directory
-        for folder_name in os.listdir(self.base_directory):
-            folder_path = os.path.join(self.base_directory, folder_name)
-            print(folder_path)
-            yaml.add_constructor(tag="tag:yaml.org,2002:python/object:uuid.UUID", constructor=uuid_constructor)
+    def get_session(self, session_id: str) -> Optional[Session]:
+        """
+        Loads a saved session by ID (folder name), without scanning the other sessions.
 
-            # Check if the folder name matches a UUID pattern
-            if os.path.isdir(folder_path):
-                # Construct the path to sessionMetadata.yaml
-                metadata_file_path = os.path.join(folder_path, 'sessionMetadata.yaml')
-
-                # Check if sessionMetadata.yaml exists
-                if os.path.isfile(metadata_file_path):
-                    # Open and read the YAML file
-                    with open(metadata_file_path, 'r') as file:
-                        # Add the constructor for the UUID tag in YAML
-                        metadata = yaml.safe_load(file)
-                        session = Session.from_dict(metadata=metadata, fallbackID=folder_name)
-                        # Add the extracted metadata to the sessions_dict with folder_name as key
-                        sessions_dict[folder_name] = session
-        return sessions_dict
+        Returns:
+            Session: The session, or None if there is no session folder with metadata for that ID.
+        """
+        metadata = self.index.get_metadata(session_id)
+        if metadata is None:
+            return None
+        return Session.from_dict(metadata=metadata, fallbackID=session_id)
+
+    def find_trial(self, trial_id: str) -> Optional[Tuple[str, str]]:
+        """
+        Finds a trial by ID (name of its video files).
+
+        Returns:
+            Tuple[str, str]: The session ID and trial name, or None if not found.
+        """
+        return self.index.find_trial(trial_id)
     
     def save_binary_file(self, data: bytes, session: Session, cam_index: int, trial: Trial):
         """
@@ -196,18 +204,14 @@ class FileManager:
             trial (Trial): The trial the data is associated with.
             filename (str): The name of the file to save the data to.
         """
-        # Create directories if they don't exist
-        trial_path = self.create_trial_directory(session ,trial)
-        trial_path = os.path.join(self.base_directory, str(session.uuid), 'Videos', f'Cam{cam_index}', 'InputMedia', trial.name) 
-        filename = f"{str(trial.uuid)}.mov"
-        # Full path for the file
-        full_filename = os.path.join(trial_path, filename)
+        full_filename = self.get_video_path(session=session, cam_index=cam_index, trial=trial)
 
         # Save the binary data
         with open(full_filename, 'wb') as file:
             file.write(data)
 
         print(f"File saved as {full_filename}")
+        self.index.update_session(str(session.uuid))
 
         # Check if the file was successfully saved
         if os.path.isfile(full_filename):  # Check if the file exists
@@ -219,6 +223,24 @@ class FileManager:
         else:
             print(f"Failed to save the file as {full_filename}.")
     
+    def get_video_path(self, session: Session, cam_index: int, trial: Trial) -> str:
+        """
+        Returns the path of the video of a trial for a camera, creating the trial directories if needed.
+
+        Args:
+            session (Session): The session the video is associated with.
+            cam_index (int): The camera index (X) for the CamX directory.
+            trial (Trial): The trial the video is associated with.
+        """
+        # Create directories if they don't exist
+        if session.iphoneModel:
+            self.create_trial_directory(session ,trial)
+        trial_path = os.path.join(self.base_directory, str(session.uuid), 'Videos', f'Cam{cam_index}', 'InputMedia', trial.name) 
+        os.makedirs(trial_path, exist_ok=True)
+        filename = f"{str(trial.uuid)}.mov"
+        # Full path for the file
+        return os.path.join(trial_path, filename)
+    
     def mirror_recording(self, session: Session, trialName: str, trialId: str, cam_index: int):
         '''
         Mirrors recording and saves it as a recording from cam_index+1.
@@ -253,6 +275,7 @@ class FileManager:
         cap.release()
         out.release()
         cv2.destroyAllWindows()
+        self.index.update_session(str(session.uuid))
         print("Saved file!")
 
     def save_subjects(self, subjects: List[Subject]):
@@ -311,43 +334,8 @@ class FileManager:
                 }
             }
         """
-        trials_folder_path = os.path.join(self.base_directory, str(session.uuid), 'Videos', 'Cam0', 'InputMedia') #Cam0 always exists
-        processed_trials_folder_path = os.path.join(self.base_directory, str(session.uuid), 'VisualizerJsons')
-        # Should add also for visualizerVideos.
-        trials = get_folders_in_path(trials_folder_path)
-        processed_trials = get_folders_in_path(processed_trials_folder_path)
-
-
-        # Create the dictionary to store trial information
-        trial_dict = {}
-
-        # Iterate over all trials except 'calibration'
-        for trial in trials:
-            if trial == 'calibration': # Skip it
-                continue
-            
-            # Set initial entry in the dictionary
-            trial_dict[trial] = {
-                "processed": "True" if trial in processed_trials else "False",
-                "uuid": None,
-                "trialName": trial,
-            }
-
-            # Define the trial directory path
-            trial_path = os.path.join(trials_folder_path, trial)
-
-            # Check if the directory exists
-            if os.path.isdir(trial_path):
-                # Get UUID from the directory name or file (if applicable)
-
-                # Find the .mov file in the trial directory
-                mov_files = [file for file in os.listdir(trial_path) if file.lower().endswith('.mov')]
-                if mov_files:
-                    # Store the first .mov file found (or modify as needed if there are multiple)
-                    trial_dict[trial]['uuid'] = mov_files[0].rsplit(".",1)[0]
-
-        # Return the final dictionary
-        return trial_dict
+        # Served from the session index, which lists the trial folders again when they changed.
+        return self.index.get_trials(str(session.uuid))
     
     def get_visualizer_videos(self, session: Session, trialName: str) -> List:
         
@@ -358,7 +346,53 @@ class FileManager:
             video_list = [os.path.join(visualizer_video_path, file) for file in files]
         return video_list
 
+    def get_visualizer_json_path(self, session: Session, trialName: str) -> Optional[str]:
+        """
+        Returns the path to the visualizer JSON of a trial, or None if there is none (eg only the compact binary file).
+        """
+        visualiser_path = os.path.join(self.base_directory, str(session.uuid), 'VisualizerJsons', trialName, f'{trialName}.json')
+        return visualiser_path if os.path.isfile(visualiser_path) else None
+
+    def get_media_path(self, session_id: str, relative_path: str) -> Optional[str]:
+        """
+        Resolves a file requested from the media endpoint.
+
+        Args:
+            session_id (str): The session folder.
+            relative_path (str): Path of the file relative to the session folder, in one of MEDIA_FOLDERS.
+
+        Returns:
+            str: The absolute path of the file, or None if it does not exist or is outside of MEDIA_FOLDERS.
+        """
+        # The path comes from the URL: reject separators in the session ID and '..' segments, and check that the
+        # resolved paths are under the data directory, in the session folder.
+        if not is_path_segment(session_id) or not all(is_path_segment(part) for part in relative_path.split('/')):
+            return None
+        base_path = os.path.realpath(self.base_directory)
+        session_path = os.path.realpath(os.path.join(base_path, session_id))
+        if os.path.dirname(session_path) != base_path:
+            return None
+        file_path = os.path.realpath(os.path.join(session_path, relative_path))
+        if not any(file_path.startswith(os.path.join(session_path, folder) + os.sep) for folder in MEDIA_FOLDERS):
+            return None
+        return file_path if os.path.isfile(file_path) else None
+
+    def get_media_url(self, path: str) -> str:
+        """
+        Returns the URL path under which the media endpoint serves a file of a session folder.
+        """
+        relative_path = os.path.relpath(os.path.realpath(path), os.path.realpath(self.base_directory))
+        return '/media/' + quote(relative_path.replace(os.sep, '/'))
+
     
+    def iter_session_zip(self, session_id: str):
+        """
+        Yields the zip archive of a session folder in chunks, while the folder is walked, eg for a streaming response.
+        Videos are stored as they are, other files are deflated.
+        """
+        session_folder_path = os.path.join(self.base_directory, session_id)
+        return iterZip(session_folder_path)
+
     def zip_session_folder(self, session_id: str) -> str:
         # Path to the session folder
         session_folder_path = os.path.join(self.base_directory, session_id)
@@ -366,8 +400,7 @@ class FileManager:
 
         # Create a zip file
         #zip_with_progress(session_folder_path, zip_file_path)
-        shutil.make_archive(zip_file_path, 'zip', session_folder_path)
-        return zip_file_path + '.zip'
+        return writeZip(session_folder_path, zip_file_path + '.zip')
     
     def encode_zip_to_base64(self, zip_file_path: str) -> str:
         # Encode the zip file in base64
@@ -17,7 +17,7 @@ from utils import getDataDirectory
 
 
 def runLocalTrial(sessionId: str, trialNames, trialId, trialType="dynamic", poseDetector='hrnet', genericFolderNames=True, cameras_to_use=['all'],
-                  resolutionPoseDetection='default', dataDir = None, forceRedoPoseEstimation = False) -> bool:
+                  resolutionPoseDetection='default', dataDir = None, forceRedoPoseEstimation = False, stage = 'all') -> bool:
     '''
     Runs the trial Locally.
 
@@ -31,40 +31,51 @@ def runLocalTrial(sessionId: str, trialNames, trialId, trialType="dynamic", pose
         resolutionPoseDetection (str): Defaults to 'default'. The resolution to run openpose with. 
                                        NB: Higher resolutions than hardware supports will crash on Ubuntu and take a very long time on Windows (or maybe also crash).
         dataDir (str): Defaults to nullable.
+        stage (str): Defaults to 'all'. 'poseDetection' only runs pose detection (GPU-bound), and
+                     'reconstruction' runs the remaining stages (CPU-bound: synchronization, triangulation,
+                     augmentation, OpenSim) re-using the detected poses. Calibration trials have no pose detection,
+                     'poseDetection' does nothing for them.
     '''
+    # The data directory is passed to main explicitly rather than through the
+    # working directory, since trials may run concurrently.
     if dataDir:
-        os.chdir(dataDir)
-        # Check if the current folder is named "Data"
-        if os.path.basename(os.getcwd()) == "Data":
-            # Change the directory one level up if it is "Data"
-            os.chdir("..")
+        data_dir = os.path.normpath(os.path.abspath(dataDir))
+        # Check if the folder is named "Data"
+        if os.path.basename(data_dir) == "Data":
+            # Use the directory one level up if it is "Data"
+            data_dir = os.path.dirname(data_dir)
+    else:
+        data_dir = getDataDirectory(isDocker=False)
+    session_path = os.path.join(data_dir,'Data',sessionId)
 
     extrinsicTrial = False
     scaleModel = False
 
     if trialType == "calibration":
-         # Get session directory and delete previous calibration files output
-        session_id = sessionId 
-        data_dir = getDataDirectory(isDocker=False)
-        session_path = os.path.join(data_dir,'Data',session_id)
+        if stage == 'poseDetection':
+            return True
+        # Delete previous calibration files output
         print(f"session_path is: {session_path}")    
         deleteCalibrationFiles(session_path=session_path, deleteRecorded=False)
 
         extrinsicTrial = True
     elif trialType == "static" or trialType=="neutral":
-        data_dir = getDataDirectory(isDocker=False)
-        session_path = os.path.join(data_dir,'Data', sessionId)
-        print(f"session_path is: {session_path}")
-        print(f"staticTrialname = {trialNames}")
-        deleteStaticFiles(session_path=session_path, staticTrialName=trialNames)
+        if stage != 'reconstruction':
+            print(f"session_path is: {session_path}")
+            print(f"staticTrialname = {trialNames}")
+            deleteStaticFiles(session_path=session_path, staticTrialName=trialNames)
+            forceRedoPoseEstimation = True
         scaleModel = True
-        forceRedoPoseEstimation = True
 
+    # The poses were detected by the 'poseDetection' stage.
+    if stage == 'reconstruction':
+        forceRedoPoseEstimation = False
 
     main(sessionId, trialNames, trialId, cameras_to_use=cameras_to_use,
          intrinsicsFinalFolder='Deployed', isDocker=False,
           extrinsicsTrial=extrinsicTrial, poseDetector=poseDetector, resolutionPoseDetection=resolutionPoseDetection,
-           scaleModel=scaleModel, genericFolderNames=genericFolderNames, forceRedoPoseEstimation=forceRedoPoseEstimation )
+           scaleModel=scaleModel, genericFolderNames=genericFolderNames, forceRedoPoseEstimation=forceRedoPoseEstimation,
+           dataDir=data_dir, poseDetectionOnly=stage == 'poseDetection')
     
     return True
 
@@ -1,3 +1,10 @@
+import os
+import sys
+
+# Dynamically calculate to get main folder, imported by FileManager,
+# uploadManager and localReprocess.
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '../../')))
+
 from fastapi import FastAPI, WebSocket, WebSocketDisconnect, BackgroundTasks, UploadFile, Request
 from fastapi.websockets import WebSocketState
 from mangum import Mangum
@@ -8,13 +15,16 @@ from sessionModel import Session, Trial, Subject
 import json
 import base64
 from FileManager import FileManager
-import os
 import pickle 
 import threading
 import time
 import asyncio
 from localReprocess import runLocalTrial
-from fastapi.responses import FileResponse
+from trialScheduler import TrialScheduler, TrialJob, TrialStage
+from fastapi.responses import FileResponse, JSONResponse, Response, StreamingResponse
+from mediaStreaming import stream_file, preflight_response, CORS_HEADERS
+from uploadManager import UploadManager, UploadOffsetError
+from starlette.requests import ClientDisconnect
 
 
 from enum import Enum # Maybe or something else
@@ -30,44 +40,49 @@ import socket
 class CustomError(Exception):
     pass
 
-# Class to save info to put in dict in order to queue processing trials
-class ProcessTrial:
-    def __init__(self):
-        #websocket: WebSocket, session: Session, trialId: str, trialType: Optional[str] = "dynamic", isTest=False,  trialNames: Optional[str] = "")
-        self.session: Session
-        self.websocket: WebSocket
-        self.trialId: str
-        self.trialType: str
-        self.trialName: str
-        self.timeAdded: time
+# Estimated GPU memory (MB) used by one pose detection. OpenPose uses the
+# whole GPU, since its memory use is not known.
+GPU_MEMORY_PER_DETECTION = {"hrnet": 3500, "mmpose": 3500}
+# GPU memory budget (MB) if it cannot be read from torch.
+DEFAULT_GPU_MEMORY = 8000
+
+def getSchedulerCapacities() -> Dict[str, float]:
+    """
+    Returns the resources available to process trials: the GPU memory budget (MB), and the number of CPU workers,
+    ie trials in CPU-bound stages at the same time (each of them also uses a few threads/processes).
+    """
+    gpuMemory = DEFAULT_GPU_MEMORY
+    try:
+        import torch
+        if torch.cuda.is_available():
+            gpuMemory = torch.cuda.get_device_properties(0).total_memory / 1024**2
+    except ImportError:
+        pass
+    return {"gpuMemory": gpuMemory, "cpuWorkers": max(1, (os.cpu_count() or 1) // 4)}
+
+def releasePoseModels(requiredMemory: Optional[float] = None):
+    """
+    Frees the GPU memory of the pose models that mmpose keeps loaded in this process between videos, if any.
+    With requiredMemory (MB), only under memory pressure, ie if less than that is free on the GPU.
+    """
+    utilsMMpose = sys.modules.get("utilsMMpose") # Only loaded if mmpose ran in this process.
+    if utilsMMpose is None:
+        return
+    if requiredMemory is not None:
+        torch = sys.modules["torch"] # Imported by utilsMMpose.
+        if not torch.cuda.is_available() or torch.cuda.mem_get_info()[0] / 1024**2 >= requiredMemory:
+            return
+    utilsMMpose.release_models()
 
 class sessionManager:
     def __init__(self):
         self.sessions: List[Session] = []
         self.activeSession: Optional[Session] = None
-        self.isProcessing = False
         self.processingTrials = {} # Dict with key: uuid as a string, and values are either: 'processing' or 'queued'
-        self.processQueue = {} # Dict for queueing the processing trials
-
-    #Checks the processQueue for the next trial to run.
-    #Should prioritize Neutral if they exist
-    def checkQueue(self) -> ProcessTrial:
-        print("Checking queue...")
-        return self.get_oldest_trial(self.processQueue)
-    
-    def get_oldest_trial(trials: Dict[str, ProcessTrial]) -> Optional[ProcessTrial]:
-        if not trials:
-            return None
-
-        neutral_trials = [t for t in trials.values() if t.trialType == "neutral"]
-
-        if neutral_trials:
-            # Return the neutral trial with the oldest timeAdded
-            return min(neutral_trials, key=lambda t: t.timeAdded)
-
-        # Otherwise return the oldest overall
-        return min(trials.values(), key=lambda t: t.timeAdded)
-
+        self.trialWebsockets: Dict[str, WebSocket] = {} # Web app that requested processing, per trial.
+        self.scheduler = TrialScheduler(getSchedulerCapacities(), onChange=self.onSchedulerChange)
+        self.activeDetections = 0 # Pose detection stages running.
+        self.detectionsLock = threading.Lock()
 
     def addSession(self, session: Session):
         self.sessions.append(session)
@@ -101,21 +116,13 @@ class sessionManager:
         print(trials)
         return trials
 
-    # Should do this a better way maybe
     def findSessionByID(self, session_id: str) -> Optional[Session]:
         # Check activate connections
         for session in self.sessions:
-            print("checking active sessions...")
             if str(session.getID()) == session_id:
                 return session
-        #Otherwise check old sessions
-        saved_sessions = fileManager.load_sessions()
-        print("checking saved sessions:")
-        for session_name, session_info in saved_sessions.items():
-            print(session_name)
-            if session_id == session_name:
-                return session_info
-        return None
+        # Otherwise load the saved session through the session index.
+        return fileManager.get_session(session_id)
     
     async def sendUpdatedTrials(self, websocket: WebSocket, session_id: str):
         trials = self.get_trials(session=Session(session_uuid=session_id))
@@ -200,23 +207,54 @@ class sessionManager:
                 }
             await manager.send_personal_message(message=json.dumps(toastMsg), websocket=websocket)
 
-    async def wait_for_gpu(self, interval=20):
+    def createTrialJob(self, sessionId: str, trialNames: str, trialId: str, trialType: str,
+                       poseDetector: str = "hrnet") -> TrialJob:
         """
-        Wait until the computer is no longer processing a trial
-
-        Args:
-            interval (int): How often to check (in seconds).
-
-        Returns:
-            int: The ID of the GPU that meets the criteria.
+        Creates the scheduler job of a trial: pose detection on the GPU, followed by the CPU-bound stages.
+        Calibration trials have a single CPU-bound stage.
         """
-        while self.isProcessing:
-            await asyncio.sleep(interval)
-    
+        def runStage(stage):
+            return lambda: runLocalTrial(sessionId, trialNames, trialId, trialType=trialType, poseDetector=poseDetector,
+                                         dataDir=fileManager.base_directory, stage=stage)
+        gpuMemory = min(GPU_MEMORY_PER_DETECTION.get(poseDetector.lower(), self.scheduler.capacities["gpuMemory"]),
+                        self.scheduler.capacities["gpuMemory"])
+        def runPoseDetection():
+            with self.detectionsLock:
+                self.activeDetections += 1
+            try:
+                runStage("poseDetection")()
+            finally:
+                with self.detectionsLock:
+                    self.activeDetections -= 1
+                    lastDetection = self.activeDetections == 0
+                # The models stay loaded for the next trials. The GPU memory of the stage is given back to the
+                # scheduler though, so they are freed if another detection would not fit next to them.
+                if lastDetection:
+                    releasePoseModels(requiredMemory=gpuMemory)
+        stages = []
+        if trialType != "calibration": # GPU only needed for dynamic and neutral trials.
+            stages.append(TrialStage("poseDetection", runPoseDetection, {"gpuMemory": gpuMemory, "cpuWorkers": 1}))
+        stages.append(TrialStage("reconstruction", runStage("reconstruction"), {"cpuWorkers": 1}))
+        return TrialJob(sessionId, trialId, trialType, stages)
+
+    async def onSchedulerChange(self, status: dict):
+        # Mark queued dynamic trials that started as processing.
+        for trial in status["trials"]:
+            trialId = trial["trialId"]
+            if trial["state"] != "queued" and self.processingTrials.get(trialId) == "queued":
+                self.processingTrials[trialId] = "processing"
+                websocket = self.trialWebsockets.get(trialId)
+                if websocket:
+                    await self.sendUpdatedTrials(websocket=websocket, session_id=trial["session"])
+        await manager.announce(json.dumps({"command": "scheduler_status", "content": status}))
+
     async def processTrial(self, websocket: WebSocket, session: Session, trialId: str, trialType: Optional[str] = "dynamic", isTest=False,  trialNames: Optional[str] = ""):
         """
         Process a trial based on the given session, trial type, and testing flag.
 
+        The trial is queued in the scheduler, which runs it as soon as resources (GPU memory, CPU workers) allow,
+        possibly at the same time as other trials.
+
         Args:
             session: The session object containing session information.
             trialType (str): The type of trial (e.g., "calibration", "neutral", "dynamic").
@@ -250,35 +288,26 @@ class sessionManager:
                 None
             )
 
-        # Run the trial locally TODO: Add some kind of check here or maybe a "try" to prevent crashes :)
-        res = None
-        if trialType != "calibration": #GPU only neededd for dynamic and neutral trials.
-            print("Checking for avaiable GPU")
-            if trialType == "dynamic":
-                self.processingTrials[trialId] = "queued"
-                await self.sendUpdatedTrials(websocket=websocket, session_id=sessionId)
-            
-            await self.wait_for_gpu() #
-        print(f"processing trial: {trialNames}, with id: {trialId}. Type: {trialType}")
-        self.isProcessing = True
+        # Run the trial locally
+        print(f"queueing trial: {trialNames}, with id: {trialId}. Type: {trialType}")
+        self.trialWebsockets[trialId] = websocket
+        if trialType == "dynamic":
+            self.processingTrials[trialId] = "queued"
+            await self.sendUpdatedTrials(websocket=websocket, session_id=sessionId)
         try:
+            await self.scheduler.submit(self.createTrialJob(sessionId, trialNames, trialId, trialType))
+            print("Succesfully processed trial")
+            successMsg = {
+                "command": "process_succeded",
+                "trialType": trialType,
+                "trialId": trialId,
+                "session": sessionId
+            }
+            await manager.send_personal_message(json.dumps(successMsg), websocket)
+            # Handle "dynamic" trial type
             if trialType == "dynamic":
-                self.processingTrials[trialId] = "processing"
+                self.processingTrials.pop(trialId)
                 await self.sendUpdatedTrials(websocket=websocket, session_id=sessionId)
-            res = await asyncio.to_thread(runLocalTrial, sessionId, trialNames, trialId, trialType=trialType, dataDir=fileManager.base_directory)
-            if res!=None:
-                print("Succesfully processed trial")
-                successMsg = {
-                    "command": "process_succeded",
-                    "trialType": trialType,
-                    "trialId": trialId,
-                    "session": sessionId
-                }
-                await manager.send_personal_message(json.dumps(successMsg), websocket)
-                # Handle "dynamic" trial type
-                if trialType == "dynamic":
-                    self.processingTrials.pop(trialId)
-                    await self.sendUpdatedTrials(websocket=websocket, session_id=sessionId)
         except Exception as inst:
             print(f"Error: {type(inst)}! Args: {inst.args} ")
             self.processingTrials[trialId] = "Error"
@@ -294,7 +323,7 @@ class sessionManager:
             }
             await manager.send_personal_message(json.dumps(toastMsg), websocket)
         finally:
-            self.isProcessing = False
+            self.trialWebsockets.pop(trialId, None)
 
     
 class ConnectionInfo:
@@ -521,7 +550,7 @@ class ConnectionManager:
         Args:
             message (str): The message to send.
         '''        
-        for web_connection, mobile_connection in self.connections.items:
+        for web_connection in list(self.connections):
             await self.try_send_message(message=message, connection=web_connection)
 
         
@@ -544,10 +573,15 @@ parent_directory = os.path.abspath(os.path.join(current_script_directory, '..'))
 base_directory = os.path.join(parent_directory, 'Data')
 
 fileManager = FileManager(base_directory)
+uploadManager = UploadManager(base_directory)
 logger = logging.getLogger('uvicorn.error')
 sessionManager = sessionManager()
 
 
+@app.on_event("shutdown")
+def release_pose_models():
+    releasePoseModels()
+
 @app.get("/")
 def health_status():
     return {"Hello": "World"}
@@ -576,10 +610,36 @@ async def download_file(file_name: str, background_tasks: BackgroundTasks):
     else:
         return {"error": "File not found dummy"}
 
-@app.post("/upload/")
-async def upload_file(request: Request, file: UploadFile):
-    # Parse form data manually
-    form = await request.form()
+@app.get("/download_session/{session_id}")
+def download_session_zip(session_id: str):
+    '''
+    Streams the zip archive of a session as it is built, without writing it to disk first.
+    The link is sent by the download_session command.
+    '''
+    if fileManager.get_session(session_id) is None:
+        return JSONResponse({"error": "Session not found"}, status_code=404)
+    return StreamingResponse(
+        fileManager.iter_session_zip(session_id),
+        media_type="application/zip",
+        headers={"Content-Disposition": f"attachment; filename={session_id}.zip"}
+    )
+
+@app.api_route("/media/{session_id}/{file_path:path}", methods=["GET", "HEAD", "OPTIONS"])
+async def stream_media(session_id: str, file_path: str, request: Request):
+    '''
+    Streams a trial video or visualizer JSON of a session, with support for Range requests and ETags.
+    URLs are returned by the get_visualizer_videos and get_visualizer commands when asUrl is set. The web app fetches them from
+    another origin, hence the CORS headers.
+    '''
+    if request.method == "OPTIONS":
+        return preflight_response()
+    path = fileManager.get_media_path(session_id, file_path)
+    if path is None:
+        return JSONResponse({"error": "File not found"}, status_code=404, headers=CORS_HEADERS)
+    return stream_file(request, path)
+
+def parse_upload_form(form):
+    # Returns the session, trial and camera index of an uploaded video, from form fields or query parameters.
     session_uuid = form.get("session_uuid")
     trial_uuid = form.get("trial_uuid")
     trial_name = form.get("trial_name")
@@ -589,15 +649,10 @@ async def upload_file(request: Request, file: UploadFile):
         trial_uuid = trial_name
     session = sessionManager.findSessionByID(session_uuid)
     trial = Trial(name=trial_name, trial_uuid=trial_uuid)
-    
-    # Save file in chunks
-    file_data = bytearray()
-    while chunk := await file.read(1024 * 1024):  # Read 1 MB at a time
-        file_data.extend(chunk)
-
-    saved_path = fileManager.save_binary_file(data=bytes(file_data), session=session, cam_index=cam_index, trial=trial)
-    print(f"Large file uploaded to {saved_path}")
+    return session_uuid, session, trial, cam_index
 
+async def notify_video_uploaded(session_uuid: str, cam_index: int):
+    fileManager.index.update_session(session_uuid)
     websocket = manager.find_web_connection_by_id(session_id=session_uuid)
     videoUploadedMsg = {
             "command": "video_uploaded",
@@ -609,6 +664,98 @@ async def upload_file(request: Request, file: UploadFile):
     else:
         print("ERROR: Video uploaded but could not find web app websocket.")
 
+@app.post("/upload/")
+async def upload_file(request: Request, file: UploadFile):
+    # Parse form data manually
+    form = await request.form()
+    session_uuid, session, trial, cam_index = parse_upload_form(form)
+    saved_path = fileManager.get_video_path(session=session, cam_index=cam_index, trial=trial)
+
+    # Stream the file to disk in chunks, see uploadManager.
+    async def chunks():
+        while chunk := await file.read(1024 * 1024):  # Read 1 MB at a time
+            yield chunk
+    await uploadManager.save_stream(saved_path, chunks())
+    print(f"Large file uploaded to {saved_path}")
+    await notify_video_uploaded(session_uuid, cam_index)
+
+@app.post("/upload_stream/")
+async def upload_file_stream(request: Request):
+    '''
+    Uploads a whole video in one request, as /upload/, but the request body is the raw video and the session, trial
+    and camera are given as query parameters (same fields as the /upload/ form). The body is written to disk as it
+    arrives, see uploadManager, rather than parsed as a form first, which spools the whole video.
+    '''
+    session_uuid, session, trial, cam_index = parse_upload_form(request.query_params)
+    if session is None:
+        return JSONResponse({"error": f"No session found with ID {session_uuid}"}, status_code=404)
+    saved_path = fileManager.get_video_path(session=session, cam_index=cam_index, trial=trial)
+    try:
+        digest = await uploadManager.save_stream(saved_path, request.stream())
+    except ClientDisconnect:
+        # Nothing is kept, use /uploads/ to resume uploads.
+        return Response(status_code=400)
+    print(f"Large file uploaded to {saved_path}")
+    await notify_video_uploaded(session_uuid, cam_index)
+    return JSONResponse({"complete": True, "sha256": digest})
+
+@app.post("/uploads/")
+async def create_upload(request: Request):
+    '''
+    Starts a resumable upload. Takes the same form fields as /upload/ (without the file), and optionally the total
+    size in bytes. The bytes are then sent with PATCH /uploads/{upload_id}.
+    '''
+    form = await request.form()
+    session_uuid, session, trial, cam_index = parse_upload_form(form)
+    if session is None:
+        return JSONResponse({"error": f"No session found with ID {session_uuid}"}, status_code=404)
+    size = int(form["size"]) if form.get("size") else None
+    upload = uploadManager.create(fileManager.get_video_path(session=session, cam_index=cam_index, trial=trial),
+                                  size=size, info={"session_uuid": session_uuid, "cam_index": cam_index})
+    return JSONResponse({"upload_id": upload.upload_id, "offset": 0}, headers={"Upload-Offset": "0"})
+
+@app.head("/uploads/{upload_id}")
+async def get_upload_offset(upload_id: str):
+    '''
+    Returns the number of bytes received so far in the Upload-Offset header, to resume an upload.
+    '''
+    upload = uploadManager.get(upload_id)
+    if upload is None:
+        return Response(status_code=404)
+    return Response(headers={"Upload-Offset": str(upload.offset), "Cache-Control": "no-store"})
+
+@app.patch("/uploads/{upload_id}")
+async def append_upload(upload_id: str, request: Request):
+    '''
+    Appends the request body to an upload, at the offset given by the Upload-Offset header. The upload is complete
+    once its size is reached, or if the Upload-Complete header is 1 (size not given on creation).
+    '''
+    upload = uploadManager.get(upload_id)
+    if upload is None:
+        return JSONResponse({"error": "Upload not found"}, status_code=404)
+    try:
+        offset = await uploadManager.append(upload, int(request.headers.get("upload-offset", 0)), request.stream())
+    except UploadOffsetError as e:
+        return JSONResponse({"error": str(e), "offset": e.offset}, status_code=409,
+                            headers={"Upload-Offset": str(e.offset)})
+    except ClientDisconnect:
+        # The bytes received so far are kept, the client resumes from the offset.
+        return Response(status_code=400)
+    if upload.size is not None and offset > upload.size:
+        uploadManager.cancel(upload)
+        return JSONResponse({"error": f"Received {offset} bytes, expected {upload.size}."}, status_code=400)
+    headers = {"Upload-Offset": str(offset)}
+    if offset == upload.size or request.headers.get("upload-complete") == "1":
+        try:
+            digest = await uploadManager.complete(upload)
+        except UploadOffsetError as e: # Completed before its declared size was received.
+            return JSONResponse({"error": str(e), "offset": e.offset}, status_code=409,
+                                headers={"Upload-Offset": str(e.offset)})
+        print(f"Large file uploaded to {upload.target_path}")
+        await notify_video_uploaded(upload.info["session_uuid"], upload.info["cam_index"])
+        return JSONResponse({"offset": offset, "complete": True, "sha256": digest}, headers=headers)
+    return JSONResponse({"offset": offset, "complete": False}, headers=headers)
+
 @app.websocket("/ws")
 async def websocket_endpoint(websocket: WebSocket, client_type: str, link_to_web: Optional[str] = None ):
     await manager.connect(websocket, client_type, link_to_web)
@@ -688,6 +835,11 @@ async def websocket_endpoint(websocket: WebSocket, client_type: str, link_to_web
 
 async def handle_web_message(websocket, message_json, command, active_session: Session, session_id):
     print(f"Received command: {command}")
+    if command == "get_scheduler_status":
+        # Queue depth, wait times and per-slot utilization of the trial scheduler.
+        statusMsg = {"command": "scheduler_status", "content": sessionManager.scheduler.getStatus()}
+        await manager.send_personal_message(json.dumps(statusMsg), websocket)
+        return
     if active_session:
 
         if command == 'process_trial':
@@ -772,12 +924,21 @@ async def handle_web_message(websocket, message_json, command, active_session: S
 
         elif command == "get_visualizer":
             trialName = message_json.get("trialName")
-            visualizerJson = fileManager.find_visualizer_json(session=active_session, trialName=trialName)
-            jsonMsg = {
-                "command": "visualizerJSON",
-                "content": visualizerJson,
-                "session": str(active_session.uuid)
-            }
+            visualizerPath = fileManager.get_visualizer_json_path(session=active_session, trialName=trialName)
+            if message_json.get("asUrl") and visualizerPath:
+                # The web app fetches the JSON from the media endpoint.
+                jsonMsg = {
+                    "command": "visualizerJSON",
+                    "url": f"http://{ip_address}:8080" + fileManager.get_media_url(visualizerPath),
+                    "session": str(active_session.uuid)
+                }
+            else:
+                visualizerJson = fileManager.find_visualizer_json(session=active_session, trialName=trialName)
+                jsonMsg = {
+                    "command": "visualizerJSON",
+                    "content": visualizerJson,
+                    "session": str(active_session.uuid)
+                }
             await manager.send_personal_message(message=json.dumps(jsonMsg), websocket=websocket)
         
         elif command == "delete_session":
@@ -787,18 +948,12 @@ async def handle_web_message(websocket, message_json, command, active_session: S
         elif command == "download_session":
             #try:
             # Get chunk size and info egarding download. Send to web app
-            print(f"zipping file...{active_session.uuid}")
             start_message = {
                     "command": "download_start",
                 }
             await manager.send_personal_message(message=json.dumps(start_message), websocket=websocket)
-            dataPath = fileManager.send_session_zip(session_id=str(active_session.uuid))
-            fileName = os.path.basename(dataPath)
-            
-            print(f"zipped as {fileName}")
-            # open the zipped file
-            # Assuming you're sending this message via a WebSocket
-            download_link = f"http://{ip_address}:8080/download/{fileName}"
+            # The archive is streamed while it is built, the download starts right away.
+            download_link = f"http://{ip_address}:8080/download_session/{active_session.uuid}"
 
             message = {
                 "command": "download_link",
@@ -812,11 +967,19 @@ async def handle_web_message(websocket, message_json, command, active_session: S
             video_paths = fileManager.get_visualizer_videos(session = active_session, trialName=trialName)
             videos = []
             for video_path in video_paths:
-                with open(video_path, "rb") as video:
-                    encoded_video = base64.b64encode(video.read()).decode("utf-8")
+                if message_json.get("asUrl"):
+                    # The web app streams the video from the media endpoint.
                     videos.append({
-                        "data": encoded_video
+                        "url": f"http://{ip_address}:8080" + fileManager.get_media_url(video_path),
+                        "name": os.path.basename(video_path),
+                        "size": os.path.getsize(video_path)
                     })
+                else:
+                    with open(video_path, "rb") as video:
+                        encoded_video = base64.b64encode(video.read()).decode("utf-8")
+                        videos.append({
+                            "data": encoded_video
+                        })
             message = {
                 "command": "visualizer_videos",
                 "content": videos
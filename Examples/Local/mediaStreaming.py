@@ -0,0 +1,134 @@
+"""
+Streaming of session files (trial videos, visualizer JSONs) over HTTP.
+
+Files are read in chunks while they are sent, so memory use does not depend
+on the file size, and the reads run in the threadpool of the server rather
+than on the event loop. Single byte ranges (Range: bytes=start-end) are
+supported, such that video players can seek and resume. An ETag, derived
+from the modification time and size of the file, lets clients re-validate
+cached files (If-None-Match) and resume only if the file did not change
+(If-Range). The web app is served from another origin than the local
+server, so the responses carry CORS headers, and preflight requests are
+answered by preflight_response.
+"""
+
+import os
+import mimetypes
+from email.utils import formatdate
+from typing import Iterator, Optional, Tuple
+
+from fastapi import Request
+from fastapi.responses import Response, StreamingResponse
+
+CHUNK_SIZE = 256 * 1024 # bytes
+
+# Session media is not private to an origin: any page may read it.
+CORS_HEADERS = {
+    "Access-Control-Allow-Origin": "*",
+    "Access-Control-Expose-Headers": "Accept-Ranges, Content-Length, Content-Range, ETag",
+}
+
+mimetypes.add_type("video/quicktime", ".mov")
+mimetypes.add_type("video/x-msvideo", ".avi")
+
+
+def get_etag(stat: os.stat_result) -> str:
+    return '"{:x}-{:x}"'.format(stat.st_mtime_ns, stat.st_size)
+
+
+def parse_range(range_header: Optional[str], size: int) -> Optional[Tuple[int, int]]:
+    """
+    Parses a Range header into (start, end), inclusive.
+
+    Returns:
+        Tuple[int, int]: The requested range, or None to send the whole file (no header, several ranges, or a header
+                         that is not understood).
+
+    Raises:
+        ValueError: If the range cannot be satisfied.
+    """
+    if not range_header or not range_header.startswith("bytes=") or "," in range_header:
+        return None
+    first, _, last = range_header[len("bytes="):].strip().partition("-")
+    try:
+        first = int(first) if first else None
+        last = int(last) if last else None
+    except ValueError:
+        return None # Invalid headers are ignored.
+    if first is None: # Suffix range: the last `last` bytes.
+        if last is None:
+            return None
+        if last == 0 or size == 0:
+            raise ValueError("Range not satisfiable.")
+        return max(0, size - last), size - 1
+    if first >= size or (last is not None and last < first):
+        raise ValueError("Range not satisfiable.")
+    return first, size - 1 if last is None else min(last, size - 1)
+
+
+def iter_file(path: str, start: int, end: int, chunk_size: int = CHUNK_SIZE) -> Iterator[bytes]:
+    # Sync generator: the server iterates it in its threadpool.
+    with open(path, "rb") as file:
+        file.seek(start)
+        remaining = end - start + 1
+        while remaining > 0:
+            chunk = file.read(min(chunk_size, remaining))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+            yield chunk
+
+
+def preflight_response() -> Response:
+    """
+    Returns the response to a CORS preflight (OPTIONS) request, eg for a fetch with a Range header.
+    """
+    headers = dict(CORS_HEADERS)
+    headers["Access-Control-Allow-Methods"] = "GET, HEAD"
+    headers["Access-Control-Allow-Headers"] = "Range, If-None-Match, If-Range"
+    headers["Access-Control-Max-Age"] = "600"
+    return Response(status_code=204, headers=headers)
+
+
+def stream_file(request: Request, path: str, media_type: Optional[str] = None) -> Response:
+    """
+    Returns a response streaming the file at path, honoring Range, If-None-Match and If-Range.
+    """
+    stat = os.stat(path)
+    size = stat.st_size
+    etag = get_etag(stat)
+    if media_type is None:
+        media_type = mimetypes.guess_type(path)[0] or "application/octet-stream"
+    headers = {
+        **CORS_HEADERS,
+        "Accept-Ranges": "bytes",
+        "ETag": etag,
+        "Last-Modified": formatdate(stat.st_mtime, usegmt=True),
+        "Cache-Control": "no-cache", # Cached, but re-validated with the ETag.
+    }
+
+    if etag in [tag.strip() for tag in request.headers.get("if-none-match", "").split(",")]:
+        return Response(status_code=304, headers=headers)
+
+    # Ranges only apply to the version of the file identified by If-Range, if any.
+    range_header = request.headers.get("range")
+    if_range = request.headers.get("if-range")
+    if if_range and if_range != etag:
+        range_header = None
+    try:
+        byte_range = parse_range(range_header, size)
+    except ValueError:
+        headers["Content-Range"] = f"bytes */{size}"
+        return Response(status_code=416, headers=headers)
+
+    status_code = 200
+    start, end = 0, size - 1
+    if byte_range is not None:
+        start, end = byte_range
+        status_code = 206
+        headers["Content-Range"] = f"bytes {start}-{end}/{size}"
+    headers["Content-Length"] = str(end - start + 1)
+    if request.method == "HEAD":
+        return Response(status_code=status_code, headers=headers, media_type=media_type)
+    return StreamingResponse(iter_file(path, start, end), status_code=status_code, headers=headers,
+                             media_type=media_type)
@@ -0,0 +1,265 @@
+"""
+Persistent index of the sessions and trials in the data directory.
+
+Listing sessions used to re-scan the data directory and parse every
+sessionMetadata.yaml. The index keeps, per session folder, the parsed
+metadata and the trials found in Cam0/InputMedia, and is saved in a hidden
+folder of the data directory (.sessionIndex/index.json) such that restarting
+the server does not re-parse unchanged sessions. Saving the index thus does
+not change the data directory itself, which would trigger a full refresh.
+
+Entries are kept consistent with the files, including edits made outside
+of the server, by comparing file signatures (modification time and size):
+    - the metadata is re-parsed when sessionMetadata.yaml changed,
+    - the trials are re-listed when the InputMedia or VisualizerJsons folder,
+      or one of the trial folders, changed,
+    - the list of session folders is re-read when the data directory changed
+      (a folder was added or removed).
+Looking up a session or trial by ID is thus a dictionary lookup plus a few
+stat calls, independent of the number of sessions. FileManager updates the
+index directly after its own writes.
+"""
+
+import os
+import copy
+import json
+import threading
+from typing import Dict, Optional, Tuple
+
+import yaml
+
+INDEX_VERSION = 1
+INDEX_FOLDER = ".sessionIndex"
+INDEX_FILE = "index.json"
+
+
+def get_signature(path: str) -> Optional[list]:
+    """
+    Returns [modification time (ns), size] of a file or folder, or None if it does not exist.
+    """
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return [stat.st_mtime_ns, stat.st_size]
+
+
+class SessionIndex:
+    """
+    Index of the session folders in base_directory, by session ID (folder name), and of their trials, by trial ID.
+
+    Args:
+        base_directory (str): The data directory, with one folder per session.
+        persist (bool): Whether to save the index to a hidden folder of base_directory and load it at startup.
+    """
+    def __init__(self, base_directory: str, persist: bool = True):
+        self.base_directory = base_directory
+        self.index_path = os.path.join(base_directory, INDEX_FOLDER, INDEX_FILE) if persist else None
+        self.sessions: Dict[str, dict] = {}
+        self.trials: Dict[str, Tuple[str, str]] = {} # trial ID -> (session ID, trial name)
+        self.base_signature = None
+        self.lock = threading.RLock()
+        self.dirty = False
+        if self.index_path is not None and os.path.isdir(base_directory):
+            # Created before the first signature of base_directory is taken.
+            os.makedirs(os.path.dirname(self.index_path), exist_ok=True)
+        self.load()
+        self.refresh()
+
+    # Persistence.
+    def load(self):
+        if self.index_path is None or not os.path.isfile(self.index_path):
+            return
+        try:
+            with open(self.index_path, "r") as file:
+                data = json.load(file)
+        except (OSError, ValueError):
+            return # Rebuilt by refresh.
+        if data.get("version") != INDEX_VERSION:
+            return
+        self.sessions = data["sessions"]
+        for session_id, entry in self.sessions.items():
+            self._index_trials(session_id, entry)
+
+    def save(self):
+        # Saves the index if it changed. Written to a temporary file first, such that a crash cannot corrupt it.
+        with self.lock:
+            if self.index_path is None or not self.dirty:
+                return
+            # The files written in it do not change the signature of base_directory.
+            os.makedirs(os.path.dirname(self.index_path), exist_ok=True)
+            tmp_path = self.index_path + ".tmp"
+            with open(tmp_path, "w") as file:
+                json.dump({"version": INDEX_VERSION, "sessions": self.sessions}, file, default=str)
+            os.replace(tmp_path, self.index_path)
+            self.dirty = False
+
+    # Consistency.
+    def refresh(self):
+        """
+        Full consistency check: adds new session folders, drops removed ones, and updates changed entries.
+        """
+        with self.lock:
+            self.base_signature = get_signature(self.base_directory)
+            folders = set()
+            if os.path.isdir(self.base_directory):
+                # Hidden folders hold server state, eg uploads in progress.
+                folders = {name for name in os.listdir(self.base_directory)
+                           if not name.startswith(".") and os.path.isdir(os.path.join(self.base_directory, name))}
+            for session_id in list(self.sessions):
+                if session_id not in folders:
+                    self.remove_session(session_id)
+            for session_id in folders:
+                self._validate(session_id)
+            self.save()
+
+    def _refresh_folders(self):
+        # Re-reads the list of session folders only if the data directory changed.
+        if get_signature(self.base_directory) != self.base_signature:
+            self.refresh()
+
+    def _validate(self, session_id: str) -> Optional[dict]:
+        # Returns the up-to-date entry of a session folder, or None if it is not a session (anymore).
+        session_path = os.path.join(self.base_directory, session_id)
+        if not os.path.isdir(session_path):
+            self.remove_session(session_id)
+            return None
+        entry = self.sessions.get(session_id)
+        if entry is None:
+            entry = {"metadataSignature": None, "metadata": None, "trialsSignature": None, "trials": {}}
+            self.sessions[session_id] = entry
+            self.dirty = True
+
+        metadata_path = os.path.join(session_path, "sessionMetadata.yaml")
+        signature = get_signature(metadata_path)
+        if signature != entry["metadataSignature"]:
+            entry["metadataSignature"] = signature
+            entry["metadata"] = None
+            if signature is not None:
+                try:
+                    with open(metadata_path, "r") as file:
+                        entry["metadata"] = yaml.safe_load(file)
+                except (OSError, yaml.YAMLError) as e:
+                    print(f"Could not read {metadata_path}: {e}")
+            self.dirty = True
+
+        signature = self._trials_signature(session_path, entry)
+        if signature != entry["trialsSignature"]:
+            entry["trialsSignature"] = signature
+            self._unindex_trials(session_id, entry)
+            entry["trials"] = self._list_trials(session_path)
+            self._index_trials(session_id, entry)
+            self.dirty = True
+        return entry
+
+    def _trials_signature(self, session_path: str, entry: dict) -> list:
+        trials_path = os.path.join(session_path, "Videos", "Cam0", "InputMedia")
+        processed_path = os.path.join(session_path, "VisualizerJsons")
+        signature = [get_signature(trials_path), get_signature(processed_path)]
+        for trial_name in sorted(entry["trials"]):
+            signature.append(get_signature(os.path.join(trials_path, trial_name)))
+        return signature
+
+    def _list_trials(self, session_path: str) -> dict:
+        # Same content as FileManager.find_trials.
+        trials_path = os.path.join(session_path, "Videos", "Cam0", "InputMedia") # Cam0 always exists
+        processed_path = os.path.join(session_path, "VisualizerJsons")
+        processed_trials = get_folders(processed_path)
+        trial_dict = {}
+        for trial in get_folders(trials_path):
+            if trial == "calibration": # Skip it
+                continue
+            trial_dict[trial] = {
+                "processed": "True" if trial in processed_trials else "False",
+                "uuid": None,
+                "trialName": trial,
+            }
+            mov_files = sorted(file for file in os.listdir(os.path.join(trials_path, trial))
+                               if file.lower().endswith(".mov"))
+            if mov_files:
+                trial_dict[trial]["uuid"] = mov_files[0].rsplit(".", 1)[0]
+        return trial_dict
+
+    def _index_trials(self, session_id: str, entry: dict):
+        for trial_name, trial in entry["trials"].items():
+            if trial["uuid"]:
+                self.trials[trial["uuid"]] = (session_id, trial_name)
+
+    def _unindex_trials(self, session_id: str, entry: dict):
+        for trial in entry["trials"].values():
+            if self.trials.get(trial["uuid"], (None,))[0] == session_id:
+                del self.trials[trial["uuid"]]
+
+    # Updates after writes.
+    def update_session(self, session_id: str):
+        with self.lock:
+            self.base_signature = get_signature(self.base_directory)
+            self._validate(session_id)
+            self.save()
+
+    def remove_session(self, session_id: str):
+        with self.lock:
+            entry = self.sessions.pop(session_id, None)
+            if entry is not None:
+                self._unindex_trials(session_id, entry)
+                self.dirty = True
+
+    # Lookups.
+    def get_metadata(self, session_id: str) -> Optional[dict]:
+        """
+        Returns a copy of the parsed metadata of a session, or None if there is no such session or it has no metadata.
+        """
+        with self.lock:
+            if session_id not in self.sessions:
+                self._refresh_folders()
+            entry = self._validate(session_id) if session_id in self.sessions else None
+            self.save()
+            if entry is None or entry["metadata"] is None:
+                return None
+            return copy.deepcopy(entry["metadata"])
+
+    def get_all_metadata(self) -> Dict[str, dict]:
+        """
+        Returns the parsed metadata of all sessions with metadata, by session ID.
+        """
+        with self.lock:
+            self._refresh_folders()
+            metadata = {}
+            for session_id in list(self.sessions):
+                entry = self._validate(session_id)
+                if entry is not None and entry["metadata"] is not None:
+                    metadata[session_id] = copy.deepcopy(entry["metadata"])
+            self.save()
+            return metadata
+
+    def get_trials(self, session_id: str) -> dict:
+        """
+        Returns the trials of a session, as FileManager.find_trials.
+        """
+        with self.lock:
+            if session_id not in self.sessions:
+                self._refresh_folders()
+            entry = self._validate(session_id) if session_id in self.sessions else None
+            self.save()
+            return copy.deepcopy(entry["trials"]) if entry is not None else {}
+
+    def find_trial(self, trial_id: str) -> Optional[Tuple[str, str]]:
+        """
+        Returns the session ID and trial name of a trial, or None if not found.
+        """
+        with self.lock:
+            location = self.trials.get(trial_id)
+            if location is not None:
+                entry = self._validate(location[0])
+                if entry is not None and entry["trials"].get(location[1], {}).get("uuid") == trial_id:
+                    self.save()
+                    return location
+            # Not indexed or moved: check all sessions for changes.
+            self.refresh()
+            return self.trials.get(trial_id)
+
+
+def get_folders(path: str) -> list:
+    if not os.path.isdir(path):
+        return []
+    return [name for name in os.listdir(path) if os.path.isdir(os.path.join(path, name))]
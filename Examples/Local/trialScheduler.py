@@ -0,0 +1,214 @@
+"""
+Event-driven scheduler for processing trials on the local server.
+
+Each trial is a job made of stages that run one after the other, eg pose
+detection (GPU-bound) and reconstruction (CPU-bound: synchronization,
+triangulation, augmentation, OpenSim). Each stage declares the resources it
+needs, eg GPU memory (MB) and CPU workers, and is started as soon as these
+are available. Stages of different trials thus overlap: while one trial
+detects poses on the GPU, others are reconstructed on the CPU, and several
+detections run at the same time if the GPU memory budget allows it.
+
+Scheduling is event-driven: it runs when a trial is submitted and when a
+stage finishes, there is no polling.
+
+Ordering:
+    - Waiting stages are considered by trial type (calibration, then neutral,
+      then dynamic) and then by submission time. A stage that does not fit
+      reserves the resources it needs, such that trials behind it cannot
+      starve it by taking these resources first.
+    - Trials of the same session depend on each other: a dynamic trial waits
+      for the calibration and neutral trials submitted before it, and a
+      calibration or neutral trial waits for all trials submitted before it
+      (it deletes and rewrites files that the other trials use).
+"""
+
+import time
+import asyncio
+import itertools
+from typing import Callable, Dict, List, Optional
+
+# Order in which waiting trials are considered.
+TRIAL_TYPE_PRIORITY = {"calibration": 0, "neutral": 1, "static": 1, "dynamic": 2}
+
+
+class TrialStage:
+    """
+    A step of a trial, run in a worker thread.
+
+    Args:
+        name (str): Name of the stage, eg "poseDetection".
+        func (Callable): Function run by the stage, without arguments.
+        resources (Dict[str, float]): Amount of each resource the stage uses while running.
+    """
+    def __init__(self, name: str, func: Callable, resources: Dict[str, float]):
+        self.name = name
+        self.func = func
+        self.resources = resources
+
+
+class TrialJob:
+    """
+    A trial waiting for or being processed by the scheduler.
+
+    Args:
+        sessionId (str): Session of the trial.
+        trialId (str): Id of the trial.
+        trialType (str): "calibration", "neutral" or "dynamic".
+        stages (List[TrialStage]): Stages of the trial, run in order.
+    """
+    _counter = itertools.count()
+
+    def __init__(self, sessionId: str, trialId: str, trialType: str, stages: List[TrialStage]):
+        self.sessionId = sessionId
+        self.trialId = trialId
+        self.trialType = trialType
+        self.stages = stages
+        self.order = next(TrialJob._counter)
+        self.timeAdded = time.time()
+        self.timeStarted: Optional[float] = None
+        self.stageIndex = 0
+        self.running = False # True while a stage runs
+        self.done: Optional[asyncio.Future] = None
+
+    def nextStage(self) -> TrialStage:
+        return self.stages[self.stageIndex]
+
+    def state(self) -> str:
+        if self.running:
+            return self.nextStage().name
+        return "queued" if self.timeStarted is None else "waiting"
+
+    def priority(self):
+        return (TRIAL_TYPE_PRIORITY.get(self.trialType, 2), self.order)
+
+
+class TrialScheduler:
+    """
+    Runs the stages of the submitted trials as resources become available.
+
+    Args:
+        capacities (Dict[str, float]): Amount available of each resource, eg {"gpuMemory": 8000, "cpuWorkers": 4}.
+        onChange (Callable): Optional coroutine function, awaited with the scheduler status whenever a trial is
+                             submitted, starts or finishes a stage.
+    """
+    def __init__(self, capacities: Dict[str, float], onChange: Optional[Callable] = None):
+        self.capacities = dict(capacities)
+        self.inUse = {name: 0. for name in capacities}
+        self.onChange = onChange
+        self.jobs: List[TrialJob] = [] # Submitted and not finished, in submission order.
+        self.timeCreated = time.time()
+        # Integral over time of the amount of each resource in use, for utilization.
+        self.busyIntegral = {name: 0. for name in capacities}
+        self.timeUpdated = self.timeCreated
+        self.waitTimes: List[float] = [] # Queueing time of the last started trials.
+
+    def submit(self, job: TrialJob) -> asyncio.Future:
+        """
+        Adds a trial to the queue.
+
+        Returns:
+            asyncio.Future: Resolved when all stages of the trial are done, or set to the exception raised by a stage.
+        """
+        for stage in job.stages:
+            for name, amount in stage.resources.items():
+                if amount > self.capacities.get(name, 0):
+                    raise ValueError(f"Stage {stage.name} needs {amount} {name}, but only "
+                                     f"{self.capacities.get(name, 0)} is available.")
+        job.done = asyncio.get_running_loop().create_future()
+        self.jobs.append(job)
+        self._schedule()
+        self._notify()
+        return job.done
+
+    def _updateUtilization(self):
+        now = time.time()
+        for name in self.inUse:
+            self.busyIntegral[name] += self.inUse[name] * (now - self.timeUpdated)
+        self.timeUpdated = now
+
+    def _fits(self, stage: TrialStage, reserved: set) -> bool:
+        return all(name not in reserved and
+                   self.inUse.get(name, 0) + amount <= self.capacities.get(name, 0)
+                   for name, amount in stage.resources.items() if amount > 0)
+
+    def _dependenciesDone(self, job: TrialJob) -> bool:
+        for other in self.jobs:
+            if other.order >= job.order or other.sessionId != job.sessionId:
+                continue
+            if job.trialType != "dynamic" or other.trialType != "dynamic":
+                return False
+        return True
+
+    def _schedule(self):
+        # Starts every waiting stage that fits, by priority. Called on events.
+        reserved = set()
+        for job in sorted(self.jobs, key=TrialJob.priority):
+            if job.running or not self._dependenciesDone(job):
+                continue
+            stage = job.nextStage()
+            if not self._fits(stage, reserved):
+                reserved.update(name for name, amount in stage.resources.items() if amount > 0)
+                continue
+            self._updateUtilization()
+            for name, amount in stage.resources.items():
+                self.inUse[name] += amount
+            job.running = True
+            if job.timeStarted is None:
+                job.timeStarted = time.time()
+                self.waitTimes = (self.waitTimes + [job.timeStarted - job.timeAdded])[-50:]
+            asyncio.create_task(self._runStage(job, stage))
+
+    async def _runStage(self, job: TrialJob, stage: TrialStage):
+        self._notify()
+        error = None
+        try:
+            await asyncio.to_thread(stage.func)
+        except Exception as e:
+            error = e
+        self._updateUtilization()
+        for name, amount in stage.resources.items():
+            self.inUse[name] -= amount
+        job.running = False
+        job.stageIndex += 1
+        if error is not None or job.stageIndex == len(job.stages):
+            self.jobs.remove(job)
+            if error is not None:
+                job.done.set_exception(error)
+            else:
+                job.done.set_result(True)
+        self._schedule()
+        self._notify()
+
+    def _notify(self):
+        if self.onChange is not None:
+            asyncio.create_task(self.onChange(self.getStatus()))
+
+    def getStatus(self) -> dict:
+        """
+        Returns the queue depth, wait times, and per-resource utilization.
+
+        Utilization is the average fraction of the resource used since the scheduler was created.
+        """
+        self._updateUtilization()
+        now = time.time()
+        elapsed = max(now - self.timeCreated, 1e-9)
+        waiting = [now - job.timeAdded for job in self.jobs if job.timeStarted is None]
+        slots = {}
+        for name, capacity in self.capacities.items():
+            slots[name] = {
+                "capacity": capacity,
+                "inUse": self.inUse[name],
+                "utilization": self.busyIntegral[name] / (capacity * elapsed) if capacity else 0.,
+            }
+        return {
+            "queueDepth": len(waiting),
+            "running": sum(job.running for job in self.jobs),
+            "waitTime": {
+                "longestQueued": max(waiting, default=0.),
+                "recentAverage": sum(self.waitTimes) / len(self.waitTimes) if self.waitTimes else 0.,
+            },
+            "slots": slots,
+            "trials": [{"trialId": job.trialId, "session": job.sessionId, "trialType": job.trialType,
+                        "state": job.state()} for job in sorted(self.jobs, key=TrialJob.priority)],
+        }
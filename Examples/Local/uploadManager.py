@@ -0,0 +1,202 @@
+"""
+Streaming, resumable uploads of videos to the local server.
+
+Uploaded bytes are written to a temporary file next to the destination as
+they arrive, instead of being accumulated in memory, and hashed (sha256)
+on the fly. On completion, the temporary file is fsynced and atomically
+renamed to its destination, so a partial upload never appears as a video,
+and its hash is registered with the stage cache (utilsStageCache), which
+then does not need to read the video again.
+
+Resumable uploads are identified by an upload ID. The client creates the
+upload, sends the bytes in one or more requests, each starting at the
+offset the server has received so far, and asks for that offset to resume
+after a dropped connection. The state of each upload is saved in
+<base_directory>/.uploads, such that uploads can also be resumed after a
+restart of the server (the partial file is then hashed again once).
+"""
+
+import os
+import json
+import uuid
+import asyncio
+import hashlib
+import threading
+from typing import AsyncIterator, Dict, Optional
+
+from utilsStageCache import registerFileHash
+
+WRITE_SIZE = 1024 * 1024 # bytes buffered before each write to disk
+
+
+class UploadOffsetError(Exception):
+    """
+    Raised when the bytes sent do not start at the offset received so far.
+    """
+    def __init__(self, offset: int):
+        super().__init__(f"Upload is at offset {offset}.")
+        self.offset = offset
+
+
+def fsync_directory(path: str):
+    # Persists a rename. Not supported (nor needed) on Windows.
+    if os.name == "nt":
+        return
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+class Upload:
+    """
+    A file being received: the temporary file, the number of bytes received, and the running hash.
+    """
+    def __init__(self, upload_id: str, target_path: str, size: Optional[int] = None, info: Optional[dict] = None):
+        self.upload_id = upload_id
+        self.target_path = target_path
+        self.part_path = f"{target_path}.{upload_id}.part"
+        self.size = size # Expected total size, if known.
+        self.info = info or {} # Passed back on completion, eg session and camera.
+        self.offset = 0
+        self.hasher = hashlib.sha256()
+        self.lock = asyncio.Lock() # One request writes to an upload at a time.
+
+    def to_dict(self) -> dict:
+        return {"upload_id": self.upload_id, "target_path": self.target_path, "size": self.size, "info": self.info}
+
+    def resume(self):
+        # Restores offset and hash from the partial file, after a restart.
+        self.offset = 0
+        self.hasher = hashlib.sha256()
+        if os.path.exists(self.part_path):
+            with open(self.part_path, "rb") as file:
+                for chunk in iter(lambda: file.read(WRITE_SIZE), b""):
+                    self.hasher.update(chunk)
+                    self.offset += len(chunk)
+
+    def write(self, data: bytes):
+        with open(self.part_path, "ab") as file:
+            file.write(data)
+        self.hasher.update(data)
+        self.offset += len(data)
+
+    def finalize(self) -> str:
+        with open(self.part_path, "ab") as file:
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(self.part_path, self.target_path)
+        fsync_directory(os.path.dirname(self.target_path))
+        digest = self.hasher.hexdigest()
+        registerFileHash(self.target_path, digest)
+        return digest
+
+
+class UploadManager:
+    """
+    Keeps track of the uploads in progress.
+
+    Args:
+        base_directory (str): The data directory; upload states are saved in its .uploads folder.
+    """
+    def __init__(self, base_directory: str):
+        self.state_directory = os.path.join(base_directory, ".uploads")
+        os.makedirs(self.state_directory, exist_ok=True)
+        self.uploads: Dict[str, Upload] = {}
+        self.lock = threading.Lock()
+
+    def _state_path(self, upload_id: str) -> str:
+        return os.path.join(self.state_directory, f"{upload_id}.json")
+
+    def create(self, target_path: str, size: Optional[int] = None, info: Optional[dict] = None) -> Upload:
+        """
+        Starts a resumable upload to target_path.
+        """
+        upload = Upload(uuid.uuid4().hex, target_path, size=size, info=info)
+        with open(upload.part_path, "wb"):
+            pass
+        with open(self._state_path(upload.upload_id), "w") as file:
+            json.dump(upload.to_dict(), file)
+        with self.lock:
+            self.uploads[upload.upload_id] = upload
+        return upload
+
+    def get(self, upload_id: str) -> Optional[Upload]:
+        """
+        Returns an upload in progress, restoring it from its saved state if needed (after a restart).
+        """
+        with self.lock:
+            upload = self.uploads.get(upload_id)
+            if upload is None and all(c in "0123456789abcdef" for c in upload_id):
+                state_path = self._state_path(upload_id)
+                if os.path.isfile(state_path):
+                    with open(state_path, "r") as file:
+                        state = json.load(file)
+                    upload = Upload(upload_id, state["target_path"], size=state["size"], info=state["info"])
+                    upload.resume()
+                    self.uploads[upload_id] = upload
+            return upload
+
+    async def append(self, upload: Upload, offset: int, chunks: AsyncIterator[bytes]) -> int:
+        """
+        Writes the chunks to the upload, starting at offset.
+
+        Returns:
+            int: The new offset. If the connection drops, the bytes received so far are kept.
+
+        Raises:
+            UploadOffsetError: If offset is not the number of bytes received so far.
+        """
+        async with upload.lock:
+            if offset != upload.offset:
+                raise UploadOffsetError(upload.offset)
+            buffer = bytearray()
+            try:
+                async for chunk in chunks:
+                    buffer.extend(chunk)
+                    if len(buffer) >= WRITE_SIZE:
+                        await asyncio.to_thread(upload.write, bytes(buffer))
+                        buffer.clear()
+            finally:
+                if buffer:
+                    await asyncio.to_thread(upload.write, bytes(buffer))
+            return upload.offset
+
+    async def complete(self, upload: Upload) -> str:
+        """
+        Moves a complete upload to its destination.
+
+        Returns:
+            str: The sha256 hexdigest of the file.
+        """
+        async with upload.lock:
+            if upload.size is not None and upload.offset != upload.size:
+                raise UploadOffsetError(upload.offset)
+            digest = await asyncio.to_thread(upload.finalize)
+            with self.lock:
+                self.uploads.pop(upload.upload_id, None)
+            os.remove(self._state_path(upload.upload_id))
+            return digest
+
+    def cancel(self, upload: Upload):
+        with self.lock:
+            self.uploads.pop(upload.upload_id, None)
+        for path in [upload.part_path, self._state_path(upload.upload_id)]:
+            if os.path.exists(path):
+                os.remove(path)
+
+    async def save_stream(self, target_path: str, chunks: AsyncIterator[bytes]) -> str:
+        """
+        Saves a whole (non-resumable) upload to target_path, without holding it in memory.
+
+        Returns:
+            str: The sha256 hexdigest of the file.
+        """
+        upload = self.create(target_path)
+        try:
+            await self.append(upload, 0, chunks)
+            return await self.complete(upload)
+        except BaseException:
+            self.cancel(upload)
+            raise
@@ -0,0 +1,96 @@
+"""
+---------------------------------------------------------------------------
+OpenCap: benchmarkPoseServer.py
+---------------------------------------------------------------------------
+
+Licensed under the Apache License, Version 2.0 (the "License"); you may not
+use this file except in compliance with the License. You may obtain a copy
+of the License at http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+
+This script compares pose detection through the pose server
+(utilsPoseServer), which keeps the model loaded, with initializing the model
+for every video, as the file-polling daemons did. It uses the CPU-only
+stand-in model, with a simulated initialization time, so it runs without a
+GPU. The videos of several cameras are sent concurrently, as
+utilsDetector does, and the keypoints returned by the server are checked
+against running the model directly.
+
+"""
+
+import os
+import sys
+import time
+import shutil
+import tempfile
+import threading
+
+import cv2
+import numpy as np
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '../')))
+from utilsPoseServer import PoseServer, StandInPoseModel, runPoseServerJob
+
+nVideos = 6
+nCameras = 2
+nFrames = 120
+loadTime = 2. # s to initialize the model
+bbox_thr = 0.8
+
+# %%
+def writeVideo(path):
+    writer = cv2.VideoWriter(path, cv2.VideoWriter_fourcc(*'MJPG'), 60,
+                             (320, 240))
+    for i in range(nFrames):
+        writer.write(np.full((240, 320, 3), i % 256, dtype=np.uint8))
+    writer.release()
+
+# %%
+if __name__ == '__main__':
+    dataDir = tempfile.mkdtemp()
+    videoPath = os.path.join(dataDir, 'video.avi')
+    writeVideo(videoPath)
+    expected = StandInPoseModel().infer(videoPath, bbox_thr)
+
+    # Model initialized for every video.
+    start = time.time()
+    for i in range(nVideos):
+        StandInPoseModel(loadTime=loadTime).infer(videoPath, bbox_thr)
+    timePerVideo = time.time() - start
+
+    # Pose server, the cameras of a trial sent concurrently.
+    start = time.time()
+    server = PoseServer(StandInPoseModel(loadTime=loadTime), port=0).start()
+    timeLoad = time.time() - start
+    progress = []
+    for i in range(0, nVideos, nCameras):
+        results = [None] * nCameras
+        def runCamera(c):
+            results[c] = runPoseServerJob(server.url, videoPath, bbox_thr,
+                                          onProgress=progress.append)
+        threads = [threading.Thread(target=runCamera, args=(c,))
+                   for c in range(nCameras)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        for frames in results:
+            assert len(frames) == len(expected)
+            for frame, expectedFrame in zip(frames, expected):
+                assert np.array_equal(frame[0]['preds_with_flip'],
+                                      expectedFrame[0]['preds_with_flip'])
+    timeServer = time.time() - start
+    server.shutdown()
+    shutil.rmtree(dataDir)
+
+    assert any(message['status'] == 'running' for message in progress)
+    print('Model initialized per video: {} videos in {:.1f}s.'.format(
+        nVideos, timePerVideo))
+    print('Pose server: {} videos in {:.1f}s, including {:.1f}s to load the '
+          'model once.'.format(nVideos, timeServer, timeLoad))
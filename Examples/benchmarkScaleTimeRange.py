@@ -0,0 +1,87 @@
+"""
+---------------------------------------------------------------------------
+OpenCap: benchmarkScaleTimeRange.py
+---------------------------------------------------------------------------
+
+Licensed under the Apache License, Version 2.0 (the "License"); you may not
+use this file except in compliance with the License. You may obtain a copy
+of the License at http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+
+This script compares the static window detection used by getScaleTimeRange
+(utilsOpenSim.detectStaticWindow) with the original window-by-window search,
+on synthetic static trials of increasing duration and sampling frequency. It
+checks that both return the same window and reports their run times.
+
+"""
+
+import os
+import sys
+import time
+import numpy as np
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '../')))
+from utilsOpenSim import detectStaticWindow
+
+# %% Original search, evaluating one window at a time.
+def detectStaticWindow_loop(trc_data, sf, nf, thresholdPosition=0.005,
+                            thresholdTime=0.3):
+    detectedWindow = False
+    i = 0
+    while not detectedWindow:
+        c_window = trc_data[i:i+nf,:]
+        c_window_max = np.max(c_window, axis=0)
+        c_window_min = np.min(c_window, axis=0)
+        c_window_diff = np.abs(c_window_max - c_window_min)
+        detectedWindow = np.all(c_window_diff<thresholdPosition)
+        if not detectedWindow:
+            i += 1
+            if i > trc_data.shape[0]-nf:
+                i = 0
+                nf -= int(0.1*sf)
+            if np.round((nf-1)/sf,2) < thresholdTime:
+                raise Exception('No static window detected.')
+
+    return i, nf
+
+# %% Synthetic static trial: the subject moves, and stands still for
+# staticDuration seconds towards the end of the trial.
+def generateTrial(duration, sf, staticDuration, nMarkers=31, seed=0):
+    np.random.seed(seed)
+    nFrames = int(duration*sf)
+    trc_data = np.cumsum(np.random.normal(0, 0.002, (nFrames, 3*nMarkers)),
+                         axis=0)
+    staticStart = int((duration - staticDuration - 0.5)*sf)
+    staticEnd = staticStart + int(staticDuration*sf)
+    trc_data[staticStart:staticEnd] = (
+        trc_data[staticStart] + np.random.uniform(
+            0, 0.004, (staticEnd-staticStart, 3*nMarkers)))
+
+    return trc_data
+
+# %%
+if __name__ == '__main__':
+    for duration, sf, staticDuration in [(5, 60, 1.5), (10, 60, 0.8),
+                                         (10, 120, 0.8), (20, 240, 0.6)]:
+        trc_data = generateTrial(duration, sf, staticDuration)
+        nf = int(sf + 1)
+
+        start = time.time()
+        result_loop = detectStaticWindow_loop(trc_data, sf, nf)
+        time_loop = time.time() - start
+
+        start = time.time()
+        result = detectStaticWindow(trc_data, sf, nf)
+        time_vectorized = time.time() - start
+
+        assert result == result_loop, (result, result_loop)
+        print('{}s at {}Hz (window of {} frames at {}): loop {:.3f}s, '
+              'vectorized {:.3f}s ({:.0f}x).'.format(
+                  duration, sf, result[1], result[0], time_loop,
+                  time_vectorized, time_loop/time_vectorized))
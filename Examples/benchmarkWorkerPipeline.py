@@ -0,0 +1,215 @@
+"""
+---------------------------------------------------------------------------
+OpenCap: benchmarkWorkerPipeline.py
+---------------------------------------------------------------------------
+
+Licensed under the Apache License, Version 2.0 (the "License"); you may not
+use this file except in compliance with the License. You may obtain a copy
+of the License at http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+
+This script runs the pipelined worker (utilsWorker.TrialPipeline) against a
+stand-in API server on localhost, with stubbed processing, and compares it
+with processing the trials one after the other, as app.py used to. The
+server hands out trials from a queue, serves their videos with a simulated
+bandwidth, and records the status posted for each trial and the results
+uploaded. Processing is simulated with a sleep. One trial fails during
+processing and one during download, to check that failures stay isolated.
+
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import tempfile
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '../')))
+from utilsTransfer import getHTTPSession, downloadFiles
+from utilsWorker import TrialPipeline
+
+nTrials = 8
+nSessions = 3
+nCameras = 2
+videoSize = 1 << 20 # bytes
+transferTime = 0.4 # s per video, download and upload
+processingTime = 1. # s per trial
+failProcessing = 3 # index of the trial that fails during processing
+failDownload = 5 # index of the trial whose videos are missing
+
+# %% Stand-in API server.
+class FakeAPI(object):
+    def __init__(self):
+        self.pending = []
+        self.status = {}
+        self.uploads = {}
+        self.lock = threading.Lock()
+
+    def reset(self):
+        with self.lock:
+            self.pending = [{'id': 'trial{}'.format(i),
+                             'session': 'session{}'.format(i % nSessions),
+                             'name': 'trial{}'.format(i),
+                             'videos': [{'video': 'videos/trial{}_cam{}.mov'.format(i, c)}
+                                        for c in range(nCameras)]}
+                            for i in range(nTrials)]
+            self.status = {}
+            self.uploads = {}
+
+class Handler(BaseHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+    def send(self, code, body=b''):
+        self.send_response(code)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        api = self.server.api
+        if self.path.startswith('/trials/dequeue/'):
+            with api.lock:
+                trial = api.pending.pop(0) if api.pending else None
+            if trial is None:
+                self.send(404)
+            else:
+                self.send(200, json.dumps(trial).encode())
+        elif self.path.startswith('/videos/'):
+            if 'trial{}_'.format(failDownload) in self.path:
+                self.send(404)
+                return
+            time.sleep(transferTime)
+            self.send(200, b'\0' * videoSize)
+        else:
+            self.send(404)
+
+    def do_PATCH(self):
+        api = self.server.api
+        trial_id = self.path.strip('/').split('/')[-1]
+        body = self.rfile.read(int(self.headers['Content-Length'])).decode()
+        with api.lock:
+            api.status[trial_id] = body.split('=')[-1]
+        self.send(200)
+
+    def do_POST(self):
+        api = self.server.api
+        trial_id = self.path.strip('/').split('/')[-1]
+        self.rfile.read(int(self.headers['Content-Length']))
+        time.sleep(transferTime)
+        with api.lock:
+            api.uploads[trial_id] = api.uploads.get(trial_id, 0) + 1
+        self.send(201)
+
+# %% Stubbed stages.
+def getStages(apiURL, dataDir, log):
+    def dequeue():
+        r = getHTTPSession().get(apiURL + 'trials/dequeue/')
+        if r.status_code == 404:
+            time.sleep(0.05)
+            return None
+        return r.json()
+
+    def prepare(trial):
+        sessionPath = os.path.join(dataDir, trial['session'])
+        os.makedirs(sessionPath, exist_ok=True)
+        downloadFiles([(apiURL + v['video'],
+                        os.path.join(sessionPath, os.path.basename(v['video'])))
+                       for v in trial['videos']])
+        return {'trial': trial, 'sessionPath': sessionPath}
+
+    def process(state):
+        trial = state['trial']
+        log.append(('start', trial['session'], time.time()))
+        time.sleep(processingTime)
+        log.append(('end', trial['session'], time.time()))
+        if trial['id'] == 'trial{}'.format(failProcessing):
+            raise Exception('Processing failed.', 'Simulated failure.')
+        with open(os.path.join(state['sessionPath'], 'result.bin'), 'wb') as f:
+            f.write(b'\0' * videoSize)
+
+    def upload(state):
+        with open(os.path.join(state['sessionPath'], 'result.bin'), 'rb') as f:
+            r = getHTTPSession().post(
+                apiURL + 'results/' + state['trial']['id'] + '/',
+                files={'file': f})
+        r.raise_for_status()
+
+    def setStatus(trial, status):
+        r = getHTTPSession().patch(apiURL + 'trials/' + trial['id'] + '/',
+                                   data={'status': status})
+        r.raise_for_status()
+
+    def cleanup(trial):
+        shutil.rmtree(os.path.join(dataDir, trial['session']),
+                      ignore_errors=True)
+
+    return dequeue, prepare, process, upload, setStatus, cleanup
+
+# %% Trials one after the other, as in the original worker loop.
+def runSequential(dequeue, prepare, process, upload, setStatus, cleanup):
+    for i in range(nTrials):
+        trial = None
+        while trial is None:
+            trial = dequeue()
+        try:
+            state = prepare(trial)
+            process(state)
+            upload(state)
+            setStatus(trial, 'done')
+        except Exception:
+            setStatus(trial, 'error')
+        cleanup(trial)
+
+# %%
+if __name__ == '__main__':
+    api = FakeAPI()
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    server.api = api
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    apiURL = 'http://127.0.0.1:{}/'.format(server.server_address[1])
+    expectedStatus = {'trial{}'.format(i): 'done' for i in range(nTrials)}
+    expectedStatus['trial{}'.format(failProcessing)] = 'error'
+    expectedStatus['trial{}'.format(failDownload)] = 'error'
+
+    times = {}
+    for mode in ['sequential', 'pipelined']:
+        api.reset()
+        dataDir = tempfile.mkdtemp()
+        log = []
+        stages = getStages(apiURL, dataDir, log)
+        start = time.time()
+        if mode == 'sequential':
+            runSequential(*stages)
+        else:
+            dequeue, prepare, process, upload, setStatus, cleanup = stages
+            pipeline = TrialPipeline(dequeue, prepare, process, upload,
+                                     setStatus, cleanup=cleanup,
+                                     idleInterval=0.05)
+            pipeline.run(maxTrials=nTrials)
+        times[mode] = time.time() - start
+
+        assert api.status == expectedStatus, api.status
+        assert sorted(api.uploads) == sorted(
+            t for t, s in expectedStatus.items() if s == 'done')
+        assert not os.listdir(dataDir)
+        shutil.rmtree(dataDir)
+        # Trials are processed one at a time.
+        for (_, _, end), (_, _, nextStart) in zip(log[1::2], log[2::2]):
+            assert nextStart >= end
+        # Share of the time spent processing, ie the GPU utilization.
+        busyTime = processingTime * len(log) / 2
+        print('{}: {} trials in {:.1f}s ({:.0f}% processing).'.format(
+            mode, nTrials, times[mode], 100 * busyTime / times[mode]))
+
+    print('Speedup: {:.1f}x.'.format(times['sequential'] / times['pipelined']))
+    server.shutdown()
@@ -0,0 +1,168 @@
+"""
+---------------------------------------------------------------------------
+OpenCap: checkTransfers.py
+---------------------------------------------------------------------------
+
+Licensed under the Apache License, Version 2.0 (the "License"); you may not
+use this file except in compliance with the License. You may obtain a copy
+of the License at http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+
+This script checks the retries of the HTTP transfers (utilsTransfer) and
+utils.postFileToTrial against a stand-in API and S3 server on localhost.
+The server fails a given number of requests per path, with an error status
+or by breaking the response stream, and counts the requests it receives,
+such that each failure is checked to be retried by one layer only, and
+errors to be raised once the retries are exhausted.
+
+"""
+
+import os
+import sys
+import json
+import shutil
+import tempfile
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import requests
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '../')))
+import utils
+import utilsTransfer
+
+videoSize = 1 << 20 # bytes
+
+# %% Stand-in API and S3 server.
+class Handler(BaseHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+    def send(self, code, body=b'', length=None):
+        self.send_response(code)
+        self.send_header('Content-Length', str(len(body) if length is None
+                                               else length))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def count(self):
+        # Returns the failure configured for this request, if any.
+        server = self.server
+        path = self.path.split('?')[0]
+        with server.lock:
+            server.requests[path] = server.requests.get(path, 0) + 1
+            failures = server.failures.get(path, [])
+            return failures.pop(0) if failures else None
+
+    def do_GET(self):
+        failure = self.count()
+        if failure == 'broken':
+            # Announces the full video but closes the connection halfway.
+            self.send(200, self.server.video[:videoSize // 2],
+                      length=videoSize)
+            self.close_connection = True
+        elif failure is not None:
+            self.send(failure)
+        elif self.path.startswith('/sessions/null/get_presigned_url/'):
+            self.send(200, json.dumps({
+                'url': self.server.url + '/s3/',
+                'fields': {'key': 'results/file.trc'}}).encode())
+        else:
+            self.send(200, self.server.video)
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        failure = self.count()
+        if failure is not None:
+            self.send(failure)
+        elif self.path == '/results/':
+            self.send(201)
+        else:
+            self.send(204)
+
+def startServer():
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    server.url = 'http://127.0.0.1:{}'.format(server.server_port)
+    server.lock = threading.Lock()
+    server.requests = {}
+    server.failures = {}
+    server.video = os.urandom(videoSize)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+def setFailures(server, failures):
+    with server.lock:
+        server.requests = {}
+        server.failures = {path: list(f) for path, f in failures.items()}
+
+# %%
+if __name__ == '__main__':
+    server = startServer()
+    utils.API_URL = server.url + '/'
+    utils.API_TOKEN = 'token'
+    utilsTransfer.BACKOFF_FACTOR = 0.01
+    utilsTransfer.resetHTTPSession()
+    nAttempts = utilsTransfer.MAX_RETRIES + 1
+    dataDir = tempfile.mkdtemp()
+    filePath = os.path.join(dataDir, 'file.trc')
+    with open(filePath, 'wb') as f:
+        f.write(b'trc')
+
+    # Error statuses of a download are retried by the session only.
+    setFailures(server, {'/video.mov': [503] * 2})
+    videoPath = os.path.join(dataDir, 'video.mov')
+    utilsTransfer.downloadFile(server.url + '/video.mov', videoPath)
+    with open(videoPath, 'rb') as f:
+        assert f.read() == server.video
+    assert server.requests['/video.mov'] == 3, server.requests
+
+    setFailures(server, {'/video.mov': [503] * 10})
+    try:
+        utilsTransfer.downloadFile(server.url + '/video.mov', videoPath + '2')
+        raise AssertionError('Download did not raise.')
+    except requests.HTTPError:
+        pass
+    assert server.requests['/video.mov'] == nAttempts, server.requests
+    assert not os.path.exists(videoPath + '2')
+
+    # A broken stream is retried by downloadFile.
+    setFailures(server, {'/video.mov': ['broken']})
+    utilsTransfer.downloadFile(server.url + '/video.mov', videoPath)
+    with open(videoPath, 'rb') as f:
+        assert f.read() == server.video
+    assert server.requests['/video.mov'] == 2, server.requests
+
+    # Uploads are retried by uploadFile only, then the result is posted.
+    setFailures(server, {'/s3/': [503] * 2})
+    utils.postFileToTrial(filePath, 'trial', 'ik_results', 'all')
+    assert server.requests['/s3/'] == 3, server.requests
+    assert server.requests['/results/'] == 1, server.requests
+
+    # A failed upload raises, and no result is posted.
+    setFailures(server, {'/s3/': [503] * 10})
+    try:
+        utils.postFileToTrial(filePath, 'trial', 'ik_results', 'all')
+        raise AssertionError('Failed upload did not raise.')
+    except requests.HTTPError:
+        pass
+    assert server.requests['/s3/'] == nAttempts, server.requests
+    assert '/results/' not in server.requests, server.requests
+
+    # Client errors are not retried.
+    setFailures(server, {'/s3/': [403]})
+    try:
+        utils.postFileToTrial(filePath, 'trial', 'ik_results', 'all')
+        raise AssertionError('Failed upload did not raise.')
+    except requests.HTTPError:
+        pass
+    assert server.requests['/s3/'] == 1, server.requests
+
+    server.shutdown()
+    shutil.rmtree(dataDir)
+    print('All transfer checks passed.')
@@ -3,7 +3,8 @@ import time
 import json
 import os
 import shutil
-from utilsServer import processTrial, runTestSession
+from utilsServer import (runTestSession, prepareTrial, runTrial,
+                         uploadTrialResults)
 import traceback
 import logging
 import glob
@@ -12,6 +13,8 @@ from utilsAPI import getAPIURL, getWorkerType, getASInstance, unprotect_current_
 from utilsAuth import getToken
 from utils import (getDataDirectory, checkTime, checkResourceUsage,
                   sendStatusEmail, checkForTrialsWithStatus)
+from utilsTransfer import getHTTPSession
+from utilsWorker import TrialPipeline
 
 logging.basicConfig(level=logging.INFO)
 
@@ -35,17 +38,33 @@ with_on_prem = True
 minutesBeforeRemoveScaleInProtection = 2
 max_on_prem_pending_trials = 5
 
-while True:
+# Trials are processed by a pipeline (see utilsWorker): while a trial is
+# processed, the next trial is dequeued and downloaded, and the results of
+# the previous trial are uploaded.
+pipeline = None
+
+def checkStatus():
     # Run test trial at a given frequency to check status of machine. Stop machine if fails.
+    global t, initialStatusCheck
     if checkTime(t,minutesElapsed=30) or not initialStatusCheck:
         runTestSession(isDocker=isDocker)           
         t = time.localtime()
         initialStatusCheck = True
+        
+def dequeueTrial():
+    # Returns the next trial, or None if there is none.
+    global t_lastTrial, justProcessed
+    
+    # Trials in the pipeline count as just processed, such that scale-in
+    # protection is not removed while they are processed.
+    busy = pipeline is not None and pipeline.getNumberOfTrialsInFlight() > 0
+    if busy:
+        justProcessed = True
 
     # When using autoscaling, if there are on-prem workers, then we will remove
     # the instance scale-in protection if the number of pending trials is below
     # a threshold so that the on-prem workers are prioritized.
-    if with_on_prem:
+    if with_on_prem and not busy:
         # Query the number of pending trials        
         if autoScalingInstance:
             pending_trials = get_number_of_pending_trials()
@@ -64,12 +83,13 @@ while True:
     # no query string -> defaults to 'all'
     queue_path = "trials/dequeue/?workerType=" + workerType
     try:
+        # Not retried, dequeuing claims the trial.
         r = requests.get("{}{}".format(API_URL, queue_path),
                          headers = {"Authorization": "Token {}".format(API_TOKEN)})
     except Exception as e:
         traceback.print_exc()
         time.sleep(15)
-        continue
+        return None
 
     if r.status_code == 404:
         logging.info("...pulling " + workerType + " trials.")
@@ -95,12 +115,12 @@ while True:
             justProcessed = False
             t_lastTrial = time.localtime()
             
-        continue
+        return None
     
     if np.floor(r.status_code/100) == 5: # 5xx codes are server faults
         logging.info("API unresponsive. Status code = {:.0f}.".format(r.status_code))
         time.sleep(5)
-        continue
+        return None
     
     # Check resource usage
     resourceUsage = checkResourceUsage(stop_machine_and_email=True)
@@ -119,7 +139,7 @@ while True:
 
         r = requests.patch(trial_url, data={"status": "error", "meta": json.dumps(error_msg)},
                          headers = {"Authorization": "Token {}".format(API_TOKEN)})
-        continue
+        return None
 
     # The following is now done in main, to allow reprocessing trials with missing videos
     # if any([v["video"] is None for v in trial["videos"]]):
@@ -127,44 +147,56 @@ while True:
     #                 headers = {"Authorization": "Token {}".format(API_TOKEN)})
     #     continue
 
-    trial_type = "dynamic"
+    trial["trial_type"] = "dynamic"
     if trial["name"] == "calibration":
-        trial_type = "calibration"
+        trial["trial_type"] = "calibration"
     if trial["name"] == "neutral":
         trial["name"] = "static"
-        trial_type = "static"
+        trial["trial_type"] = "static"
+    
+    justProcessed = True
+        
+    return trial
 
-    logging.info("processTrial({},{},trial_type={})".format(trial["session"], trial["id"], trial_type))
+def prepare(trial):
+    logging.info("processTrial({},{},trial_type={})".format(trial["session"], trial["id"], trial["trial_type"]))
+    return prepareTrial(trial["session"], trial["id"],
+                        trial_type=trial["trial_type"], isDocker=isDocker)
 
-    try:
-        # trigger reset of timer for last processed trial                            
-        processTrial(trial["session"], trial["id"], trial_type=trial_type, isDocker=isDocker)   
-        # note a result needs to be posted for the API to know we finished, but we are posting them 
-        # automatically thru procesTrial now
-        r = requests.patch(trial_url, data={"status": "done"},
-                         headers = {"Authorization": "Token {}".format(API_TOKEN)})
-        logging.info('0.5s pause if need to restart.')
-        time.sleep(0.5)
-    except Exception as e:
-        r = requests.patch(trial_url, data={"status": "error"},
-                         headers = {"Authorization": "Token {}".format(API_TOKEN)})
-        traceback.print_exc()
-
-        # Antoine: Removing this, it is too often causing the machines to stop. Not because
-        # the machines are failing, but because for instance the video is very long with a lot
-        # of people in it. We should not stop the machine for that. Originally the check was
-        # to catch a bug where the machine would hang, I have not seen this bug in a long time.
-        # args_as_strings = [str(arg) for arg in e.args]
-        # if len(args_as_strings) > 1 and 'pose detection timed out' in args_as_strings[1].lower():
-        #     logging.info("Worker failed. Stopping machine.")
-        #     message = "A backend OpenCap machine timed out during pose detection. It has been stopped."
-        #     sendStatusEmail(message=message)
-        #     raise Exception('Worker failed. Stopped.')
-    justProcessed = True
+def setStatus(trial, status):
+    # note a result needs to be posted for the API to know we finished, but we are posting them 
+    # automatically thru uploadTrialResults now
+    trial_url = "{}{}{}/".format(API_URL, "trials/", trial["id"])
+    r = getHTTPSession().patch(trial_url, data={"status": status},
+                               headers = {"Authorization": "Token {}".format(API_TOKEN)})
+    r.raise_for_status()
+    
+    # Antoine: Removed stopping the machine when a trial fails, it is too often causing the machines to stop. Not because
+    # the machines are failing, but because for instance the video is very long with a lot
+    # of people in it. We should not stop the machine for that. Originally the check was
+    # to catch a bug where the machine would hang, I have not seen this bug in a long time.
+    # args_as_strings = [str(arg) for arg in e.args]
+    # if len(args_as_strings) > 1 and 'pose detection timed out' in args_as_strings[1].lower():
+    #     logging.info("Worker failed. Stopping machine.")
+    #     message = "A backend OpenCap machine timed out during pose detection. It has been stopped."
+    #     sendStatusEmail(message=message)
+    #     raise Exception('Worker failed. Stopped.')
     
-    # Clean data directory
-    if isDocker:
-        folders = glob.glob(os.path.join(getDataDirectory(isDocker=True),'Data','*'))
-        for f in folders:         
-            shutil.rmtree(f)
-            logging.info('deleting ' + f)
\ No newline at end of file
+def cleanup(trial):
+    # Clean session directory; other sessions may be in the pipeline.
+    session_path = os.path.join(getDataDirectory(isDocker=isDocker),'Data',trial["session"])
+    if isDocker and os.path.exists(session_path):
+        shutil.rmtree(session_path)
+        logging.info('deleting ' + session_path)
+
+# Clean data directory
+if isDocker:
+    folders = glob.glob(os.path.join(getDataDirectory(isDocker=True),'Data','*'))
+    for f in folders:         
+        shutil.rmtree(f)
+        logging.info('deleting ' + f)
+
+checkStatus()
+pipeline = TrialPipeline(dequeueTrial, prepare, runTrial, uploadTrialResults,
+                         setStatus, cleanup=cleanup, betweenTrials=checkStatus)
+pipeline.run()
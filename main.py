@@ -8,6 +8,7 @@
 
 import os 
 import glob
+import time
 import numpy as np
 import yaml
 import traceback
@@ -29,6 +30,8 @@ from utilsChecker import rotateIntrinsics
 from utilsDetector  import runPoseDetector
 from utilsAugmenter import augmentTRC
 from utilsOpenSim import runScaleTool, getScaleTimeRange, runIKTool, generateVisualizerJson
+from utilsStageCache import StageCache, getStageCacheDirectory, getCodeVersion, hashFile
+from utilsVisualizer import getVisualizerBinaryPath
 
 def main(sessionName, trialName, trial_id, cameras_to_use=['all'],
          intrinsicsFinalFolder='Deployed', isDocker=False,
@@ -41,7 +44,9 @@ def main(sessionName, trialName, trial_id, cameras_to_use=['all'],
          dataDir=None, overwriteAugmenterModel=False,
          filter_frequency='default', overwriteFilterFrequency=False,
          scaling_setup='upright_standing_pose', overwriteScalingSetup=False,
-         overwriteCamerasToUse=False, forceRedoPoseEstimation=False):
+         overwriteCamerasToUse=False, forceRedoPoseEstimation=False,
+         useStageCache=False, stageCacheDir=None, visualizerFormat='json',
+         poseDetectionOnly=False):
 
     # %% High-level settings.
     # Camera calibration.
@@ -187,6 +192,22 @@ def main(sessionName, trialName, trial_id, cameras_to_use=['all'],
         with open(pathSettings, 'w') as file:
             yaml.dump(settings, file)
 
+    # %% Stage cache.
+    # If useStageCache, the outputs of pose detection, synchronization, 
+    # triangulation, marker augmentation, and the OpenSim pipeline are stored
+    # in a content-addressed cache (see utilsStageCache), and restored instead
+    # of re-running the stage when its inputs did not change. The cache is
+    # outside the session folder, such that it survives deleting the session
+    # folder between reprocessing runs.
+    stageCache = None
+    if useStageCache and not extrinsicsTrial:
+        if stageCacheDir is None:
+            stageCacheDir = getStageCacheDirectory(dataDir)
+        stageCache = StageCache(stageCacheDir, sessionDir, trial_id)
+        codeVersion2D3D = getCodeVersion(
+            [os.path.join(baseDir, i) for i in ['utilsChecker.py', 
+                                                'utilsCameraPy3.py']])
+
     # %% Camera calibration.
     if runCameraCalibration:    
         # Get checkerboard parameters from metadata.
@@ -266,11 +287,19 @@ def main(sessionName, trialName, trial_id, cameras_to_use=['all'],
                 CamParams = rotateIntrinsics(CamParams,extrinsicPath)
                 
                 # for 720p, imageUpsampleFactor=4 is best for small board
+                # If useStageCache, checkerboard detections are cached by 
+                # video content.
+                extrinsicsCacheDir = None
+                if useStageCache:
+                    extrinsicsCacheDir = os.path.join(
+                        stageCacheDir if stageCacheDir is not None else 
+                        getStageCacheDirectory(dataDir), 'extrinsics')
                 try:
                     CamParams = calcExtrinsicsFromVideo(
                         extrinsicPath,CamParams, CheckerBoardParams, 
                         visualize=False, imageUpsampleFactor=imageUpsampleFactor,
-                        useSecondExtrinsicsSolution = useSecondExtrinsicsSolution)
+                        useSecondExtrinsicsSolution = useSecondExtrinsicsSolution,
+                        cacheDir=extrinsicsCacheDir)
                 except Exception as e:
                     if len(e.args) == 2: # specific exception
                         raise Exception(e.args[0], e.args[1])
@@ -373,6 +402,63 @@ def main(sessionName, trialName, trial_id, cameras_to_use=['all'],
                 exception = 'All cameras are required for calibration and neutral pose.'
                 raise Exception(exception, exception)
         
+        # Get stage cache keys, and restore the outputs of pose detection,
+        # as well as of triangulation (and therefore synchronization) if 
+        # available. With restored pose keypoints and rotated videos, 
+        # runPoseDetector does not re-run the pose detector.
+        if stageCache is not None:
+            if camerasToUse_c[0] == 'all':
+                camerasCached = list(cameraDirectories.keys())
+            else:
+                camerasCached = camerasToUse_c
+            videoChecksums = {}
+            for camName in camerasCached:
+                pathVideoWithoutExtension = os.path.join(
+                    cameraDirectories[camName], trialRelativePath)
+                videoChecksums[camName] = hashFile(
+                    pathVideoWithoutExtension + 
+                    getVideoExtension(pathVideoWithoutExtension))
+            if poseDetector == 'OpenPose':
+                poseDetectorSettings = {
+                    'resolutionPoseDetection': resolutionPoseDetection}
+                poseDetectorSuffix = '_' + resolutionPoseDetection
+            elif poseDetector == 'mmpose':
+                poseDetectorSettings = {'bbox_thr': bbox_thr}
+                poseDetectorSuffix = '_mmpose_' + str(bbox_thr)
+            poseDetectionKey = stageCache.getKey('poseDetection', {
+                'videos': videoChecksums, 'poseDetector': poseDetector,
+                'settings': poseDetectorSettings, 
+                'generateVideo': generateVideo,
+                'code': getCodeVersion(
+                    [os.path.join(baseDir, i) for i in [
+                        'utilsDetector.py', 'utilsKeypointStore.py',
+                        'utilsMMpose.py']])})
+            synchronizationKey = stageCache.getKey('synchronization', {
+                'poseDetection': poseDetectionKey, 
+                'CamParamDict': CamParamDict, 'filtFreqs': filtFreqs,
+                'code': codeVersion2D3D})
+            triangulationKey = stageCache.getKey('triangulation', {
+                'synchronization': synchronizationKey, 
+                'CamParamDict': CamParamDict, 
+                'calibrationOptions': calibrationOptions,
+                'alternateExtrinsics': alternateExtrinsics,
+                'scaleModel': scaleModel, 'rotationAngles': rotationAngles,
+                'code': codeVersion2D3D})
+            
+            if not forceRedoPoseEstimation:
+                cachedPoseDetection = stageCache.restore('poseDetection', 
+                                                         poseDetectionKey)
+            else:
+                cachedPoseDetection = None
+            if cachedPoseDetection is not None:
+                cachedTriangulation = stageCache.restore('triangulation',
+                                                         triangulationKey)
+                if cachedTriangulation is not None:
+                    cameras2Use = cachedTriangulation['value']['cameras2Use']
+                    CamParamDict = cachedTriangulation['value']['CamParamDict']
+                    runSynchronization = False
+                    runTriangulation = False
+        
         # Run pose detection algorithm.
         try:        
             videoExtension = runPoseDetector(
@@ -390,6 +476,35 @@ def main(sessionName, trialName, trial_id, cameras_to_use=['all'],
                     Visit https://www.opencap.ai/best-pratices to learn more about data collection
                     and https://www.opencap.ai/troubleshooting for potential causes for a failed trial."""
                 raise Exception(exception, traceback.format_exc())
+        
+        if stageCache is not None and cachedPoseDetection is None:
+            poseDetectionFiles = []
+            for camName in camerasCached:
+                camDir = cameraDirectories[camName]
+                poseDetectionFiles += [
+                    os.path.join(camDir, 'InputMedia', trialName,
+                                 trial_id + '_rotated.avi'),
+                    os.path.join(camDir, 'OutputPkl' + poseDetectorSuffix,
+                                 trialName, '*'),
+                    os.path.join(camDir, 'OutputMedia' + poseDetectorSuffix,
+                                 trialName, '*')]
+            stageCache.save('poseDetection', poseDetectionKey, 
+                            files=poseDetectionFiles)
+            
+    # If poseDetectionOnly, stop after pose detection, eg to run the 
+    # remaining (CPU-bound) stages in a second call while the GPU detects 
+    # poses for another trial. The second call re-uses the detected poses as
+    # long as forceRedoPoseEstimation is False.
+    if poseDetectionOnly and not extrinsicsTrial:
+        return
+            
+    if runSynchronization and stageCache is not None:
+        cachedSynchronization = stageCache.restore('synchronization',
+                                                   synchronizationKey)
+        if cachedSynchronization is not None:
+            (keypoints2D, confidence, keypointNames, frameRate, nansInOut, 
+             startEndFrames, cameras2Use) = cachedSynchronization['value']
+            runSynchronization = False
       
     if runSynchronization:
         # Synchronize videos.
@@ -413,6 +528,11 @@ def main(sessionName, trialName, trial_id, cameras_to_use=['all'],
                     data collection and https://www.opencap.ai/troubleshooting for 
                     potential causes for a failed trial."""
                 raise Exception(exception, traceback.format_exc())
+        
+        if stageCache is not None:
+            stageCache.save('synchronization', synchronizationKey, value=(
+                keypoints2D, confidence, keypointNames, frameRate, nansInOut, 
+                startEndFrames, cameras2Use))
                 
     # Note: this should not be necessary, because we prevent reprocessing the neutral trial
     # with not all cameras, but keeping it in there in case we would want to.
@@ -422,7 +542,8 @@ def main(sessionName, trialName, trial_id, cameras_to_use=['all'],
             if not cam_t in cameras2Use:
                 calibrationOptions.pop(cam_t)
                 
-    if scaleModel and calibrationOptions is not None and alternateExtrinsics is None:
+    if (runTriangulation and scaleModel and calibrationOptions is not None and
+            alternateExtrinsics is None):
         # Automatically select the camera calibration to use
         CamParamDict = autoSelectExtrinsicSolution(sessionDir,keypoints2D,confidence,calibrationOptions)
      
@@ -452,6 +573,16 @@ def main(sessionName, trialName, trial_id, cameras_to_use=['all'],
         writeTRCfrom3DKeypoints(keypoints3D, pathOutputFiles[trialName],
                                 keypointNames, frameRate=frameRate, 
                                 rotationAngles=rotationAngles)
+        
+        if stageCache is not None:
+            stageCache.save('triangulation', triangulationKey, 
+                files=[pathOutputFiles[trialName],
+                       os.path.join(sessionDir, 'VisualizerVideos', 
+                                    trialName, '*'),
+                       os.path.join(sessionDir, 'Videos', 
+                                    'calibOptionSelections.json')],
+                value={'cameras2Use': cameras2Use, 
+                       'CamParamDict': CamParamDict})
     
     # %% Augmentation.
     
@@ -472,6 +603,28 @@ def main(sessionName, trialName, trial_id, cameras_to_use=['all'],
             pathAugmentedOutputFiles[trialName] = os.path.join(
                     postAugmentationDir, trial_id + "_" + augmenterModelName +".trc")
     
+    if runMarkerAugmentation and stageCache is not None:
+        augmentationKey = stageCache.getKey('augmentation', {
+            'trc': hashFile(pathOutputFiles[trialName]),
+            'pathOutputFile': os.path.relpath(
+                pathAugmentedOutputFiles[trialName], sessionDir),
+            'mass_kg': sessionMetadata['mass_kg'], 
+            'height_m': sessionMetadata['height_m'],
+            'augmenterModelName': augmenterModelName, 
+            'augmenterModel': augmenterModel, 'offset': offset,
+            'code': getCodeVersion(
+                [os.path.join(baseDir, 'utilsAugmenter.py'),
+                 os.path.join(baseDir, 'utilsDataman.py')] + 
+                glob.glob(os.path.join(baseDir, 'MarkerAugmenter', 
+                                       augmenterModelName, 
+                                       augmenterModel + '*')))})
+        cachedAugmentation = stageCache.restore('augmentation', 
+                                                augmentationKey)
+        if cachedAugmentation is not None:
+            vertical_offset, vertical_offset_settings = (
+                cachedAugmentation['value'])
+            runMarkerAugmentation = False
+    
     if runMarkerAugmentation:
         os.makedirs(postAugmentationDir, exist_ok=True)    
         augmenterDir = os.path.join(baseDir, "MarkerAugmenter")
@@ -493,6 +646,13 @@ def main(sessionName, trialName, trial_id, cameras_to_use=['all'],
             # (0.01 so that there is no overall offset, see utilsOpenSim).
             vertical_offset_settings = float(np.copy(vertical_offset)-0.01)
             vertical_offset = 0.01   
+        else:
+            vertical_offset_settings = None
+        
+        if stageCache is not None:
+            stageCache.save('augmentation', augmentationKey, 
+                            files=[pathAugmentedOutputFiles[trialName]],
+                            value=(vertical_offset, vertical_offset_settings))
         
     # %% OpenSim pipeline.
     if runOpenSimPipeline:
@@ -515,7 +675,30 @@ def main(sessionName, trialName, trial_id, cameras_to_use=['all'],
             suffix_model = '_shoulder'
         else:
             suffix_model = ''
-        
+            
+    if runOpenSimPipeline and stageCache is not None:
+        pathScaledModel = os.path.join(
+            outputScaledModelDir, 
+            sessionMetadata['openSimModel'] + "_scaled.osim")
+        openSimKey = stageCache.getKey('openSim', {
+            'trc': hashFile(pathAugmentedOutputFiles[trialName]),
+            'openSimFolderName': openSimFolderName,
+            'scaleModel': scaleModel, 'scalingSetup': scalingSetup,
+            'openSimModel': sessionMetadata['openSimModel'],
+            'mass_kg': sessionMetadata['mass_kg'], 
+            'height_m': sessionMetadata['height_m'],
+            'vertical_offset': vertical_offset,
+            'visualizerFormat': visualizerFormat,
+            'scaledModel': (hashFile(pathScaledModel) if not scaleModel and
+                            os.path.exists(pathScaledModel) else None),
+            'code': getCodeVersion([os.path.join(baseDir, 'utilsOpenSim.py'),
+                                    openSimPipelineDir])})
+        cachedOpenSim = stageCache.restore('openSim', openSimKey)
+        if cachedOpenSim is not None:
+            runOpenSimPipeline = False
+        startOpenSim = time.time()
+    
+    if runOpenSimPipeline:
         # Scaling.    
         if scaleModel:
             os.makedirs(outputScaledModelDir, exist_ok=True)
@@ -613,9 +796,27 @@ def main(sessionName, trialName, trial_id, cameras_to_use=['all'],
         os.makedirs(outputJsonVisDir,exist_ok=True)
         outputJsonVisPath = os.path.join(outputJsonVisDir,
                                          trialName + '.json')
-        generateVisualizerJson(pathModelIK, pathOutputIK,
-                               outputJsonVisPath, 
-                               vertical_offset=vertical_offset)  
+        if visualizerFormat == 'binary':
+            # Compact file, quantized to 0.01 mm and 1e-5 (quaternion).
+            outputJsonVisPath = getVisualizerBinaryPath(outputJsonVisPath)
+            generateVisualizerJson(pathModelIK, pathOutputIK,
+                                   outputJsonVisPath, 
+                                   vertical_offset=vertical_offset,
+                                   outputFormat='binary',
+                                   translationStep=1e-5, rotationStep=1e-5,
+                                   delta=True)
+        else:
+            generateVisualizerJson(pathModelIK, pathOutputIK,
+                                   outputJsonVisPath, 
+                                   vertical_offset=vertical_offset)  
+        
+        if stageCache is not None:
+            stageCache.save('openSim', openSimKey, 
+                            files=[os.path.join(openSimDir, '**', '*'), 
+                                   os.path.join(sessionDir, 
+                                                'NeutralPoseImages', '**', '*'),
+                                   os.path.join(outputJsonVisDir, '*')],
+                            since=startOpenSim)
         
     # %% Rewrite settings, adding offset  
     if not extrinsicsTrial:
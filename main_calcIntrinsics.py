@@ -26,6 +26,11 @@ loadTrialInfo = False # Load previous trial names and CheckerBoardParams from fi
 saveIntrinsicsForDeployment = True
 
 deployedFolderNames = ['Deployed_720_60fps','Deployed'] # both folder names if want to keep the detailed folder
+
+# Checkerboard detection.
+nImages = 50 # number of images sampled from each video
+detectionScaleFactor = 1 # < 1 to detect on downscaled images, corners are refined at full resolution
+nWorkers = 1 # number of processes detecting checkerboards, None for all cpus (needs the fork start method, eg Linux)
     
 # %% Paths to data folder for local testing.
 dataDir = os.path.join(getDataDirectory(),'Data')
@@ -61,7 +66,9 @@ if loadTrialInfo:
         
      
 # Compute average intrinsic values from multiple trials of same camera
-CamParamsAverage, CamParamList, intrinsicComparisons, cameraModel = computeAverageIntrinsics(sessionDir,trials,CheckerBoardParams,nImages=50)
+CamParamsAverage, CamParamList, intrinsicComparisons, cameraModel = computeAverageIntrinsics(
+    sessionDir,trials,CheckerBoardParams,nImages=nImages,
+    detectionScaleFactor=detectionScaleFactor,nWorkers=nWorkers)
 
 
 # Save intrinsics from first camera for deployement 
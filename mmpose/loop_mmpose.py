@@ -6,6 +6,7 @@ import json
 import torch
 
 from utilsMMpose import detection_inference, pose_inference
+from utilsPoseServer import PoseServer, MMposeModel
 
 logging.basicConfig(level=logging.INFO)
 
@@ -36,6 +37,15 @@ if os.path.isfile(video_path):
     os.remove(video_path)
 
 checkCudaPyTorch()
+
+# Pose server, with the models loaded once. The file handoff below remains
+# for clients that do not use it; both share the models and the GPU.
+poseServer = PoseServer(MMposeModel(model_config_person, model_ckpt_person,
+                                    model_config_pose, model_ckpt_pose),
+                        host=os.environ.get('POSE_SERVER_HOST', '0.0.0.0'),
+                        port=int(os.environ.get('POSE_SERVER_PORT', 8090))).start()
+logging.info(f"Pose server listening at {poseServer.url}")
+
 while True:    
     if not os.path.isfile(video_path):
         time.sleep(0.1)
@@ -47,6 +57,7 @@ while True:
         shutil.rmtree(output_dir)
     os.makedirs(output_dir)
     
+    poseServer.lock.acquire()
     try:
         checkCudaPyTorch()
         # Run human detection.
@@ -74,3 +85,6 @@ while True:
     except:
         logging.info("Pose detection failed.")
         os.remove(video_path)
+
+    finally:
+        poseServer.lock.release()
@@ -4,7 +4,7 @@ import pickle
 
 
 from mmpose_constants import get_flip_pair_dict
-from mmpose_utils import _xyxy2xywh, _box2cs, frame_iter
+from mmpose_utils import _xyxy2xywh, _box2cs, _crop_box, frame_iter, VideoFrameSource
 from torch.utils.data import Dataset
 
 
@@ -30,6 +30,9 @@ class CustomVideoDataset(Dataset):
         assert self.capture.isOpened(), f'Failed to load video file {video_path}'
         self.frames = np.stack([x for x in frame_iter(self.capture)])
 
+        self._init_instances(bbox_path, bbox_threshold, pipeline, config)
+
+    def _init_instances(self, bbox_path, bbox_threshold, pipeline, config):
         # load bbox
         self.bboxs = pickle.load(open(bbox_path, "rb"))
         self.bbox_threshold = bbox_threshold
@@ -53,18 +56,24 @@ class CustomVideoDataset(Dataset):
     def __len__(self):
         return len(self.instance_to_frame)
 
+    def get_image(self, frame_num, center, scale):
+        """Returns the image the instance is cropped from, and the position
+        (x, y) of that image in the frame"""
+        return self.frames[frame_num], np.zeros(2, dtype=np.float32)
+
     def __getitem__(self, idx):
         frame_num, detection_num = self.instance_to_frame[idx]
         num_joints = self.cfg.data_cfg['num_joints']
         bbox_xyxy = self.bboxs[frame_num][detection_num]['bbox']
         bbox_xywh = _xyxy2xywh(bbox_xyxy)
         center, scale = _box2cs(self.cfg, bbox_xywh)
+        img, offset = self.get_image(frame_num, center, scale)
 
         # joints_3d and joints_3d_visalble are place holders
         # but bbox in image file, image file is not used but we need bbox information later
-        data = {'img': self.frames[frame_num],
+        data = {'img': img,
                 'image_file': bbox_xyxy,
-                'center': center,
+                'center': center - offset,
                 'scale': scale,
                 'bbox_score': bbox_xywh[4] if len(bbox_xywh) == 5 else 1,
                 'bbox_id': 0,
@@ -77,4 +86,44 @@ class CustomVideoDataset(Dataset):
                     'flip_pairs': self.flip_pairs
         }}
         data = self.pipeline(data)
+        if offset.any():
+            # Keypoints are decoded with the center in the metas: back to frame coordinates.
+            data['img_metas'].data['center'] = center
         return data
+
+
+class StreamingVideoDataset(CustomVideoDataset):
+    """Custom video dataset for top down inference, decoding frames on the fly
+
+    Unlike CustomVideoDataset, the video is not loaded in memory: frames are
+    decoded as instances are read, only the last buffer_size frames are kept,
+    and each instance is cropped to the region used by the affine transform
+    before the pipeline. Memory thus depends on the batch size, not on the
+    length of the video. Instances are ordered by frame, such that reading
+    them in order (DataLoader without shuffle) decodes the video once.
+
+    Args:
+        video_path (str): Path to video file
+        bbox_path (str): Path to bounding box file
+                         (expects format to be xyxy [left, top, right, bottom])
+        pipeline (list[dict | callable]): A sequence of data transforms
+        buffer_size (int): Number of decoded frames kept in memory
+    """
+
+    def __init__(self,
+                 video_path,
+                 bbox_path,
+                 bbox_threshold,
+                 pipeline,
+                 config,
+                 buffer_size=8):
+
+        self.frames = VideoFrameSource(video_path, buffer_size=buffer_size)
+        self._init_instances(bbox_path, bbox_threshold, pipeline, config)
+
+    def get_image(self, frame_num, center, scale):
+        frame = self.frames[frame_num]
+        x0, y0, x1, y1 = _crop_box(frame.shape, center, scale)
+        if x1 <= x0 or y1 <= y0: # bbox outside of the frame
+            return frame, np.zeros(2, dtype=np.float32)
+        return frame[y0:y1, x0:x1], np.array([x0, y0], dtype=np.float32)
@@ -1,11 +1,71 @@
 import cv2
 import numpy as np
+from collections import OrderedDict
 
 def frame_iter(capture):
     while capture.grab():
         yield capture.retrieve()[1]
 
 
+class VideoFrameSource:
+    """Decodes the frames of a video lazily, keeping only the last few in memory
+
+    Frames are meant to be read in increasing order: skipped frames are
+    grabbed but not retrieved, and reading a frame older than the buffer
+    re-opens the video. The video is opened on first read, such that the
+    source can be copied to DataLoader workers.
+
+    Args:
+        video_path (str): Path to video file
+        buffer_size (int): Number of decoded frames kept in memory
+    """
+
+    def __init__(self, video_path, buffer_size=8):
+        self.video_path = video_path
+        self.buffer_size = buffer_size
+        self.capture = None
+        self.next_frame = 0
+        self.buffer = OrderedDict()
+
+    def _open(self):
+        self.release()
+        self.capture = cv2.VideoCapture(self.video_path)
+        assert self.capture.isOpened(), f'Failed to load video file {self.video_path}'
+        self.next_frame = 0
+
+    def __getitem__(self, frame_num):
+        if frame_num in self.buffer:
+            return self.buffer[frame_num]
+        if self.capture is None or frame_num < self.next_frame:
+            self._open()
+        while self.next_frame < frame_num:
+            if not self.capture.grab():
+                raise IndexError(f'Frame {frame_num} is beyond the end of {self.video_path}')
+            self.next_frame += 1
+        ret, frame = self.capture.read()
+        if not ret:
+            raise IndexError(f'Frame {frame_num} is beyond the end of {self.video_path}')
+        self.next_frame += 1
+        self.buffer[frame_num] = frame
+        while len(self.buffer) > self.buffer_size:
+            self.buffer.popitem(last=False)
+        return frame
+
+    def release(self):
+        if self.capture is not None:
+            self.capture.release()
+            self.capture = None
+        self.buffer.clear()
+
+    def __getstate__(self):
+        # The capture cannot be copied; it is re-opened on first read.
+        state = self.__dict__.copy()
+        state['capture'] = None
+        state['next_frame'] = 0
+        state['buffer'] = OrderedDict()
+        return state
+
+
 class LoadImage:
     """Simple pipeline step to check channel order"""
 
@@ -68,6 +128,24 @@ def _box2cs(cfg, box):
     return center, scale
 
 
+def _crop_box(image_shape, center, scale, margin=2):
+    """Returns the region of an image sampled by the top down affine transform.
+    Args:
+        image_shape (tuple): Shape of the image (height, width, ...)
+        center (np.ndarray): Center of the bbox (x, y)
+        scale (np.ndarray): Scale of the bbox w & h, as returned by _box2cs
+        margin (int): Pixels added on each side for interpolation
+    Returns:
+        tuple: (x0, y0, x1, y1) of the region, clipped to the image.
+    """
+    half_size = scale * 200.0 * 0.5
+    x0 = max(int(np.floor(center[0] - half_size[0])) - margin, 0)
+    y0 = max(int(np.floor(center[1] - half_size[1])) - margin, 0)
+    x1 = min(int(np.ceil(center[0] + half_size[0])) + margin + 1, image_shape[1])
+    y1 = min(int(np.ceil(center[1] + half_size[1])) + margin + 1, image_shape[0])
+    return x0, y0, max(x1, x0), max(y1, y0)
+
+
 def concat(instances):
     """Concatenate pose result batches
     Args:
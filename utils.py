@@ -3,14 +3,12 @@ import json
 import os
 import socket
 import requests
-import urllib.request
 import shutil
 import utilsDataman
 import pickle
 import glob
 import mimetypes
 import subprocess
-import zipfile
 import time
 
 import numpy as np
@@ -19,6 +17,12 @@ from scipy import signal
 
 from utilsAuth import getToken
 from utilsAPI import getAPIURL
+from utilsKeypointStore import isKeypointStore, getKeypointStorePath
+from utilsKeypointStore import findPoseKeypointsPath, loadPoseKeypoints, savePoseKeypoints
+from utilsStorage import readStorage, readStorageDataFrame, writeStorage
+from utilsTransfer import getHTTPSession, downloadFile, downloadFiles
+from utilsTransfer import uploadFile, runConcurrently
+from utilsZip import writeZip
 
 # Initialize variables to None
 API_URL = None
@@ -119,16 +123,16 @@ def importMetadata(filePath):
     return parsedYamlFile
 
 def download_file(url, file_name):
-    with urllib.request.urlopen(url) as response, open(file_name, 'wb') as out_file:
-        shutil.copyfileobj(response, out_file)
+    # Streamed through the shared session, see utilsTransfer.
+    downloadFile(url, file_name)
         
 def getTrialJson(trial_id):
-    trialJson = requests.get(get_api_url() + "trials/{}/".format(trial_id),
+    trialJson = getHTTPSession().get(get_api_url() + "trials/{}/".format(trial_id),
                          headers = {"Authorization": "Token {}".format(get_api_token())}).json()
     return trialJson
 
 def getSessionJson(session_id):
-    sessionJson = requests.get(get_api_url() + "sessions/{}/".format(session_id),
+    sessionJson = getHTTPSession().get(get_api_url() + "sessions/{}/".format(session_id),
                        headers = {"Authorization": "Token {}".format(get_api_token())}).json()
     
     # sort trials by time recorded
@@ -139,7 +143,7 @@ def getSessionJson(session_id):
     return sessionJson
 
 def getSubjectJson(subject_id):
-    subjectJson = requests.get(get_api_url() + "subjects/{}/".format(subject_id),
+    subjectJson = getHTTPSession().get(get_api_url() + "subjects/{}/".format(subject_id),
                        headers = {"Authorization": "Token {}".format(get_api_token())}).json()
     return subjectJson
     
@@ -155,6 +159,8 @@ def writeMediaToAPI(api_url, media_path,trial_id,tag=None,deleteOldMedia=False):
     if deleteOldMedia:
         deleteResult(trial_id, tag=tag)
     
+    # Files are uploaded concurrently.
+    uploads = []
     for filename in os.listdir(media_path):
         thisMimeType = mimetypes.guess_type(filename)
         if thisMimeType[0] is not None and not os.path.isdir(filename):
@@ -174,7 +180,8 @@ def writeMediaToAPI(api_url, media_path,trial_id,tag=None,deleteOldMedia=False):
                 else:
                     device_id = None
                                
-                postFileToTrial(fullpath,trial_id,tag,device_id)
+                uploads.append((fullpath,trial_id,tag,device_id))
+    runConcurrently(postFileToTrial, uploads)
 
     return
 
@@ -203,7 +210,7 @@ def postCalibrationOptions(session_path,session_id,overwrite=False):
                 "meta":json.dumps({'calibration':calibOptionsJson})
             }
         trial_url = "{}{}{}/".format(get_api_url(), "trials/", calibration_id)
-        r= requests.patch(trial_url, data=data,
+        r= getHTTPSession().patch(trial_url, data=data,
               headers = {"Authorization": "Token {}".format(get_api_token())})
         
         if r.status_code == 200:
@@ -235,13 +242,16 @@ def downloadVideosFromServer(session_id,trial_id, isDocker=True,
     # the order during the first trial processed in the session such that we
     # can use the same order for the other trials.
     if not benchmark:
+        # The videos of all cameras are downloaded concurrently.
+        downloads = []
         if not os.path.exists(os.path.join(session_path, "Videos", 'mappingCamDevice.pickle')):
             mappingCamDevice = {}
             for k, video in enumerate(trial["videos"]):
                 os.makedirs(os.path.join(session_path, "Videos", "Cam{}".format(k), "InputMedia", trial_name), exist_ok=True)
                 video_path = os.path.join(session_path, "Videos", "Cam{}".format(k), "InputMedia", trial_name, trial_id + ".mov")
-                download_file(video["video"], video_path)                
+                downloads.append((video["video"], video_path))
                 mappingCamDevice[video["device_id"].replace('-', '').upper()] = k
+            downloadFiles(downloads)
             with open(os.path.join(session_path, "Videos", 'mappingCamDevice.pickle'), 'wb') as handle:
                 pickle.dump(mappingCamDevice, handle)
         else:
@@ -254,7 +264,8 @@ def downloadVideosFromServer(session_id,trial_id, isDocker=True,
                 video_path = os.path.join(videoDir, trial_id + ".mov")
                 if not os.path.exists(video_path):
                     if video['video'] :
-                        download_file(video["video"], video_path)
+                        downloads.append((video["video"], video_path))
+            downloadFiles(downloads)
     
         # Import and save metadata
         sessionYamlPath = os.path.join(session_path, "sessionMetadata.yaml")
@@ -483,7 +494,7 @@ def deleteResult(trial_id, tag=None,resultNum=None):
         resultNums = [r['id'] for r in trial['results']]
 
     for rNum in resultNums:
-        requests.delete(get_api_url() + "results/{}/".format(rNum),
+        getHTTPSession().delete(get_api_url() + "results/{}/".format(rNum),
                         headers = {"Authorization": "Token {}".format(get_api_token())})
         
 def deleteAllResults(session_id):
@@ -608,29 +619,34 @@ def downloadAndSwitchCalibrationFromDjango(session_id,session_path,calibTrialID
         print('No metadata for camera switching. Using first solution.')
         calibDict = {'Cam'+str(i):0 for i in range(len(trial['videos']))}
         
+    downloads = []
     for cam,calibNum in calibDict.items():
         camDir = os.path.join(session_path,'Videos',cam)
         os.makedirs(camDir,exist_ok=True)
         file_name = os.path.join(camDir,'cameraIntrinsicsExtrinsics.pickle')
         if calibNum == 0:
-            download_file(calibURLs[cam+'_soln0'], file_name)
+            downloads.append((calibURLs[cam+'_soln0'], file_name))
             print('Downloading calibration for ' + cam)
         elif calibNum == 1:
-            download_file(calibURLs[cam+'_soln1'], file_name)                  
+            downloads.append((calibURLs[cam+'_soln1'], file_name))
             print('Downloading alternate calibration camera for ' + cam)
+    downloadFiles(downloads)
     
     # If static trial and we are automatically selecting a calibration
     if getCalibrationOptions:
-        tempPath = os.path.join(session_path,'tempCalib.pickle')
+        downloads = []
+        for cam in calibDict.keys():
+            for soln in ['_soln0', '_soln1']:
+                tempPath = os.path.join(session_path,'tempCalib_' + cam + soln + '.pickle')
+                downloads.append((calibURLs[cam+soln], tempPath))
+        downloadFiles(downloads)
         calibrationOptions = {}
         for cam in calibDict.keys():
             calibrationOptions[cam] = []
-            download_file(calibURLs[cam+'_soln0'], tempPath)
-            calibrationOptions[cam].append(loadCameraParameters(tempPath))
-            os.remove(tempPath)
-            download_file(calibURLs[cam+'_soln1'], tempPath)
-            calibrationOptions[cam].append(loadCameraParameters(tempPath))
-            os.remove(tempPath)            
+            for soln in ['_soln0', '_soln1']:
+                tempPath = os.path.join(session_path,'tempCalib_' + cam + soln + '.pickle')
+                calibrationOptions[cam].append(loadCameraParameters(tempPath))
+                os.remove(tempPath)            
     
         return calibrationOptions
     else:
@@ -712,7 +728,7 @@ def changeSessionMetadata(session_ids,newMetaDict):
         
         data = {"meta":json.dumps(existingMeta)}
         
-        r= requests.patch(session_url, data=data,
+        r= getHTTPSession().patch(session_url, data=data,
               headers = {"Authorization": "Token {}".format(get_api_token())})
         
         if r.status_code !=200:
@@ -761,7 +777,7 @@ def makeSessionPublic(session_id,publicStatus=True):
             "public":publicStatus
         }
         
-    r= requests.patch(session_url, data=data,
+    r= getHTTPSession().patch(session_url, data=data,
           headers = {"Authorization": "Token {}".format(get_api_token())})
     
     if r.status_code == 200:
@@ -799,9 +815,18 @@ def postMotionData(trial_id,session_path,trial_name=None,isNeutral=False,
     camDirs = glob.glob(os.path.join(session_path,'Videos','Cam*'))
     for camDir in camDirs:
         outputPklFolder = os.path.join(camDir,pklDir)
-        pickle_files = glob.glob(os.path.join(outputPklFolder,'*_pp.pkl'))
-        if pickle_files:
-            pklPath = pickle_files[0]
+        # The server expects legacy pose pickles under this tag. Write one
+        # from the keypoint store if only the store exists or is newer.
+        keypointFiles = (glob.glob(os.path.join(outputPklFolder,'*_pp.npz')) + 
+                         glob.glob(os.path.join(outputPklFolder,'*_pp.pkl')))
+        if keypointFiles:
+            pklPath = os.path.splitext(keypointFiles[0])[0] + '.pkl'
+            storePath = findPoseKeypointsPath(pklPath)
+            if storePath != pklPath:
+                savePoseKeypoints(pklPath, keypoints=loadPoseKeypoints(storePath))
+                # Same content: keep the store as the one loaded locally.
+                storeStat = os.stat(storePath)
+                os.utime(pklPath, ns=(storeStat.st_atime_ns, storeStat.st_mtime_ns))
             _,camName = os.path.split(camDir)
             postFileToTrial(pklPath,trial_id,tag='pose_pickle',device_id=camName)
         
@@ -886,12 +911,10 @@ def postFileToTrial(filePath,trial_id,tag,device_id):
         
     # get S3 link
     data = {'fileName':os.path.split(filePath)[1]}
-    r = requests.get(get_api_url() + "sessions/null/get_presigned_url/",data=data).json()
+    r = getHTTPSession().get(get_api_url() + "sessions/null/get_presigned_url/",data=data).json()
     
-    # upload to S3
-    files = {'file': open(filePath, 'rb')}
-    requests.post(r['url'], data=r['fields'],files=files)   
-    files["file"].close()
+    # upload to S3, raises if it still fails after the retries
+    uploadFile(r['url'], r['fields'], filePath)
 
     # post link to and data to results   
     data = {
@@ -901,7 +924,7 @@ def postFileToTrial(filePath,trial_id,tag,device_id):
         "media_url" : r['fields']['key']
     }
     
-    rResult = requests.post(get_api_url() + "results/", data=data,
+    rResult = getHTTPSession().post(get_api_url() + "results/", data=data,
                   headers = {"Authorization": "Token {}".format(get_api_token())})
     
     if rResult.status_code != 201:
@@ -915,6 +938,7 @@ def getSyncdVideos(trial_id,session_path):
     trial = getTrialJson(trial_id)
     trial_name = trial['name']
     
+    downloads = []
     if trial['results']:
         for result in trial['results']:
             if result['tag'] == 'video-sync':
@@ -925,7 +949,8 @@ def getSyncdVideos(trial_id,session_path):
                     suff = suff[:lastIdx]
                 
                 syncVideoPath = os.path.join(session_path,'Videos',cam,'InputMedia',trial_name,trial_name + '_sync' + suff)
-                download_file(url,syncVideoPath)
+                downloads.append((url,syncVideoPath))
+    downloadFiles(downloads)
 
 def getPosePickles(trial_id,session_path, poseDetector='OpenPose', 
                    resolutionPoseDetection='default', bbox_thr=0.8):
@@ -941,6 +966,7 @@ def getPosePickles(trial_id,session_path, poseDetector='OpenPose',
     
     trialPrefix = trial_id + "_rotated_pp.pkl"
     
+    downloads = []
     if trial['results']:
         for result in trial['results']:
             if result['tag'] == 'pose_pickle':
@@ -949,7 +975,14 @@ def getPosePickles(trial_id,session_path, poseDetector='OpenPose',
                 posePickleDir = os.path.join(session_path,'Videos',cam,pklDir)
                 os.makedirs(posePickleDir,exist_ok=True)
                 posePicklePath = os.path.join(posePickleDir,trialPrefix)
-                download_file(url,posePicklePath)
+                downloads.append((url,posePicklePath))
+    downloadFiles(downloads)
+    for _, posePicklePath in downloads:
+        # Results may be keypoint stores or legacy pickles, give
+        # stores their extension.
+        if isKeypointStore(posePicklePath):
+            os.replace(posePicklePath,
+                       getKeypointStorePath(posePicklePath))
 
 def checkAndGetPosePickles(trial_id, session_path, poseDetector, resolutionPoseDetection, bbox_thr):
     # Check if the pose pickles for that set of settings exist.
@@ -996,10 +1029,10 @@ def getMainSettings(trial_id):
                 url = result['media']
                 # Load yaml file
                 try:
-                    with urllib.request.urlopen(url) as response:
-                        yaml_content = response.read()
-                        data = yaml.safe_load(yaml_content)
-                        return data
+                    response = getHTTPSession().get(url)
+                    response.raise_for_status()
+                    data = yaml.safe_load(response.content)
+                    return data
                 except Exception as e:
                     print("An error occurred:", e)
                     return {}  # Return an empty dictionary in case of an error
@@ -1045,23 +1078,14 @@ def downloadAndZipSession(session_id,deleteFolderWhenZipped=True,isDocker=True,
 
    
     if not justDownload:
-        # Zip   
-        def zipdir(path, ziph):
-            # ziph is zipfile handle
-            for root, dirs, files in os.walk(path):
-                for file in files:
-                    ziph.write(os.path.join(root, file), 
-                               os.path.relpath(os.path.join(root, file), 
-                                               os.path.join(path, '..')))
-        
+        # Zip. Videos are stored without recompression.
         session_zip = '{}.zip'.format(session_path)
     
         if os.path.isfile(session_zip):
             os.remove(session_zip)
       
-        zipf = zipfile.ZipFile(session_zip, 'w', zipfile.ZIP_DEFLATED)
-        zipdir(session_path, zipf)
-        zipf.close()
+        writeZip(session_path, session_zip,
+                 arcRoot=os.path.basename(session_path))
         
         # write zip as a result to last trial for now
         if writeToDjango:
@@ -1114,35 +1138,15 @@ def numpy2TRC(f, data, headers, fc=50.0, t_start=0.0, units="m"):
     # Line 6.
     f.write('\n')
 
-    for frame in range(data.shape[0]):
-        f.write("{}\t{:.8f}\t".format(frame+1,(frame)/fc+t_start)) # opensim frame labeling is 1 indexed
-
-        for key in sorted(header_mapping.keys()):
-            f.write("{:.5f}\t{:.5f}\t{:.5f}\t".format(data[frame,0+(key-1)*3], data[frame,1+(key-1)*3], data[frame,2+(key-1)*3]))
-        f.write("\n")
+    # opensim frame labeling is 1 indexed
+    time = np.arange(num_frames)/fc+t_start
+    utilsDataman.writeTRCData(
+        f, time, data[:,:3*num_markers].reshape(num_frames, num_markers, 3),
+        timeFormat='%.8f', dataFormat='%.5f', trailingTab=True)
         
-def numpy2storage(labels, data, storage_file):
-    
-    assert data.shape[1] == len(labels), "# labels doesn't match columns"
-    assert labels[0] == "time"
-    
-    f = open(storage_file, 'w')
-    f.write('name %s\n' %storage_file)
-    f.write('datacolumns %d\n' %data.shape[1])
-    f.write('datarows %d\n' %data.shape[0])
-    f.write('range %f %f\n' %(np.min(data[:, 0]), np.max(data[:, 0])))
-    f.write('endheader \n')
+def numpy2storage(labels, data, storage_file, writeSidecar=False):
     
-    for i in range(len(labels)):
-        f.write('%s\t' %labels[i])
-    f.write('\n')
-    
-    for i in range(data.shape[0]):
-        for j in range(data.shape[1]):
-            f.write('%20.8f\t' %data[i, j])
-        f.write('\n')
-        
-    f.close() 
+    writeStorage(storage_file, labels, data, writeSidecar=writeSidecar)
       
     
 def lowpassFilter(inputData, filtFreq, order=4):
@@ -1168,8 +1172,9 @@ def TRC2numpy(pathFile, markers,rotation=None):
     if rotation != None:
         for axis,angle in rotation.items():
             trc_file.rotate(axis,angle)
-    for count, marker in enumerate(markers):
-        data[:,3*count:3*count+3] = trc_file.marker(marker)    
+    if markers:
+        idxMarkers = [trc_file.marker_names.index(marker) for marker in markers]
+        data[:,:] = trc_file.marker_data[:,idxMarkers].reshape(num_frames, -1)
     this_dat = np.empty((num_frames, 1))
     this_dat[:, 0] = time
     data_out = np.concatenate((this_dat, data), axis=1)
@@ -1237,7 +1242,8 @@ def rewriteVideos(inputPath,startFrame,nFrames,frameRate,outputDir=None,
     return
 
 # %%  Found here: https://github.com/chrisdembia/perimysium/ => thanks Chris
-def storage2numpy(storage_file, excess_header_entries=0):
+def storage2numpy(storage_file, excess_header_entries=0, useSidecar=True,
+                  writeSidecar=False):
     """Returns the data from a storage file in a numpy format. Skips all lines
     up to and including the line that says 'endheader'.
     Parameters
@@ -1253,49 +1259,33 @@ def storage2numpy(storage_file, excess_header_entries=0):
         We'll ignore this many header row entries from the end of the header
         row. This argument allows for a hacky fix to an issue that arises from
         Static Optimization '.sto' outputs.
+    useSidecar : bool, optional
+        Load the binary sidecar (<storage_file>.npz) instead of the text file
+        if it is up to date.
+    writeSidecar : bool, optional
+        Write the binary sidecar after parsing the text file.
     Examples
     --------
     Columns from the storage file can be obtained as follows:
         >>> data = storage2numpy('<filename>')
         >>> data['ground_force_vy']
     """
-    # What's the line number of the line containing 'endheader'?
-    f = open(storage_file, 'r')
-
-    header_line = False
-    for i, line in enumerate(f):
-        if header_line:
-            column_names = line.split()
-            break
-        if line.count('endheader') != 0:
-            line_number_of_line_containing_endheader = i + 1
-            header_line = True
-    f.close()
-
-    # With this information, go get the data.
-    if excess_header_entries == 0:
-        names = True
-        skip_header = line_number_of_line_containing_endheader
-    else:
-        names = column_names[:-excess_header_entries]
-        skip_header = line_number_of_line_containing_endheader + 1
-    data = np.genfromtxt(storage_file, names=names,
-            skip_header=skip_header)
+    data = readStorage(storage_file,
+                       excess_header_entries=excess_header_entries,
+                       useSidecar=useSidecar, writeSidecar=writeSidecar)
 
     return data
 
-def storage2df(storage_file, headers):
+def storage2df(storage_file, headers, useSidecar=True, writeSidecar=False):
     # Extract data
-    data = storage2numpy(storage_file)
-    out = pd.DataFrame(data=data['time'], columns=['time'])    
-    for count, header in enumerate(headers):
-        out.insert(count + 1, header, data[header])    
+    out = readStorageDataFrame(storage_file, headers, useSidecar=useSidecar,
+                               writeSidecar=writeSidecar)
     
     return out
 	
-def getIK(storage_file, joints, degrees=False):
+def getIK(storage_file, joints, degrees=False, writeSidecar=False):
     # Extract data
-    data = storage2numpy(storage_file)
+    data = storage2numpy(storage_file, writeSidecar=writeSidecar)
     Qs = pd.DataFrame(data=data['time'], columns=['time'])    
     for count, joint in enumerate(joints):  
         if ((joint == 'pelvis_tx') or (joint == 'pelvis_ty') or 
@@ -1509,7 +1499,7 @@ def checkForTrialsWithStatus(status,hours=9999999,relativeTime='newer'):
               'justNumber':1,
               'relativeTime':relativeTime}
     
-    r = requests.get(get_api_url()+"trials/get_trials_with_status/",params=params,
+    r = getHTTPSession().get(get_api_url()+"trials/get_trials_with_status/",params=params,
         headers = {"Authorization": "Token {}".format(get_api_token())}).json()
     
     return r['nTrials']
@@ -1590,7 +1580,7 @@ def checkCudaTF():
 # %% Some functions for loading subject data
 
 def getSubjectNumber(subjectName):
-    subjects = requests.get(get_api_url() + "subjects/",
+    subjects = getHTTPSession().get(get_api_url() + "subjects/",
                            headers = {"Authorization": "Token {}".format(get_api_token())}).json()
     sNum = [s['id'] for s in subjects if s['name'] == subjectName]
     if len(sNum)>1:
@@ -1601,7 +1591,7 @@ def getSubjectNumber(subjectName):
     return sNum[0]
 
 def getUserSessions():
-    sessionJson = requests.get(get_api_url() + "sessions/valid/",
+    sessionJson = getHTTPSession().get(get_api_url() + "sessions/valid/",
                            headers = {"Authorization": "Token {}".format(get_api_token())}).json()
     return sessionJson
 
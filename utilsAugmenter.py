@@ -1,168 +1,241 @@
 import os
+import threading
 import numpy as np
 import utilsDataman
-import copy
 import tensorflow as tf
-from utils import TRC2numpy
 import json
 
-def augmentTRC(pathInputTRCFile, subject_mass, subject_height,
-               pathOutputTRCFile, augmenterDir, augmenterModelName="LSTM",
-               augmenter_model='v0.3', offset=True):
-    
-    # This is by default - might need to be adjusted in the future.
-    featureHeight = True
-    featureWeight = True
-    
-    # Augmenter types
+# Process-wide caches of the augmenter models and of the augmenter services,
+# such that the models are loaded and their graphs built only once per process
+# (eg, across the trials processed by the app.py worker).
+_augmenterModels = {}
+_markerAugmenters = {}
+_cacheLock = threading.Lock()
+
+# %%
+def getAugmenterMarkers(augmenter_model):
+    # Returns the augmenter model types (eg, lower and upper body) and their
+    # feature and response markers.
     if augmenter_model == 'v0.0':
         from utils import getOpenPoseMarkers_fullBody
-        feature_markers_full, response_markers_full = getOpenPoseMarkers_fullBody()         
+        feature_markers_full, response_markers_full = getOpenPoseMarkers_fullBody()
         augmenterModelType_all = [augmenter_model]
         feature_markers_all = [feature_markers_full]
-        response_markers_all = [response_markers_full]            
+        response_markers_all = [response_markers_full]
     elif augmenter_model == 'v0.1' or augmenter_model == 'v0.2':
-        # Lower body           
+        # Lower body
         augmenterModelType_lower = '{}_lower'.format(augmenter_model)
         from utils import getOpenPoseMarkers_lowerExtremity
         feature_markers_lower, response_markers_lower = getOpenPoseMarkers_lowerExtremity()
         # Upper body
         augmenterModelType_upper = '{}_upper'.format(augmenter_model)
         from utils import getMarkers_upperExtremity_noPelvis
-        feature_markers_upper, response_markers_upper = getMarkers_upperExtremity_noPelvis()        
+        feature_markers_upper, response_markers_upper = getMarkers_upperExtremity_noPelvis()
         augmenterModelType_all = [augmenterModelType_lower, augmenterModelType_upper]
         feature_markers_all = [feature_markers_lower, feature_markers_upper]
         response_markers_all = [response_markers_lower, response_markers_upper]
     else:
-        # Lower body           
+        # Lower body
         augmenterModelType_lower = '{}_lower'.format(augmenter_model)
         from utils import getOpenPoseMarkers_lowerExtremity2
         feature_markers_lower, response_markers_lower = getOpenPoseMarkers_lowerExtremity2()
         # Upper body
         augmenterModelType_upper = '{}_upper'.format(augmenter_model)
         from utils import getMarkers_upperExtremity_noPelvis2
-        feature_markers_upper, response_markers_upper = getMarkers_upperExtremity_noPelvis2()        
+        feature_markers_upper, response_markers_upper = getMarkers_upperExtremity_noPelvis2()
         augmenterModelType_all = [augmenterModelType_lower, augmenterModelType_upper]
         feature_markers_all = [feature_markers_lower, feature_markers_upper]
         response_markers_all = [response_markers_lower, response_markers_upper]
-    # print('Using augmenter model: {}'.format(augmenter_model))
-    
-    # %% Process data.
-    # Import TRC file
-    trc_file = utilsDataman.TRCFile(pathInputTRCFile)
-    
-    # Loop over augmenter types to handle separate augmenters for lower and
-    # upper bodies.
-    outputs_all = {}
-    n_response_markers_all = 0
-    for idx_augm, augmenterModelType in enumerate(augmenterModelType_all):
-        outputs_all[idx_augm] = {}
-        feature_markers = feature_markers_all[idx_augm]
-        response_markers = response_markers_all[idx_augm]
-        
-        augmenterModelDir = os.path.join(augmenterDir, augmenterModelName, 
-                                         augmenterModelType)
-        
-        # %% Pre-process inputs.
-        # Step 1: import .trc file with OpenPose marker trajectories.
-        print(pathInputTRCFile)
-        trc_data = TRC2numpy(pathInputTRCFile, feature_markers)
-        trc_data_data = trc_data[:,1:]
-        
-        # Step 2: Normalize with reference marker position.
+
+    return augmenterModelType_all, feature_markers_all, response_markers_all
+
+# %%
+def loadAugmenterModel(augmenterModelDir):
+    # Loads the model, weights, normalization statistics, and metadata of an
+    # augmenter model once per process.
+    augmenterModelDir = os.path.abspath(augmenterModelDir)
+    with _cacheLock:
+        if augmenterModelDir in _augmenterModels:
+            return _augmenterModels[augmenterModelDir]
+
         with open(os.path.join(augmenterModelDir, "metadata.json"), 'r') as f:
             metadata = json.load(f)
-        referenceMarker = metadata['reference_marker']
-        referenceMarker_data = trc_file.marker(referenceMarker)
-        norm_trc_data_data = np.zeros((trc_data_data.shape[0],
-                                       trc_data_data.shape[1]))
-        for i in range(0,trc_data_data.shape[1],3):
-            norm_trc_data_data[:,i:i+3] = (trc_data_data[:,i:i+3] - 
-                                           referenceMarker_data)
-            
-        # Step 3: Normalize with subject's height.
-        norm2_trc_data_data = copy.deepcopy(norm_trc_data_data)
-        print(f"Subject height: {subject_height} {type(subject_height)}")
-        print(f"trc_data: {norm2_trc_data_data.shape}{type(norm2_trc_data_data)}")
-        norm2_trc_data_data = norm2_trc_data_data / subject_height
-        
-        # Step 4: Add remaining features.
-        inputs = copy.deepcopy(norm2_trc_data_data)
-        if featureHeight:    
-            inputs = np.concatenate(
-                (inputs, subject_height*np.ones((inputs.shape[0],1))), axis=1)
-        if featureWeight:    
-            inputs = np.concatenate(
-                (inputs, subject_mass*np.ones((inputs.shape[0],1))), axis=1)
-            
-        # Step 5: Pre-process data
         pathMean = os.path.join(augmenterModelDir, "mean.npy")
         pathSTD = os.path.join(augmenterModelDir, "std.npy")
+        trainFeatures_mean, trainFeatures_std = None, None
         if os.path.isfile(pathMean):
             trainFeatures_mean = np.load(pathMean, allow_pickle=True)
-            inputs -= trainFeatures_mean
         if os.path.isfile(pathSTD):
             trainFeatures_std = np.load(pathSTD, allow_pickle=True)
-            inputs /= trainFeatures_std 
-            
-        # Step 6: Reshape inputs if necessary (eg, LSTM)
-        if augmenterModelName == "LSTM":
-            inputs = np.reshape(inputs, (1, inputs.shape[0], inputs.shape[1]))
-            
-        # %% Load model and weights, and predict outputs.
-        json_file = open(os.path.join(augmenterModelDir, "model.json"), 'r')
-        pretrainedModel_json = json_file.read()
-        json_file.close()
+
+        with open(os.path.join(augmenterModelDir, "model.json"), 'r') as f:
+            pretrainedModel_json = f.read()
         model = tf.keras.models.model_from_json(pretrainedModel_json)
-        model.load_weights(os.path.join(augmenterModelDir, "weights.h5"))  
-        outputs = model.predict(inputs, verbose=2)
-        
-        # %% Post-process outputs.
-        # Step 1: Reshape if necessary (eg, LSTM)
-        if augmenterModelName == "LSTM":
-            outputs = np.reshape(outputs, (outputs.shape[1], outputs.shape[2]))
-            
-        # Step 2: Un-normalize with subject's height.
-        unnorm_outputs = outputs * subject_height
-        
-        # Step 2: Un-normalize with reference marker position.
-        unnorm2_outputs = np.zeros((unnorm_outputs.shape[0],
-                                    unnorm_outputs.shape[1]))
-        for i in range(0,unnorm_outputs.shape[1],3):
-            unnorm2_outputs[:,i:i+3] = (unnorm_outputs[:,i:i+3] + 
-                                        referenceMarker_data)
-            
-        # %% Add markers to .trc file.
-        for c, marker in enumerate(response_markers):
-            x = unnorm2_outputs[:,c*3]
-            y = unnorm2_outputs[:,c*3+1]
-            z = unnorm2_outputs[:,c*3+2]
-            trc_file.add_marker(marker, x, y, z)
-            
-        # %% Gather data for computing minimum y-position.
-        outputs_all[idx_augm]['response_markers'] = response_markers   
-        outputs_all[idx_augm]['response_data'] = unnorm2_outputs
-        n_response_markers_all += len(response_markers)
-        
-    # %% Extract minimum y-position across response markers. This is used
-    # to align feet and floor when visualizing.
-    responses_all_conc = np.zeros((unnorm2_outputs.shape[0],
-                                   n_response_markers_all*3))
-    idx_acc_res = 0
-    for idx_augm in outputs_all:
-        idx_acc_res_end = (idx_acc_res + 
-                           (len(outputs_all[idx_augm]['response_markers']))*3)
-        responses_all_conc[:,idx_acc_res:idx_acc_res_end] = (
-            outputs_all[idx_augm]['response_data'])
-        idx_acc_res = idx_acc_res_end
-    # Minimum y-position across response markers.
-    min_y_pos = np.min(responses_all_conc[:,1::3])
-        
-    # %% If offset
-    if offset:
-        trc_file.offset('y', -(min_y_pos-0.01))
-        
-    # %% Return augmented .trc file   
-    trc_file.write(pathOutputTRCFile)
-    
+        model.load_weights(os.path.join(augmenterModelDir, "weights.h5"))
+
+        augmenterModel = {'model': model,
+                          'referenceMarker': metadata['reference_marker'],
+                          'mean': trainFeatures_mean,
+                          'std': trainFeatures_std}
+        _augmenterModels[augmenterModelDir] = augmenterModel
+
+    return augmenterModel
+
+# %%
+def clearAugmenterCache():
+    with _cacheLock:
+        _augmenterModels.clear()
+        _markerAugmenters.clear()
+    tf.keras.backend.clear_session()
+
+# %%
+class MarkerAugmenter(object):
+    """Predicts anatomical markers from video keypoints.
+
+    Models are loaded lazily through the process-wide model cache. augment()
+    accepts several trials, whose features are stacked in a single batch
+    padded to the longest trial. The augmenter LSTMs are unidirectional, so
+    padding at the end of a sequence does not change the outputs of the
+    preceding time steps.
+
+    """
+    def __init__(self, augmenterDir, augmenterModelName="LSTM",
+                 augmenter_model='v0.3'):
+        self.augmenterDir = augmenterDir
+        self.augmenterModelName = augmenterModelName
+        self.augmenter_model = augmenter_model
+        (self.augmenterModelType_all, self.feature_markers_all,
+         self.response_markers_all) = getAugmenterMarkers(augmenter_model)
+        # This is by default - might need to be adjusted in the future.
+        self.featureHeight = True
+        self.featureWeight = True
+
+    def getModel(self, idx_augm):
+        augmenterModelDir = os.path.join(
+            self.augmenterDir, self.augmenterModelName,
+            self.augmenterModelType_all[idx_augm])
+        return loadAugmenterModel(augmenterModelDir)
+
+    def getFeatures(self, trc_file, subject_mass, subject_height, idx_augm):
+        # Returns the normalized (nFrames x nFeatures) inputs and the
+        # (nFrames x 3) reference marker trajectory.
+        augmenterModel = self.getModel(idx_augm)
+        feature_markers = self.feature_markers_all[idx_augm]
+        # Step 1: (nFrames x nMarkers x 3) feature marker trajectories.
+        trc_data = np.stack([trc_file.marker(marker)
+                             for marker in feature_markers], axis=1)
+        # Step 2: Normalize with reference marker position.
+        referenceMarker_data = trc_file.marker(
+            augmenterModel['referenceMarker'])
+        norm_trc_data = trc_data - referenceMarker_data[:, np.newaxis, :]
+        # Step 3: Normalize with subject's height.
+        inputs = norm_trc_data.reshape(trc_data.shape[0], -1) / subject_height
+        # Step 4: Add remaining features.
+        extraFeatures = []
+        if self.featureHeight:
+            extraFeatures.append(subject_height)
+        if self.featureWeight:
+            extraFeatures.append(subject_mass)
+        if extraFeatures:
+            inputs = np.concatenate(
+                (inputs, np.broadcast_to(extraFeatures,
+                                         (inputs.shape[0], len(extraFeatures)))),
+                axis=1)
+        # Step 5: Pre-process data.
+        if augmenterModel['mean'] is not None:
+            inputs = inputs - augmenterModel['mean']
+        if augmenterModel['std'] is not None:
+            inputs = inputs / augmenterModel['std']
+
+        return inputs, referenceMarker_data
+
+    def predict(self, inputs_all, idx_augm):
+        # Runs inference for a list of (nFrames x nFeatures) inputs in a
+        # single batch, and returns a list of (nFrames x nResponses) outputs.
+        model = self.getModel(idx_augm)['model']
+        nFrames_all = [inputs.shape[0] for inputs in inputs_all]
+        if self.augmenterModelName == "LSTM":
+            batch = np.zeros((len(inputs_all), max(nFrames_all),
+                              inputs_all[0].shape[1]))
+            for c, inputs in enumerate(inputs_all):
+                batch[c, :inputs.shape[0]] = inputs
+            outputs = model.predict(batch, verbose=2)
+            return [outputs[c, :nFrames]
+                    for c, nFrames in enumerate(nFrames_all)]
+        else:
+            outputs = model.predict(np.concatenate(inputs_all, axis=0),
+                                    verbose=2)
+            return np.split(outputs, np.cumsum(nFrames_all)[:-1], axis=0)
+
+    def augment(self, trc_files, subject_masses, subject_heights):
+        # Adds the response markers to each TRCFile in trc_files, and returns
+        # the minimum y-position across response markers for each trial.
+        nTrials = len(trc_files)
+        min_y_pos_all = np.full(nTrials, np.inf)
+        for idx_augm in range(len(self.augmenterModelType_all)):
+            response_markers = self.response_markers_all[idx_augm]
+            inputs_all, referenceMarker_data_all = [], []
+            for c in range(nTrials):
+                inputs, referenceMarker_data = self.getFeatures(
+                    trc_files[c], subject_masses[c], subject_heights[c],
+                    idx_augm)
+                inputs_all.append(inputs)
+                referenceMarker_data_all.append(referenceMarker_data)
+            outputs_all = self.predict(inputs_all, idx_augm)
+
+            for c in range(nTrials):
+                # Un-normalize with subject's height and reference marker
+                # position.
+                outputs = outputs_all[c].reshape(
+                    outputs_all[c].shape[0], -1, 3)
+                unnorm_outputs = (outputs * subject_heights[c] +
+                                  referenceMarker_data_all[c][:, np.newaxis, :])
+                # Add markers to .trc file.
+                trc_files[c].add_markers(response_markers, unnorm_outputs)
+                # Minimum y-position across response markers. This is used
+                # to align feet and floor when visualizing.
+                min_y_pos_all[c] = min(min_y_pos_all[c],
+                                       np.min(unnorm_outputs[:, :, 1]))
+
+        return min_y_pos_all
+
+    def augmentTRCFiles(self, pathInputTRCFiles, subject_masses,
+                        subject_heights, pathOutputTRCFiles, offset=True):
+        trc_files = [utilsDataman.TRCFile(pathInputTRCFile)
+                     for pathInputTRCFile in pathInputTRCFiles]
+        min_y_pos_all = self.augment(trc_files, subject_masses,
+                                     subject_heights)
+        for trc_file, min_y_pos, pathOutputTRCFile in zip(
+                trc_files, min_y_pos_all, pathOutputTRCFiles):
+            if offset:
+                trc_file.offset('y', -(min_y_pos-0.01))
+            trc_file.write(pathOutputTRCFile)
+
+        return min_y_pos_all
+
+# %%
+def getMarkerAugmenter(augmenterDir, augmenterModelName="LSTM",
+                       augmenter_model='v0.3'):
+    # Returns the process-wide augmenter service for this model.
+    key = (os.path.abspath(augmenterDir), augmenterModelName, augmenter_model)
+    with _cacheLock:
+        if key not in _markerAugmenters:
+            _markerAugmenters[key] = MarkerAugmenter(
+                augmenterDir, augmenterModelName=augmenterModelName,
+                augmenter_model=augmenter_model)
+
+    return _markerAugmenters[key]
+
+# %%
+def augmentTRC(pathInputTRCFile, subject_mass, subject_height,
+               pathOutputTRCFile, augmenterDir, augmenterModelName="LSTM",
+               augmenter_model='v0.3', offset=True):
+
+    markerAugmenter = getMarkerAugmenter(
+        augmenterDir, augmenterModelName=augmenterModelName,
+        augmenter_model=augmenter_model)
+    min_y_pos = markerAugmenter.augmentTRCFiles(
+        [pathInputTRCFile], [subject_mass], [subject_height],
+        [pathOutputTRCFile], offset=offset)[0]
+
     return min_y_pos
@@ -0,0 +1,57 @@
+"""
+Matching of person bounding boxes between frames.
+
+Only depends on numpy, such that it is shared by utilsChecker and the mmpose
+image (utilsMMpose), which copies this file but not the rest of the repo.
+"""
+
+import numpy as np
+
+# Proportion of mean image dimensions that corners must change to be
+# considered different person.
+CORNER_CHANGE_THRESHOLD = 0.2
+
+# %%
+def boxCorners(bbox):
+    # bbox: [x, y, width, height] -> [x1, y1, x2, y2].
+    return np.array([bbox[0], bbox[1], bbox[0] + bbox[2], bbox[1] + bbox[3]])
+
+# %%
+def findClosestCorners(bboxCorners, keyBoxCorners, imageSize, iPerson=None):
+    # bboxCorners: corners [x1, y1, x2, y2, (score)] of the bbox selected from
+    # the previous frame.
+    # keyBoxCorners: corners of the bboxes detected in the current frame.
+    # imageSize: size of the image
+    # iPerson: index of the person to track, the closest bbox if None.
+    # Returns the index of the bbox (None if there is none) and whether it
+    # is the same person.
+    bboxCorners = np.asarray(bboxCorners)[:4]
+    boxErrors = [np.linalg.norm(np.asarray(keyBox)[:4] - bboxCorners)
+                 for keyBox in keyBoxCorners]
+    try:
+        if iPerson is None:
+            iPerson = np.nanargmin(boxErrors)
+        boxError = boxErrors[iPerson]
+    except (ValueError, IndexError):
+        return None, False
+
+    # If large jump in bounding box, break.
+    samePerson = True
+    if (boxError > CORNER_CHANGE_THRESHOLD*np.mean(imageSize)):
+        samePerson = False
+
+    return iPerson, samePerson
+
+# %%
+def findClosestBox(bbox,keyBoxes,imageSize,iPerson=None):
+    # bbox: the bbox selected from the previous frame, [x, y, width, height].
+    # keyBoxes: bboxes detected in the current frame.
+    # imageSize: size of the image
+    # iPerson: index of the person to track..
+    iPerson, samePerson = findClosestCorners(
+        boxCorners(bbox), [boxCorners(keyBox) for keyBox in keyBoxes],
+        imageSize, iPerson=iPerson)
+    if iPerson is None:
+        return None, None, False
+
+    return iPerson,keyBoxes[iPerson],samePerson
@@ -880,6 +880,72 @@ def nview_linear_triangulations(cameras, image_points,weights=None):
     return world,confidence
 
 
+def nview_linear_triangulations_batch(cameras, image_points, weights=None,
+                                      chunk_size=100000):
+    """
+    Computes world coordinates from image correspondences in n views, for
+    all points at once. Numerically equivalent to nview_linear_triangulations,
+    but builds the weighted D matrices of all points together and solves them
+    with a single batched SVD instead of one SVD per point.
+    :param cameras: pinhole models of cameras corresponding to views
+    :type cameras: sequence of Camera objects
+    :param image_points: image coordinates of m correspondences in n views
+    :type image_points: numpy.ndarray, shape=(n, m, 2)
+    :param weights: per-view confidences, nan confidences are treated as 0.5
+    :type weights: numpy.ndarray, shape=(n, m), optional
+    :param chunk_size: maximum number of points solved per batched SVD
+    :type chunk_size: int
+    :return: m world coordinates and their confidences
+    :rtype: numpy.ndarray, shape=(3, m), numpy.ndarray, shape=(1, m)
+    """
+    assert(type(cameras) == list)
+    image_points = np.asarray(image_points, dtype=float)
+    assert(image_points.ndim == 3)
+    assert(image_points.shape[0] == len(cameras))
+    assert(image_points.shape[2] == 2)
+
+    n_points = image_points.shape[1]
+    if weights is None:
+        weights = np.ones(image_points.shape[:2])
+    else:
+        weights = np.asarray(weights, dtype=float)
+        assert(weights.shape == image_points.shape[:2])
+    w = np.nan_to_num(weights, nan=0.5)  # turns nan confidences into 0.5
+
+    # Rows of D: w * (u * P[2, :] - P[0, :]) and w * (v * P[2, :] - P[1, :]).
+    P = np.stack([cam.P for cam in cameras])  # (n, 3, 4)
+    world = np.zeros((3, n_points))
+    for start in range(0, n_points, chunk_size):
+        end = min(start + chunk_size, n_points)
+        uv = image_points[:, start:end, :]
+        wc = w[:, start:end, None]
+        rows_u = wc * (uv[..., 0, None] * P[:, None, 2, :] - P[:, None, 0, :])
+        rows_v = wc * (uv[..., 1, None] * P[:, None, 2, :] - P[:, None, 1, :])
+        # Q = D.T.dot(D), accumulated over views.
+        Q = (np.einsum('cmi,cmj->mij', rows_u, rows_u) +
+             np.einsum('cmi,cmj->mij', rows_v, rows_v))
+        u, _, _ = np.linalg.svd(Q)
+        pts = u[:, :, -1]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            world[:, start:end] = (pts[:, :3] / pts[:, 3, None]).T
+
+    # Confidence: mean of the non-zero, non-nan weights. Points seen with
+    # confidence by fewer than 2 cameras are returned as 0s.
+    nonzero = weights != 0
+    valid = nonzero & ~np.isnan(weights)
+    n_valid = np.count_nonzero(valid, axis=0)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        confidence = np.where(
+            n_valid > 0,
+            np.sum(np.where(valid, weights, 0), axis=0) / n_valid,
+            .5)  # nans get 0.5 confidence
+    not_seen = np.count_nonzero(nonzero, axis=0) < 2
+    world[:, not_seen] = 0
+    confidence[not_seen] = 0
+
+    return world, confidence[np.newaxis, :]
+
+
 def calibrate_division_model(line_coordinates, y0, z_n, focal_length=1):
     """
     Calibrate division model by making lines straight.
@@ -15,16 +15,21 @@ import requests
 import ffmpeg
 import matplotlib.pyplot as plt
 from scipy.ndimage import gaussian_filter1d
-from scipy.signal import gaussian, sosfiltfilt, butter, find_peaks
+from scipy.signal import gaussian, sosfiltfilt, butter, find_peaks, fftconvolve
 from scipy.interpolate import pchip_interpolate
 from scipy.spatial.transform import Rotation 
 import scipy.linalg
 from itertools import combinations
 import copy
+import warnings
 from utilsCameraPy3 import Camera, nview_linear_triangulations
+from utilsCameraPy3 import nview_linear_triangulations_batch
 from utils import getOpenPoseMarkerNames, getOpenPoseFaceMarkers
 from utils import numpy2TRC, rewriteVideos, delete_multiple_element,loadCameraParameters
 from utilsAPI import getAPIURL
+from utilsKeypointStore import loadPoseKeypoints
+from utilsBoxes import findClosestBox
+from utilsStageCache import hashFile, hashObject
 
 from utilsAuth import getToken
 
@@ -88,95 +93,155 @@ def video2Images(videoPath, nImages=12, tSingleImage=None, filePrefix='output',
     return outImagePath
         
 
-# %%                
-def calcIntrinsics(folderName, CheckerBoardParams=None, filenames=['*.jpg'], 
-                   imageScaleFactor=1, visualize=False, saveFileName=None):
+# %%
+def readVideoFrames(videoPath, times):
+    # Decodes the frames at the given times (s) into memory, seeking with
+    # cv2.VideoCapture rather than spawning ffmpeg for each frame. Returns
+    # a list of BGR images (None for frames that could not be read).
+    cap = cv2.VideoCapture(videoPath)
+    frameRate = cap.get(cv2.CAP_PROP_FPS)
+    images = []
+    for t in times:
+        cap.set(cv2.CAP_PROP_POS_FRAMES, int(np.round(t*frameRate)))
+        ret, image = cap.read()
+        images.append(image if ret else None)
+    cap.release()
+    
+    return images
+
+# %%
+def getVideoDuration(videoPath):
+    # Duration from the container metadata read by OpenCV, which avoids
+    # spawning ffprobe. Falls back to ffprobe if the metadata is missing.
+    cap = cv2.VideoCapture(videoPath)
+    frameRate = cap.get(cv2.CAP_PROP_FPS)
+    nFrames = cap.get(cv2.CAP_PROP_FRAME_COUNT)
+    cap.release()
+    if frameRate > 0 and nFrames > 0:
+        return nFrames / frameRate
+    return getVideoLength(videoPath)
+
+# %%
+def sampleVideoFrames(videoPath, nImages=12):
+    # Same sampling times as video2Images, disregarding first and last
+    # second. The frames are the ones at these times, whereas video2Images
+    # pops the next keyframe.
+    lengthVideo = getVideoDuration(videoPath)
+    timeImageSamples = np.linspace(1,lengthVideo-1,nImages)
+    
+    return readVideoFrames(videoPath, timeImageSamples)
+
+# %%
+def detectCheckerboardCorners(grayColor, dimensions, detectionScaleFactor=1):
+    # Detects the checkerboard corners. If detectionScaleFactor < 1, the
+    # corners are detected on a downscaled image and refined with
+    # cornerSubPix at full resolution. Returns whether the checkerboard was
+    # detected, the corners, and the shape of the detected board. Defined at
+    # module level such that it can run in a process pool.
+    if detectionScaleFactor != 1:
+        dim = (int(detectionScaleFactor*grayColor.shape[1]),
+               int(detectionScaleFactor*grayColor.shape[0]))
+        detectionImage = cv2.resize(grayColor,dim,interpolation=cv2.INTER_AREA)
+    else:
+        detectionImage = grayColor
+    
+    ret,corners,meta = cv2.findChessboardCornersSBWithMeta(detectionImage, dimensions,
+                                                    cv2.CALIB_CB_EXHAUSTIVE + 
+                                                    cv2.CALIB_CB_ACCURACY + 
+                                                    cv2.CALIB_CB_LARGER)
+    if not ret:
+        return False, None, None
+    
+    if detectionScaleFactor != 1:
+        # stop the iteration when specified accuracy, epsilon, is reached or 
+        # specified number of iterations are completed. 
+        criteria = (cv2.TERM_CRITERIA_EPS + 
+                    cv2.TERM_CRITERIA_MAX_ITER, 30, 0.001)
+        corners = cv2.cornerSubPix(
+            grayColor, np.ascontiguousarray(corners/detectionScaleFactor, 
+                                            dtype=np.float32),
+            (11, 11), (-1, -1), criteria)
+    
+    return True, corners, meta.shape
+
+# %%
+def calcIntrinsicsFromImages(images, CheckerBoardParams=None, imageNames=None,
+                             imageScaleFactor=1, detectionScaleFactor=1,
+                             nWorkers=1, imageSaveDir=None, 
+                             visualize=False, saveFileName=None):
+    # Calibrates the intrinsics from in-memory BGR images. The checkerboard
+    # corners are detected across a process pool of nWorkers processes
+    # (serially if nWorkers is 1, all cpus if None).
     if CheckerBoardParams is None:
         # number of black to black corners and side length (cm)
         CheckerBoardParams = {'dimensions': (6,9), 'squareSize': 2.71}
-    
-    if '*' in filenames[0]:
-        imageFiles = glob.glob(folderName + '/' + filenames[0])
-        
+    if imageNames is None:
+        imageNames = ['image' + str(iImage) for iImage in range(len(images))]
+    
+    imageNames = [imageName for image, imageName in zip(images, imageNames)
+                  if image is not None]
+    images = [image for image in images if image is not None]
+    if len(images) == 0:
+        print('No intrinsic images could be read.')
+        return None
+    if imageScaleFactor != 1:
+        images = [cv2.resize(image,(int(imageScaleFactor*image.shape[1]),
+                                    int(imageScaleFactor*image.shape[0])),
+                             interpolation=cv2.INTER_AREA) for image in images]
+    grayColors = [cv2.cvtColor(image, cv2.COLOR_BGR2GRAY) for image in images]
+    imageSize = np.reshape(np.asarray(np.shape(images[-1])[0:2]).astype(np.float64),(2,1)) # This all to be able to copy camera param dictionary
+    
+    # Find the chess board corners.
+    nArgs = len(grayColors)
+    detectionArgs = (grayColors, [CheckerBoardParams['dimensions']]*nArgs,
+                     [detectionScaleFactor]*nArgs)
+    if nWorkers is None:
+        nWorkers = min(os.cpu_count() or 1, nArgs)
+    if nWorkers > 1:
+        from concurrent.futures import ProcessPoolExecutor
+        # One OpenCV thread per process, the parallelism is across images.
+        with ProcessPoolExecutor(max_workers=nWorkers, 
+                                 initializer=cv2.setNumThreads,
+                                 initargs=(1,)) as pool:
+            detections = list(pool.map(detectCheckerboardCorners, 
+                                       *detectionArgs))
     else:
-        imageFiles = [] ;
-        for fName in filenames:
-            imageFiles.append(folderName + '/' + fName)    
-           
-    # stop the iteration when specified 
-    # accuracy, epsilon, is reached or 
-    # specified number of iterations are completed. 
-    criteria = (cv2.TERM_CRITERIA_EPS + 
-                cv2.TERM_CRITERIA_MAX_ITER, 30, 0.001)       
-      
+        detections = list(map(detectCheckerboardCorners, *detectionArgs))
+    
     # Vector for 3D points 
     threedpoints = [] 
-      
     # Vector for 2D points 
-    twodpoints = []       
-      
-    #  3D points real world coordinates 
-    # objectp3d = generate3Dgrid(CheckerBoardParams) 
-            
-    # Load images in for calibration
-    for iImage, pathName in enumerate(imageFiles):
-        image = cv2.imread(pathName) 
-        if imageScaleFactor != 1:
-            dim = (int(imageScaleFactor*image.shape[1]),int(imageScaleFactor*image.shape[0]))
-            image = cv2.resize(image,dim,interpolation=cv2.INTER_AREA)
-        imageSize = np.reshape(np.asarray(np.shape(image)[0:2]).astype(np.float64),(2,1)) # This all to be able to copy camera param dictionary
-        
-        grayColor = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY) 
-        print(pathName + ' used for intrinsics calibration.')
-      
-        # Find the chess board corners 
-        # If desired number of corners are 
-        # found in the image then ret = true 
-        # ret, corners = cv2.findChessboardCorners( 
-        #                 grayColor, CheckerBoardParams['dimensions'],  
-        #                 cv2.CALIB_CB_ADAPTIVE_THRESH
-        #                 + cv2.CALIB_CB_FAST_CHECK + 
-        #                 cv2.CALIB_CB_NORMALIZE_IMAGE) 
-        
-        ret,corners,meta = cv2.findChessboardCornersSBWithMeta(	grayColor, CheckerBoardParams['dimensions'],
-                                                        cv2.CALIB_CB_EXHAUSTIVE + 
-                                                        cv2.CALIB_CB_ACCURACY + 
-                                                        cv2.CALIB_CB_LARGER)
-      
+    twodpoints = []
+    
+    for iImage, (image, (ret, corners, metaShape)) in enumerate(
+            zip(images, detections)):
+        print(imageNames[iImage] + ' used for intrinsics calibration.')
+        
         # If desired number of corners can be detected then, 
         # refine the pixel coordinates and display 
         # them on the images of checker board 
         if ret == True: 
             # 3D points real world coordinates 
             checkerCopy = copy.copy(CheckerBoardParams)
-            checkerCopy['dimensions'] = meta.shape[::-1] # reverses order so width is first
+            checkerCopy['dimensions'] = metaShape[::-1] # reverses order so width is first
             objectp3d = generate3Dgrid(checkerCopy)
             
             threedpoints.append(objectp3d) 
-      
-            # Refining pixel coordinates 
-            # for given 2d points. 
-            # corners2 = cv2.cornerSubPix( 
-            #     grayColor, corners, (11, 11), (-1, -1), criteria) 
             
             corners2 = corners/imageScaleFactor # Don't need subpixel refinement with findChessboardCornersSBWithMeta
             twodpoints.append(corners2) 
             
-            # Draw and display the corners 
-            image = cv2.drawChessboardCorners(image,  
-                                                meta.shape[::-1],  
-                                                corners2, ret) 
-                
-            #findAspectRatio
-            ar = imageSize[1]/imageSize[0]            
-            # cv2.namedWindow("img", cv2.WINDOW_NORMAL) 
-            cv2.resize(image,(int(600*ar),600))
+            # Draw and display the corners, on a copy since the images
+            # belong to the caller.
+            if imageSaveDir is not None or visualize:
+                image = cv2.drawChessboardCorners(image.copy(),  
+                                                    metaShape[::-1],  
+                                                    corners2, ret) 
             
             # Save intrinsic images
-            imageSaveDir = os.path.join(folderName,'IntrinsicCheckerboards')
-            if not os.path.exists(imageSaveDir):
-                os.mkdir(imageSaveDir)
-            cv2.imwrite(os.path.join(imageSaveDir,'intrinsicCheckerboard' + str(iImage) + '.jpg'), image)
+            if imageSaveDir is not None:
+                os.makedirs(imageSaveDir, exist_ok=True)
+                cv2.imwrite(os.path.join(imageSaveDir,'intrinsicCheckerboard' + str(iImage) + '.jpg'), image)
                 
             if visualize:
                 print('Press enter or close image to continue')
@@ -185,9 +250,9 @@ def calcIntrinsics(folderName, CheckerBoardParams=None, filenames=['*.jpg'],
                 cv2.destroyAllWindows() 
                 
         if ret == False:
-            print("Couldn't find checkerboard in " + pathName)
+            print("Couldn't find checkerboard in " + imageNames[iImage])
   
-    if len(twodpoints) < .5*len(imageFiles):
+    if len(twodpoints) < .5*len(images):
        print('Checkerboard not detected in at least half of intrinsic images. Re-record video.')
        return None
        
@@ -197,7 +262,7 @@ def calcIntrinsics(folderName, CheckerBoardParams=None, filenames=['*.jpg'],
     # and its corresponding pixel coordinates of the 
     # detected corners (twodpoints) 
     ret, matrix, distortion, r_vecs, t_vecs = cv2.calibrateCamera( 
-        threedpoints, twodpoints, grayColor.shape[::-1], None, None)     
+        threedpoints, twodpoints, grayColors[-1].shape[::-1], None, None)     
     
     CamParams = {'distortion':distortion,'intrinsicMat':matrix,'imageSize':imageSize}
     
@@ -206,8 +271,49 @@ def calcIntrinsics(folderName, CheckerBoardParams=None, filenames=['*.jpg'],
   
     return CamParams
 
+# %%                
+def calcIntrinsics(folderName, CheckerBoardParams=None, filenames=['*.jpg'], 
+                   imageScaleFactor=1, visualize=False, saveFileName=None,
+                   detectionScaleFactor=1, nWorkers=1):
+    
+    if '*' in filenames[0]:
+        imageFiles = glob.glob(folderName + '/' + filenames[0])
+        
+    else:
+        imageFiles = [] ;
+        for fName in filenames:
+            imageFiles.append(folderName + '/' + fName)    
+    
+    # Load images in for calibration
+    images = [cv2.imread(pathName) for pathName in imageFiles]
+    
+    return calcIntrinsicsFromImages(
+        images, CheckerBoardParams=CheckerBoardParams, imageNames=imageFiles,
+        imageScaleFactor=imageScaleFactor, 
+        detectionScaleFactor=detectionScaleFactor, nWorkers=nWorkers,
+        imageSaveDir=os.path.join(folderName,'IntrinsicCheckerboards'),
+        visualize=visualize, saveFileName=saveFileName)
+
+# %%
+def calcIntrinsicsFromVideo(videoPath, CheckerBoardParams=None, nImages=12,
+                            detectionScaleFactor=1, nWorkers=1,
+                            visualize=False, saveFileName=None):
+    # Samples the intrinsic images from the video in memory, instead of
+    # popping them to disk with video2Images, and calibrates the intrinsics.
+    images = sampleVideoFrames(videoPath, nImages=nImages)
+    imageNames = [videoPath + ' (image ' + str(iImage) + ')' 
+                  for iImage in range(len(images))]
+    
+    return calcIntrinsicsFromImages(
+        images, CheckerBoardParams=CheckerBoardParams, imageNames=imageNames,
+        detectionScaleFactor=detectionScaleFactor, nWorkers=nWorkers,
+        imageSaveDir=os.path.join(os.path.dirname(videoPath),
+                                  'IntrinsicCheckerboards'),
+        visualize=visualize, saveFileName=saveFileName)
+
 # %%
-def computeAverageIntrinsics(session_path,trialIDs,CheckerBoardParams,nImages=25):
+def computeAverageIntrinsics(session_path,trialIDs,CheckerBoardParams,nImages=25,
+                             detectionScaleFactor=1,nWorkers=1):
     CamParamList = []
     camModels = []
     
@@ -231,12 +337,13 @@ def computeAverageIntrinsics(session_path,trialIDs,CheckerBoardParams,nImages=25
             
         if not os.path.exists(os.path.join(video_dir,'cameraIntrinsics.pickle')):
             
-            # Compute intrinsics from images popped out of intrinsic video.
-            video2Images(video_path,filePrefix=trial_name,nImages=nImages)
-            CamParams = calcIntrinsics(os.path.join(session_path,trial_name), CheckerBoardParams=CheckerBoardParams,
-                                       filenames=['*.jpg'], 
-                                       saveFileName=os.path.join(video_dir,'cameraIntrinsics.pickle'),
-                                       visualize = False)
+            # Compute intrinsics from images sampled from intrinsic video.
+            CamParams = calcIntrinsicsFromVideo(video_path, CheckerBoardParams=CheckerBoardParams,
+                                                nImages=nImages,
+                                                detectionScaleFactor=detectionScaleFactor,
+                                                nWorkers=nWorkers,
+                                                saveFileName=os.path.join(video_dir,'cameraIntrinsics.pickle'),
+                                                visualize = False)
             if CamParams is None:
                 saveCameraParameters(os.path.join(video_dir,'cameraIntrinsics.pickle'),CamParams)
             
@@ -361,16 +468,44 @@ def rotateIntrinsics(CamParams,videoPath):
     return CamParams
 
 # %% 
-def calcExtrinsics(imageFileName, CameraParams, CheckerBoardParams,
-                   imageScaleFactor=1,visualize=False,
-                   imageUpsampleFactor=1,useSecondExtrinsicsSolution=False):
-    # Camera parameters is a dictionary with intrinsics
+def detectExtrinsicCorners(image, CheckerBoardParams, upsampleFactor=1):
+    # Detects the checkerboard on the image resampled by upsampleFactor.
+    # Returns the corners in image pixels, or None.
     
     # stop the iteration when specified 
     # accuracy, epsilon, is reached or 
     # specified number of iterations are completed. 
     criteria = (cv2.TERM_CRITERIA_EPS + 
                 cv2.TERM_CRITERIA_MAX_ITER, 30, 0.001) 
+    
+    if upsampleFactor != 1:
+        dim = (int(upsampleFactor*image.shape[1]),int(upsampleFactor*image.shape[0]))
+        imageUpsampled = cv2.resize(image,dim,interpolation=cv2.INTER_AREA)
+    else:
+        imageUpsampled = image
+    grayColor = cv2.cvtColor(imageUpsampled, cv2.COLOR_BGR2GRAY)
+    # Note I tried findChessboardCornersSB here, but it didn't find chessboard as reliably
+    ret, corners = cv2.findChessboardCorners( 
+                grayColor, CheckerBoardParams['dimensions'],  
+                cv2.CALIB_CB_ADAPTIVE_THRESH) 
+    if ret == False:
+        return None
+    
+    # Refining pixel coordinates for given 2d points.
+    corners = cv2.cornerSubPix( 
+        grayColor, corners, (11, 11), (-1, -1), criteria) / upsampleFactor
+    # Newer OpenCV returns (N, 2) corners.
+    return np.reshape(corners, (-1, 1, 2))
+
+# %%
+def calcExtrinsics(imageFileName, CameraParams, CheckerBoardParams,
+                   imageScaleFactor=1,visualize=False,
+                   imageUpsampleFactor=1,useSecondExtrinsicsSolution=False,
+                   image=None, corners=None):
+    # Camera parameters is a dictionary with intrinsics
+    # The image is read from imageFileName unless given, and the 
+    # checkerboard is detected unless corners are given (see 
+    # detectExtrinsicCorners). Outputs are saved relative to imageFileName.
       
     # Vector for 3D points 
     threedpoints = [] 
@@ -382,56 +517,22 @@ def calcExtrinsics(imageFileName, CameraParams, CheckerBoardParams,
     objectp3d = generate3Dgrid(CheckerBoardParams)
     
     # Load and resize image - remember calibration image res needs to be same as all processing
-    image = cv2.imread(imageFileName)
+    if image is None:
+        image = cv2.imread(imageFileName)
     if imageScaleFactor != 1:
         dim = (int(imageScaleFactor*image.shape[1]),int(imageScaleFactor*image.shape[0]))
         image = cv2.resize(image,dim,interpolation=cv2.INTER_AREA)
-        
-    if imageUpsampleFactor != 1:
-        dim = (int(imageUpsampleFactor*image.shape[1]),int(imageUpsampleFactor*image.shape[0]))
-        imageUpsampled = cv2.resize(image,dim,interpolation=cv2.INTER_AREA)
     else:
-        imageUpsampled = image
-
+        image = image.copy()
     
     # Find the chess board corners 
-    # If desired number of corners are 
-    # found in the image then ret = true 
-    
     #TODO need to add a timeout to the findChessboardCorners function
-    grayColor = cv2.cvtColor(imageUpsampled, cv2.COLOR_BGR2GRAY)
-    
-    ## Contrast TESTING - openCV does thresholding already, but this may be a bit helpful for bumping contrast
-    # grayColor = grayColor.astype('float64')
-    # cv2.imshow('Grayscale', grayColor.astype('uint8'))
-    # savePath = os.path.join(os.path.dirname(imageFileName),'extrinsicGray.jpg')
-    # cv2.imwrite(savePath,grayColor)
-    
-    # grayContrast = np.power(grayColor,2)
-    # grayContrast = grayContrast/(np.max(grayContrast)/255)    
-    # # plt.figure()
-    # # plt.imshow(grayContrast, cmap='gray')
-    
-    # # cv2.imshow('ContrastEnhanced', grayContrast.astype('uint8'))
-    # savePath = os.path.join(os.path.dirname(imageFileName),'extrinsicGrayContrastEnhanced.jpg')
-    # cv2.imwrite(savePath,grayContrast)
-      
-    # grayContrast = grayContrast.astype('uint8')
-    # grayColor = grayColor.astype('uint8')
-
-    ## End contrast Testing
-    
-    ## Testing settings - slow and don't help 
-    # ret, corners = cv2.findChessboardCorners( 
-    #                 grayContrast, CheckerBoardParams['dimensions'],  
-    #                 cv2.CALIB_CB_ADAPTIVE_THRESH  
-    #                 + cv2.CALIB_CB_FAST_CHECK + 
-    #                 cv2.CALIB_CB_NORMALIZE_IMAGE) 
-    
-    # Note I tried findChessboardCornersSB here, but it didn't find chessboard as reliably
-    ret, corners = cv2.findChessboardCorners( 
-                grayColor, CheckerBoardParams['dimensions'],  
-                cv2.CALIB_CB_ADAPTIVE_THRESH) 
+    if corners is None:
+        corners2 = detectExtrinsicCorners(image, CheckerBoardParams,
+                                          imageUpsampleFactor)
+    else:
+        corners2 = corners
+    ret = corners2 is not None
 
     # If desired number of corners can be detected then, 
     # refine the pixel coordinates and display 
@@ -440,11 +541,6 @@ def calcExtrinsics(imageFileName, CameraParams, CheckerBoardParams,
         # 3D points real world coordinates       
         threedpoints.append(objectp3d) 
   
-        # Refining pixel coordinates 
-        # for given 2d points. 
-        corners2 = cv2.cornerSubPix( 
-            grayColor, corners, (11, 11), (-1, -1), criteria) / imageUpsampleFactor
-  
         twodpoints.append(corners2) 
   
         # For testing: Draw and display the corners 
@@ -595,50 +691,98 @@ def calcExtrinsics(imageFileName, CameraParams, CheckerBoardParams,
 # %% 
 def calcExtrinsicsFromVideo(videoPath, CamParams, CheckerBoardParams,
                             visualize=False, imageUpsampleFactor=2,
-                            useSecondExtrinsicsSolution=False):    
-    # Get video parameters.
-    vidLength = getVideoLength(videoPath)
+                            useSecondExtrinsicsSolution=False, cacheDir=None):    
+    # The extrinsic image is popped from the end of the video as before, and
+    # read once. The extrinsics are then computed at imageUpsampleFactor and,
+    # if detection or solvePnP fails, at the factors it used to be retried
+    # with, without re-reading the image or re-trying a factor. If cacheDir
+    # is given, the corners that gave the extrinsics are cached keyed by the
+    # video content and the checkerboard parameters, such that re-running
+    # the calibration pops the image and only solves for the extrinsics.
     videoDir, videoName = os.path.split(videoPath)    
-    # Pick end of video as only sample point. For some reason, won't output
-    # video with t close to vidLength, so we count down til it does.
-    tSampPts = [np.round(vidLength-0.3, decimals=1)]    
-    upsampleIters = 0
-    for iTime,t in enumerate(tSampPts):
-        # Pop an image.
-        imagePath = os.path.join(videoDir, 'extrinsicImage0.png')
+    imagePath = os.path.join(videoDir, 'extrinsicImage0.png')
+    upsampleFactors = [imageUpsampleFactor]
+    for upsampleIters in range(3):
+        if upsampleFactors[-1] > 1: 
+            upsampleFactors.append(1)
+        elif upsampleFactors[-1] == 1:
+            upsampleFactors.append(.5)
+        elif upsampleFactors[-1] < 1:
+            upsampleFactors.append(1)
+    
+    def popImage(t):
+        # Pops the keyframe at t, or returns None if there is none.
         if os.path.exists(imagePath):
             os.remove(imagePath)
-        while not os.path.exists(imagePath) and t>=0:
-            video2Images(videoPath, nImages=1, tSingleImage=t, filePrefix='extrinsicImage', skipIfRun=False)
-            t -= 0.2
-        # Default to beginning if can't find a keyframe.
+        video2Images(videoPath, nImages=1, tSingleImage=t, 
+                     filePrefix='extrinsicImage', skipIfRun=False)
         if not os.path.exists(imagePath):
-            video2Images(videoPath, nImages=1, tSingleImage=0.01, filePrefix='extrinsicImage', skipIfRun=False)
-        # Throw error if it can't find a keyframe.
-        if not os.path.exists(imagePath):
-            exception = 'No calibration image could be extracted for at least one camera. Verify your setup and try again. Visit https://www.opencap.ai/best-pratices to learn more about camera calibration and https://www.opencap.ai/troubleshooting for potential causes for a failed calibration.'
-            raise Exception(exception, exception)
-        # Try to find the checkerboard; return None if you can't find it.           
-        CamParamsTemp = calcExtrinsics(
-            os.path.join(videoDir, 'extrinsicImage0.png'),
-            CamParams, CheckerBoardParams, visualize=visualize, 
-            imageUpsampleFactor=imageUpsampleFactor,
-            useSecondExtrinsicsSolution=useSecondExtrinsicsSolution)
-        while iTime == 0 and CamParamsTemp is None and upsampleIters < 3:
-            if imageUpsampleFactor > 1: 
-                imageUpsampleFactor = 1
-            elif imageUpsampleFactor == 1:
-                imageUpsampleFactor = .5
-            elif imageUpsampleFactor < 1:
-                imageUpsampleFactor = 1
-            CamParamsTemp = calcExtrinsics(
-                os.path.join(videoDir, 'extrinsicImage0.png'),
-                CamParams, CheckerBoardParams, visualize=visualize, 
-                imageUpsampleFactor=imageUpsampleFactor,
-                useSecondExtrinsicsSolution=useSecondExtrinsicsSolution)
-            upsampleIters += 1
+            return None
+        return cv2.imread(imagePath)
+    
+    def solveExtrinsics(image, corners):
+        # Outputs are saved next to the image (see deleteCalibrationFiles).
+        return calcExtrinsics(
+            imagePath, CamParams, CheckerBoardParams, visualize=visualize, 
+            useSecondExtrinsicsSolution=useSecondExtrinsicsSolution,
+            image=image, corners=corners)
+    
+    cachePath = None
+    if cacheDir is not None:
+        cacheKey = hashObject({'version': 3, 'video': hashFile(videoPath),
+                               'CheckerBoardParams': CheckerBoardParams,
+                               'upsampleFactors': upsampleFactors})
+        cachePath = os.path.join(cacheDir, cacheKey + '.json')
+        if os.path.exists(cachePath):
+            with open(cachePath, 'r') as f:
+                cachedDetection = json.load(f)
+            image = popImage(cachedDetection['time'])
+            if image is not None:
+                CamParamsTemp = solveExtrinsics(
+                    image, np.asarray(cachedDetection['corners'], 
+                                      dtype=np.float32).reshape(-1, 1, 2))
+                if CamParamsTemp is not None:
+                    print('Using cached checkerboard detection.')
+                    # Marks the detection as used, see 
+                    # utilsStageCache.collectStageCacheGarbage.
+                    os.utime(cachePath)
+                    return CamParamsTemp.copy()
+    
+    # Pick end of video as only sample point. For some reason, won't output
+    # video with t close to vidLength, so we count down til it does.
+    vidLength = getVideoLength(videoPath)
+    t = np.round(vidLength-0.3, decimals=1)
+    image = None
+    while image is None and t >= 0:
+        image = popImage(t)
+        tImage = t
+        t -= 0.2
+    # Default to beginning if can't find a keyframe.
+    if image is None:
+        tImage = 0.01
+        image = popImage(tImage)
+    # Throw error if it can't find a keyframe.
+    if image is None:
+        exception = 'No calibration image could be extracted for at least one camera. Verify your setup and try again. Visit https://www.opencap.ai/best-pratices to learn more about camera calibration and https://www.opencap.ai/troubleshooting for potential causes for a failed calibration.'
+        raise Exception(exception, exception)
+    
+    # Try to find the checkerboard and the extrinsics at each factor in turn.
+    triedFactors = []
+    for factor in upsampleFactors:
+        if factor in triedFactors: # Same image and factor, same result.
+            continue
+        triedFactors.append(factor)
+        corners = detectExtrinsicCorners(image, CheckerBoardParams, factor)
+        if corners is None:
+            continue
+        CamParamsTemp = solveExtrinsics(image, corners)
         if CamParamsTemp is not None:
             # If checkerboard was found, exit.
+            if cachePath is not None:
+                os.makedirs(cacheDir, exist_ok=True)
+                with open(cachePath, 'w') as f:
+                    json.dump({'time': float(tImage), 
+                               'corners': corners.tolist()}, f)
             CamParams = CamParamsTemp.copy()
             return CamParams
 
@@ -924,10 +1068,15 @@ def synchronizeVideoKeypoints(keypointList, confidenceList,
                               sampleFreq=30, visualize=False, maxShiftSteps=30,
                               isGait=False, CameraParams = None,
                               cameras2Use=['none'],CameraDirectories = None,
-                              trialName=None, trialID=''):
+                              trialName=None, trialID='', corrBackend='fft',
+                              lagSearch='exhaustive'):
     visualize2Dkeypoint = False # this is a visualization just for testing what filtered input data looks like
     
     # keypointList is a mCamera length list of (nmkrs,nTimesteps,2) arrays of camera 2D keypoints
+    # corrBackend selects how cross correlations are computed: 'fft' (batched
+    # over timeseries) or 'direct' (np.correlate).
+    # lagSearch selects how the reprojection error-based lag refinement
+    # searches around the correlation peak: 'exhaustive' or 'coarseToFine'.
     print('Synchronizing Keypoints')
     
     # Deep copies such that the inputs do not get modified.
@@ -1140,25 +1289,28 @@ def synchronizeVideoKeypoints(keypointList, confidenceList,
                                  'keypointList':keypointListFilt,
                                  'cams2UseReproj': [0, c_cameras2Use.index(c_cameras2Use[iCam])],
                                  'confidence': confidenceSyncListFilt,
-                                 'cameras2Use': c_cameras2Use
+                                 'cameras2Use': c_cameras2Use,
+                                 'lagSearch': lagSearch
                                  }
                 corVal,lag = cross_corr(vertVel,vertVelList[0],multCorrGaussianStd=maxShiftSteps/2,
                                         visualize=False,dataForReproj=dataForReproj,
-                                        frameRate=sampleFreq) # gaussian curve gets multipled by correlation plot - helping choose the smallest shift value for periodic motions
+                                        frameRate=sampleFreq,backend=corrBackend) # gaussian curve gets multipled by correlation plot - helping choose the smallest shift value for periodic motions
             elif syncActivity == 'gait':
                 
                 dataForReproj = {'CamParamList':c_CameraParams,
                                  'keypointList':keypointListFilt,
                                  'cams2UseReproj': [0, c_cameras2Use.index(c_cameras2Use[iCam])],
                                  'confidence': confidenceSyncListFilt,
-                                 'cameras2Use': c_cameras2Use
+                                 'cameras2Use': c_cameras2Use,
+                                 'lagSearch': lagSearch
                                  }
                 corVal,lag = cross_corr_multiple_timeseries(mkrSpeedList[iCam],
                                             mkrSpeedList[0],
                                             multCorrGaussianStd=maxShiftSteps/2,
                                             dataForReproj=dataForReproj,
                                             visualize=False,
-                                            frameRate=sampleFreq)    
+                                            frameRate=sampleFreq,
+                                            backend=corrBackend)    
             elif syncActivity == 'handPunch':
                 corVal,lag = syncHandPunch([handPunchVertPositionList[i] for i in [0,iCam]],
                                            handForPunch,maxShiftSteps=maxShiftSteps)
@@ -1485,42 +1637,6 @@ def keypointsToBoundingBox(data,confidenceThreshold=0.3):
     
     return bbox
 
-#%%    
-def findClosestBox(bbox,keyBoxes,imageSize,iPerson=None):
-    # bbox: the bbox selected from the previous frame.
-    # keyBoxes: bboxes detected in the current frame.
-    # imageSize: size of the image
-    # iPerson: index of the person to track..   
-    
-    # Parameters.
-    # Proportion of mean image dimensions that corners must change to be
-    # considered different person
-    cornerChangeThreshold = 0.2 
-    
-    keyBoxCorners = []
-    for keyBox in keyBoxes:
-        keyBoxCorners.append(np.array([keyBox[0], keyBox[1], 
-                                       keyBox[0] + keyBox[2],
-                                       keyBox[1] + keyBox[3]]))
-    bboxCorners = np.array(
-        [bbox[0], bbox[1], bbox[0] + bbox[2], bbox[1] + bbox[3]])
-    
-    boxErrors = [
-        np.linalg.norm(keyBox - bboxCorners) for keyBox in keyBoxCorners]
-    try:
-        if iPerson is None:
-            iPerson = np.nanargmin(boxErrors)
-        bbox = keyBoxes[iPerson]
-    except:
-        return None, None, False
-    
-    # If large jump in bounding box, break.
-    samePerson = True
-    if (boxErrors[iPerson] > cornerChangeThreshold*np.mean(imageSize)):
-        samePerson = False
-        
-    return iPerson,bbox,samePerson
-
 #%%
 def trackKeypointBox(videoPath,bbStart,allPeople,allBoxes,dataOut,frameStart = 0 ,
                      frameIncrement = 1, visualize = False, poseDetector='OpenPose',
@@ -2086,7 +2202,63 @@ def clean2Dkeypoints(key2D, confidence, confidenceThreshold=0.5, nCams=2,
     return key2D_out, confidence_out, nans_in_out, confidence_sync_out
 
 # %%
-def cross_corr(y1, y2,multCorrGaussianStd=None,visualize=False, dataForReproj=None, frameRate=60):
+def normalized_cross_corr(Y1, Y2, backend='fft'):
+    """Calculates the unbiased, normalized cross correlation of timeseries.
+    
+    Each row of Y1 is correlated with the same row of Y2, the shorter signals
+    are padded with 0s. The output matches np.correlate(y1, y2, mode='same'),
+    divided by the unbiased sample size and the autocorrelations.
+    
+    Args:
+    Y1, Y2: nSeries x nSamples arrays (or 1D arrays for a single series).
+    backend: 'fft' computes all correlations in one batched FFT call,
+        'direct' uses np.correlate per timeseries (O(N^2)).
+    
+    Returns:
+    corr: nSeries x nSamples correlations (nSamples for 1D inputs).
+    shift: The index of the 0 lag in corr.
+    """
+    isVector = np.ndim(Y1) == 1
+    Y1 = np.atleast_2d(np.asarray(Y1, dtype=float))
+    Y2 = np.atleast_2d(np.asarray(Y2, dtype=float))
+    
+    # Pad shorter signal with 0s
+    nSamples = np.max([Y1.shape[1], Y2.shape[1]])
+    if Y1.shape[1] < nSamples:
+        Y1 = np.pad(Y1, ((0,0),(0,nSamples-Y1.shape[1])))
+    if Y2.shape[1] < nSamples:
+        Y2 = np.pad(Y2, ((0,0),(0,nSamples-Y2.shape[1])))
+        
+    y1_auto_corr = np.sum(Y1*Y1, axis=1) / nSamples
+    y2_auto_corr = np.sum(Y2*Y2, axis=1) / nSamples
+    if backend == 'fft':
+        corr = fftconvolve(Y1, Y2[:,::-1], mode='same', axes=1)
+        # nans only affect the lags they contribute to with np.correlate,
+        # but spread over the whole FFT output.
+        nanRows = np.argwhere(np.any(np.isnan(Y1) | np.isnan(Y2), axis=1))
+        for iRow in nanRows.flatten():
+            corr[iRow,:] = np.correlate(Y1[iRow,:], Y2[iRow,:], mode='same')
+    elif backend == 'direct':
+        corr = np.empty(Y1.shape)
+        for iRow in range(Y1.shape[0]):
+            corr[iRow,:] = np.correlate(Y1[iRow,:], Y2[iRow,:], mode='same')
+    else:
+        raise ValueError('Unknown cross correlation backend: {}'.format(backend))
+    # The unbiased sample size is N - lag.
+    shift = nSamples // 2
+    unbiased_sample_size = nSamples - np.abs(np.arange(nSamples) - shift)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        corr = (corr / unbiased_sample_size / 
+                np.sqrt(y1_auto_corr * y2_auto_corr)[:,None])
+    
+    if isVector:
+        corr = corr[0]
+    
+    return corr, shift
+
+# %%
+def cross_corr(y1, y2,multCorrGaussianStd=None,visualize=False, dataForReproj=None, frameRate=60,
+               backend='fft'):
     """Calculates the cross correlation and lags without normalization.
     
     The definition of the discrete cross-correlation is in:
@@ -2094,28 +2266,13 @@ def cross_corr(y1, y2,multCorrGaussianStd=None,visualize=False, dataForReproj=No
     
     Args:
     y1, y2: Should have the same length.
+    backend: 'fft' or 'direct', see normalized_cross_corr.
     
     Returns:
     max_corr: Maximum correlation without normalization.
     lag: The lag in terms of the index.
     """
-    # Pad shorter signal with 0s
-    if len(y1) > len(y2):
-        temp = np.zeros(len(y1))
-        temp[0:len(y2)] = y2
-        y2 = np.copy(temp)
-    elif len(y2)>len(y1):
-        temp = np.zeros(len(y2))
-        temp[0:len(y1)] = y1
-        y1 = np.copy(temp)
-        
-    y1_auto_corr = np.dot(y1, y1) / len(y1)
-    y2_auto_corr = np.dot(y2, y2) / len(y1)
-    corr = np.correlate(y1, y2, mode='same')
-    # The unbiased sample size is N - lag.
-    unbiased_sample_size = np.correlate(np.ones(len(y1)), np.ones(len(y1)), mode='same')
-    corr = corr / unbiased_sample_size / np.sqrt(y1_auto_corr * y2_auto_corr)
-    shift = len(y1) // 2
+    corr, shift = normalized_cross_corr(y1, y2, backend=backend)
     max_corr = np.max(corr)
     argmax_corr = np.argmax(corr)    
 
@@ -2137,15 +2294,13 @@ def cross_corr(y1, y2,multCorrGaussianStd=None,visualize=False, dataForReproj=No
         if len(lags)>3:
             lags = lags[np.argsort(np.abs(lags))[:3]]
         
-        reprojError = np.empty((len(lags),1))
-        reprojSuccess = []
-        for iPeak,lag in enumerate(lags):
-            # calculate reprojection error for each potential lag
-            reprojError[iPeak,0], reprojSuccessi = calcReprojectionErrorForSync(
-                dataForReproj['CamParamList'], dataForReproj['keypointList'],
-                lag, dataForReproj['cams2UseReproj'], 
-                dataForReproj['confidence'], dataForReproj['cameras2Use'])
-            reprojSuccess.append(reprojSuccessi)
+        # calculate reprojection error for each potential lag
+        reprojErrorForSync = ReprojectionErrorForSync(
+            dataForReproj['CamParamList'], dataForReproj['keypointList'],
+            dataForReproj['cams2UseReproj'], dataForReproj['confidence'],
+            dataForReproj['cameras2Use'])
+        reprojError = reprojErrorForSync.evaluate(lags)[:,None]
+        reprojSuccess = [reprojErrorForSync.confRanges is not None] * len(lags)
         
         # find if min reproj error is clearly smaller than other peaks. If it is not,
         # don't use reproj error min for sync. E.g. with treadmill walking, reproj error may not work as
@@ -2155,7 +2310,7 @@ def cross_corr(y1, y2,multCorrGaussianStd=None,visualize=False, dataForReproj=No
         if reprojErrorRatio < 0.6 and not False in reprojSuccess: # tunable parameter. Usually around 0.25 for overground walking
             # find idx with minimum reprojection error 
             lag_corr = lags[np.argmin(reprojError)]
-            max_corr = corr[lag+shift]
+            max_corr = corr[lag_corr+shift]
             
             if multCorrGaussianStd is not None:
                 print('For {}, used reprojection error minimization to sync.'.format(dataForReproj['cameras2Use'][dataForReproj['cams2UseReproj'][1]]))
@@ -2165,18 +2320,11 @@ def cross_corr(y1, y2,multCorrGaussianStd=None,visualize=False, dataForReproj=No
             # This helps the fact that correlation peak is not always the best lag, esp for front-facing cameras
 
             # Create a list of lags to test that is +/- .2 seconds around the selected lag based on frameRate
-            numFrames = int(.2*frameRate)
-            lags = np.arange(lag_corr-numFrames,lag_corr+numFrames+1)
-            reprojErrors = np.empty((len(lags),1))
-
-            for iLag,lag in enumerate(lags):            
-                reprojErrors[iLag,0], _ = calcReprojectionErrorForSync(
-                    dataForReproj['CamParamList'], dataForReproj['keypointList'],
-                    lag, dataForReproj['cams2UseReproj'], 
-                    dataForReproj['confidence'], dataForReproj['cameras2Use'])
-                
             # Select the lag with the lowest reprojection error
-            lag = lags[np.argmin(reprojErrors)]
+            numFrames = int(.2*frameRate)
+            lag, lags, reprojErrors = reprojErrorForSync.refineLag(
+                lag_corr, numFrames, 
+                search=dataForReproj.get('lagSearch', 'exhaustive'))
 
             # plot the reproj errors against lag and identify which was lag_corr
             if visualize:
@@ -2214,7 +2362,8 @@ def cross_corr(y1, y2,multCorrGaussianStd=None,visualize=False, dataForReproj=No
 
 
 # %%
-def cross_corr_multiple_timeseries(Y1, Y2,multCorrGaussianStd=None,dataForReproj=None,visualize=False,frameRate=60):
+def cross_corr_multiple_timeseries(Y1, Y2,multCorrGaussianStd=None,dataForReproj=None,visualize=False,frameRate=60,
+                                   backend='fft'):
     
     # SHAPE OF Y1,Y2 is nMkrs by nSamples
     """Calculates the cross correlation and lags without normalization.
@@ -2224,34 +2373,14 @@ def cross_corr_multiple_timeseries(Y1, Y2,multCorrGaussianStd=None,dataForReproj
     
     Args:
     y1, y2: Should have the same length.
+    backend: 'fft' or 'direct', see normalized_cross_corr.
     
     Returns:
     max_corr: Maximum correlation without normalization.
     lag: The lag in terms of the index.
     """
     nMkrs = Y1.shape[0]
-    corrMat = np.empty(Y1.shape)
-    for iMkr in range(nMkrs):
-        y1=Y1[iMkr,:]
-        y2=Y2[iMkr,:]
-        # Pad shorter signal with 0s
-        if len(y1) > len(y2):
-            temp = np.zeros(len(y1))
-            temp[0:len(y2)] = y2
-            y2 = np.copy(temp)
-        elif len(y2)>len(y1):
-            temp = np.zeros(len(y2))
-            temp[0:len(y1)] = y1
-            y1 = np.copy(temp)
-            
-        y1_auto_corr = np.dot(y1, y1) / len(y1)
-        y2_auto_corr = np.dot(y2, y2) / len(y1)
-        corr = np.correlate(y1, y2, mode='same')
-        # The unbiased sample size is N - lag
-        unbiased_sample_size = np.correlate(np.ones(len(y1)), np.ones(len(y1)), mode='same')
-        corr = corr / unbiased_sample_size / np.sqrt(y1_auto_corr * y2_auto_corr)
-        shift = len(y1) // 2
-        corrMat[iMkr,:] = corr  
+    corrMat, shift = normalized_cross_corr(Y1, Y2, backend=backend)
     
     if visualize:
         plt.figure()
@@ -2280,15 +2409,13 @@ def cross_corr_multiple_timeseries(Y1, Y2,multCorrGaussianStd=None,dataForReproj
         if len(lags)>3:
             lags = lags[np.argsort(np.abs(lags))[:3]]
         
-        reprojError = np.empty((len(lags),1))
-        reprojSuccess = []
-        for iPeak,lag in enumerate(lags):
-            # calculate reprojection error for each potential lag
-            reprojError[iPeak,0], reprojSuccessi = calcReprojectionErrorForSync(
-                dataForReproj['CamParamList'], dataForReproj['keypointList'],
-                lag, dataForReproj['cams2UseReproj'], 
-                dataForReproj['confidence'], dataForReproj['cameras2Use'])
-            reprojSuccess.append(reprojSuccessi)
+        # calculate reprojection error for each potential lag
+        reprojErrorForSync = ReprojectionErrorForSync(
+            dataForReproj['CamParamList'], dataForReproj['keypointList'],
+            dataForReproj['cams2UseReproj'], dataForReproj['confidence'],
+            dataForReproj['cameras2Use'])
+        reprojError = reprojErrorForSync.evaluate(lags)[:,None]
+        reprojSuccess = [reprojErrorForSync.confRanges is not None] * len(lags)
         
         # find if min reproj error is clearly smaller than other peaks. If it is not,
         # don't use reproj error min for sync. E.g. with treadmill walking, reproj error may not work as
@@ -2298,7 +2425,7 @@ def cross_corr_multiple_timeseries(Y1, Y2,multCorrGaussianStd=None,dataForReproj
         if reprojErrorRatio < 0.6 and not False in reprojSuccess: # tunable parameter. Usually around 0.25 for overground walking
             # find idx with minimum reprojection error 
             lag_corr = lags[np.argmin(reprojError)]
-            max_corr = summedCorr[lag+shift]
+            max_corr = summedCorr[lag_corr+shift]
             
             if multCorrGaussianStd is not None:
                 print('For {}, used reprojection error minimization to sync.'.format(dataForReproj['cameras2Use'][dataForReproj['cams2UseReproj'][1]]))
@@ -2308,18 +2435,11 @@ def cross_corr_multiple_timeseries(Y1, Y2,multCorrGaussianStd=None,dataForReproj
             # This helps the fact that correlation peak is not always the best lag, esp for front-facing cameras
 
             # Create a list of lags to test that is +/- .2 seconds around the selected lag based on frameRate
-            numFrames = int(.2*frameRate)
-            lags = np.arange(lag_corr-numFrames,lag_corr+numFrames+1)
-            reprojErrors = np.empty((len(lags),1))
-
-            for iLag,lag in enumerate(lags):            
-                reprojErrors[iLag,0], _ = calcReprojectionErrorForSync(
-                    dataForReproj['CamParamList'], dataForReproj['keypointList'],
-                    lag, dataForReproj['cams2UseReproj'], 
-                    dataForReproj['confidence'], dataForReproj['cameras2Use'])
-                
             # Select the lag with the lowest reprojection error
-            lag = lags[np.argmin(reprojErrors)]
+            numFrames = int(.2*frameRate)
+            lag, lags, reprojErrors = reprojErrorForSync.refineLag(
+                lag_corr, numFrames, 
+                search=dataForReproj.get('lagSearch', 'exhaustive'))
 
             # plot the reproj errors against lag and identify which was lag_corr
             if visualize:
@@ -2518,6 +2638,41 @@ def triangulateMultiview(CameraParamList, points2dUndistorted,
     return points3d, confidence3d
 
 
+# %% Triangulate all frames of a trial at once.
+# keypointList contains one (nMkrs x nFrames x 2) array of undistorted
+# keypoints per camera, and confidenceList one (nMkrs x nFrames) array per
+# camera. Returns the same outputs as looping triangulateMultiview over frames
+# (without outlier rejection), i.e. (3 x nMkrs x nFrames) points and
+# (1 x nMkrs x nFrames) confidences.
+def triangulateMultiviewBatch(CameraParamList, keypointList, confidenceList=None,
+                              useRotationEuler=False):
+    cameraList = []
+    for camParams in CameraParamList:
+        if useRotationEuler:
+            rotMat = cv2.Rodrigues(camParams['rotation_EulerAngles'])[0]
+        else:
+            rotMat = camParams['rotation']
+        
+        c = Camera()
+        c.set_K(camParams['intrinsicMat'])
+        c.set_R(rotMat)
+        c.set_t(np.reshape(camParams['translation'],(3,1)))
+        cameraList.append(c)
+    
+    stackedPoints = np.stack(keypointList) # nCams x nMkrs x nFrames x 2
+    nCams, nMkrs, nFrames, _ = stackedPoints.shape
+    if confidenceList is not None:
+        weights = np.stack(confidenceList).reshape(nCams, nMkrs*nFrames)
+    else:
+        weights = None
+    
+    points3D, confidence3D = nview_linear_triangulations_batch(
+        cameraList, stackedPoints.reshape(nCams, nMkrs*nFrames, 2), 
+        weights=weights)
+    
+    return (points3D.reshape(3, nMkrs, nFrames), 
+            confidence3D.reshape(1, nMkrs, nFrames))
+
 # %% Get 3D keypoints by triangulation.
 # If you set ignoreMissingMarkers to True, and pass the DISTORTED keypoints
 # as keypoints2D, the triangulation will ignore data from cameras that
@@ -2529,7 +2684,7 @@ def triangulateMultiviewVideo(CameraParamDict,keypointDict,imageScaleFactor=1,
                               spline3dZeros = False, splineMaxFrames=5, nansInOut=[],
                               CameraDirectories = None, trialName = None,
                               startEndFrames=None, trialID='',
-                              outputMediaFolder=None):
+                              outputMediaFolder=None, batched=True):
     # cams2Use is a list of cameras that you want to use in triangulation. 
     # if first entry of list is ['all'], will use all
     # otherwise, ['Cam0','Cam2']
@@ -2559,21 +2714,33 @@ def triangulateMultiviewVideo(CameraParamDict,keypointDict,imageScaleFactor=1,
     keypointList_selectedCams = [keypointDict_selectedCams[i] for i in keypointDict_selectedCams]
     confidenceList_selectedCams = [confidenceDict_selectedCams[i] for i in confidenceDict_selectedCams]
     CameraParamList_selectedCams = [CameraParamDict_selectedCams[i] for i in CameraParamDict_selectedCams]
-    unpackedKeypoints = unpackKeypointList(keypointList_selectedCams)
-    points3D = np.zeros((3,keypointList_selectedCams[0].shape[0],keypointList_selectedCams[0].shape[1]))
-    confidence3D = np.zeros((1,keypointList_selectedCams[0].shape[0],keypointList_selectedCams[0].shape[1]))
-    
     
-    for iFrame,points2d in enumerate(unpackedKeypoints):
-        # If confidence weighting
+    # The batched engine triangulates all frames and markers at once. Marker-
+    # specific camera selection (ignoreMissingMarkers) is only supported by
+    # the per-frame path.
+    if batched and not (ignoreMissingMarkers and len(CameraParamList_selectedCams)>2):
         if confidenceDict:
-            thisConfidence = [c[:,iFrame] for c in confidenceList_selectedCams]
+            confidenceList = confidenceList_selectedCams
         else:
-            thisConfidence = None
-        
-        points3D[:,:,iFrame], confidence3D[:,:,iFrame] = triangulateMultiview(CameraParamList_selectedCams, points2d, 
-                          imageScaleFactor=1, useRotationEuler=False,
-                          ignoreMissingMarkers=ignoreMissingMarkers, keypoints2D=keypoints2D,confidence=thisConfidence)
+            confidenceList = None
+        points3D, confidence3D = triangulateMultiviewBatch(
+            CameraParamList_selectedCams, keypointList_selectedCams,
+            confidenceList=confidenceList)
+    else:
+        unpackedKeypoints = unpackKeypointList(keypointList_selectedCams)
+        points3D = np.zeros((3,keypointList_selectedCams[0].shape[0],keypointList_selectedCams[0].shape[1]))
+        confidence3D = np.zeros((1,keypointList_selectedCams[0].shape[0],keypointList_selectedCams[0].shape[1]))
+        
+        for iFrame,points2d in enumerate(unpackedKeypoints):
+            # If confidence weighting
+            if confidenceDict:
+                thisConfidence = [c[:,iFrame] for c in confidenceList_selectedCams]
+            else:
+                thisConfidence = None
+            
+            points3D[:,:,iFrame], confidence3D[:,:,iFrame] = triangulateMultiview(CameraParamList_selectedCams, points2d, 
+                              imageScaleFactor=1, useRotationEuler=False,
+                              ignoreMissingMarkers=ignoreMissingMarkers, keypoints2D=keypoints2D,confidence=thisConfidence)
         
     if trimTrial:
         # Delete confidence and 3D keypoints if markers, except for face 
@@ -2738,114 +2905,186 @@ def findInternalZeroInds(x,maxLength):
     return zeroInds, nonZeroInds
     
 # %% 
+class ReprojectionErrorForSync(object):
+    """Reprojection error of a camera pair as a function of the sync lag.
+    
+    Equivalent to calcReprojectionErrorForSync, but the lag-independent work
+    (camera matrices, confidence ranges) is done once, the input arrays are
+    indexed in place instead of deep-copied, the triangulations for several
+    lags are solved in a single batched call, and errors are cached per lag.
+    
+    """
+    def __init__(self, CamParamList, keypointList, cams2UseReproj, 
+                 confidence, cameras2Use, nTimesteps=5):
+        """
+        Parameters
+        ----------
+        CamParamList, keypointList, confidence : list
+            Per-camera parameters, (nMkrs x nFrames x 2) keypoints, and
+            (nMkrs x nFrames) confidences, as in dataForReproj.
+        cams2UseReproj : list
+            Indices of the 2 cameras to compare; the lag is applied to the
+            second one.
+        cameras2Use : list
+            Camera names, only used for printing.
+        nTimesteps : int
+            Number of timesteps over which the error is averaged.
+            
+        """
+        self.cams2UseReproj = cams2UseReproj
+        self.cameras2Use = cameras2Use
+        self.nTimesteps = nTimesteps
+        self.keypoints = [keypointList[cam] for cam in cams2UseReproj]
+        self.confidence = [confidence[cam] for cam in cams2UseReproj]
+        self.cameraList = []
+        for cam in cams2UseReproj:
+            c = Camera()
+            c.set_K(CamParamList[cam]['intrinsicMat'])
+            c.set_R(CamParamList[cam]['rotation'])
+            c.set_t(np.reshape(CamParamList[cam]['translation'],(3,1)))
+            self.cameraList.append(c)
+        self.P = np.stack([c.P for c in self.cameraList])
+        self.cache = {}
+        
+        # Find the range of frames in which each camera confidently sees the
+        # person. This does not depend on the lag.
+        self.confRanges = []
+        for conf in self.confidence:
+            confThresh = .5*np.nanmax(conf)
+            temp = np.nanmean(conf,axis=0) > confThresh
+            if not True in temp:
+                self.confRanges = None
+                break
+            self.confRanges.append([np.argwhere(temp)[0,0], 
+                                    np.argwhere(temp)[-1,0]+1])
+    
+    def __call__(self, lagVal):
+        """Returns the reprojection error and success flag for one lag."""
+        return self.evaluate([lagVal])[0], self.confRanges is not None
+    
+    def evaluate(self, lags):
+        """Returns the reprojection errors for a sequence of lags."""
+        lags = [int(lag) for lag in lags]
+        if self.confRanges is None:
+            return np.full(len(lags), 0.1)
+        newLags = np.unique([lag for lag in lags if lag not in self.cache])
+        if len(newLags) > 0:
+            errors = self._compute(newLags)
+            self.cache.update(zip(newLags.tolist(), errors))
+        return np.array([self.cache[lag] for lag in lags])
+    
+    def _compute(self, lags):
+        nLags, nT = len(lags), self.nTimesteps
+        
+        # Shift second camera based on lag, so indices are "aligned," then 
+        # find overlapping range. Ignore the first and last few timesteps
+        # here as confidence drops.
+        r0, r1 = self.confRanges
+        overlapStart = np.maximum(r0[0], r1[0] - lags) + 3
+        overlapEnd = np.minimum(r0[1], r1[1] - lags) - 3
+        shiftedSampleInds = np.linspace(overlapStart, overlapEnd, nT, 
+                                        axis=1).astype(int)
+        sampleInds = [shiftedSampleInds, shiftedSampleInds + lags[:,None]]
+        
+        # nCams x nMkrs x (nLags*nT)
+        keypoints2D = np.stack([k[:,inds.flatten(),:] for k, inds in 
+                                zip(self.keypoints, sampleInds)])
+        conf = np.stack([c[:,inds.flatten()] for c, inds in 
+                         zip(self.confidence, sampleInds)])
+        nCams, nMkrs, nSamples, _ = keypoints2D.shape
+        
+        # Triangulate all lags and timesteps at once.
+        points3D, _ = nview_linear_triangulations_batch(
+            self.cameraList, keypoints2D.reshape(nCams, nMkrs*nSamples, 2),
+            weights=conf.reshape(nCams, nMkrs*nSamples))
+        
+        # Confidence-weighted reprojection error, normalized by the height
+        # of the bounding box.
+        reproj = np.einsum('cij,jn->cin', self.P, 
+                           np.vstack((points3D, np.ones((1, points3D.shape[1])))))
+        reproj = (reproj[:,:2,:] / reproj[:,2,None,:]).reshape(nCams, 2, nMkrs, nSamples)
+        confForWeights = np.nan_to_num(conf, nan=0)
+        reprojErrors = np.linalg.norm(
+            (reproj - np.moveaxis(keypoints2D, 3, 1)) * confForWeights[:,None], axis=1)
+        yVals = np.where(keypoints2D[...,1] > 0, keypoints2D[...,1], np.nan)
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', category=RuntimeWarning)
+            boxHeight = np.nanmax(yVals, axis=1) - np.nanmin(yVals, axis=1)
+        reprojErrors = np.mean(reprojErrors / boxHeight[:,None,:], axis=0)
+        
+        # Multiply minimum confidence between cameras times marker-wise reproj
+        # errors so we don't include errors for markers that had low
+        # confidence in one of the cameras.
+        minConf = np.min(confForWeights, axis=0)
+        minConf[minConf<0.5] = 0
+        weightedReprojErrors = reprojErrors * minConf
+        useMkrs = minConf > 0
+        with np.errstate(divide='ignore', invalid='ignore'):
+            meanErrors = (np.sum(np.where(useMkrs, weightedReprojErrors, 0), axis=0) /
+                          np.count_nonzero(useMkrs, axis=0))
+        # In cases where no position is confident set to large reproj error.
+        # Typical values are on the order of 0.1.
+        meanErrors[~np.any(weightedReprojErrors, axis=0)] = 1000
+        
+        return np.mean(meanErrors.reshape(nLags, nT), axis=1)
+    
+    def refineLag(self, lagCenter, numFrames, search='exhaustive'):
+        """Finds the lag within lagCenter +/- numFrames with the minimum 
+        reprojection error.
+        
+        Parameters
+        ----------
+        search : str
+            'exhaustive' evaluates every lag in the range. 'coarseToFine'
+            evaluates a coarse grid of lags and halves the step around the
+            best lag until it reaches 1 frame, which assumes the error is 
+            roughly unimodal within the range.
+            
+        Returns
+        -------
+        lag : int
+            The refined lag.
+        lags, reprojErrors : numpy.ndarray
+            The evaluated lags (sorted) and their reprojection errors.
+            
+        """
+        lagMin, lagMax = lagCenter - numFrames, lagCenter + numFrames
+        if search == 'exhaustive':
+            lags = np.arange(lagMin, lagMax+1)
+            reprojErrors = self.evaluate(lags)
+        elif search == 'coarseToFine':
+            step = max(1, numFrames // 4)
+            lags = np.unique(np.concatenate((np.arange(lagMin, lagMax+1, step),
+                                             [lagCenter, lagMax])))
+            while True:
+                reprojErrors = self.evaluate(lags)
+                bestLag = lags[np.argmin(reprojErrors)]
+                if step == 1:
+                    break
+                step = max(1, step // 2)
+                lags = np.arange(max(lagMin, bestLag - 2*step), 
+                                 min(lagMax, bestLag + 2*step) + 1, step)
+            lags = np.array(sorted(self.cache))
+            lags = lags[(lags >= lagMin) & (lags <= lagMax)]
+            reprojErrors = self.evaluate(lags)
+        else:
+            raise ValueError('Unknown lag search: {}'.format(search))
+        
+        lag = lags[np.argmin(reprojErrors)]
+        
+        return lag, lags, reprojErrors
+
+# %%
 def calcReprojectionErrorForSync(CamParamList, keypointList, lagVal,
                                  cams2UseReproj, confidence, cameras2Use):
     
     # Number of timesteps to triangulate. Will average reprojection error over all nTimesteps.
     nTimesteps = 5 
     
-    keypoints2D = copy.deepcopy(keypointList)
-    conf = copy.deepcopy(confidence)
-    CamParamListCopy = copy.deepcopy(CamParamList)
-    
-    # Find the range of overlapping confidence for this lag value
-    confSel = []
-    for cam in cams2UseReproj:
-        confSel.append(conf[cam])
-        
-    # find confidence ranges in original indices
-    confThresh = [.5*np.nanmax(c) for c in confSel] # Threshold for saying this camera confidently sees the person
-    avgConf = [np.nanmean(c,axis=0) for c in confSel]
-    
-    # Breakdown steps to catch potential error.
-    confRanges = []
-    for i,c in enumerate(avgConf):
-        temp = c > confThresh[i]
-        if True in temp:
-            confRanges.append(np.array([np.argwhere(temp)[0], np.argwhere(temp)[-1]+1]))
-        else:
-            reprojErrorAcrossFrames = 0.1
-            reprojSuccess = False
-            return reprojErrorAcrossFrames, reprojSuccess
-        
-    # shift second camera based on lag, so indices are "aligned," then find overlapping range
-    shiftedConfRanges = copy.deepcopy(confRanges)
-    shiftedConfRanges[1] = shiftedConfRanges[1] - lagVal # shift the indices for second camera
-    # Ignore the first and last few timesteps here as confidence drops
-    shiftedOverlapInds = [np.max((shiftedConfRanges[0][0],shiftedConfRanges[1][0]))+3,
-                          np.min((shiftedConfRanges[0][1],shiftedConfRanges[1][1]))-3]
-    
-    # Sample nTimesteps between the shifted Overlap Inds
-    shiftedSampleInds = np.linspace(shiftedOverlapInds[0],shiftedOverlapInds[1],nTimesteps).astype(int)
-    
-    sampleInds = []
-    sampleInds.append(shiftedSampleInds) # no shift for first camera
-    sampleInds.append(shiftedSampleInds + lagVal) # unshifts the indices for second camera
-    
-    # Select keypoints and confidence at appropriate timesteps
-    keypoints2DSelected = []
-    cameraListSelected = []
-    confListSelected = []
-    for iCam, cam in enumerate(cams2UseReproj):
-        keypoints2D[cam] = keypoints2D[cam][:,sampleInds[iCam],:]
-        conf[cam] = conf[cam][:,sampleInds[iCam]]
-        keypoints2DSelected.append(keypoints2D[cam])
-        cameraListSelected.append(CamParamListCopy[cam])
-        confListSelected.append(conf[cam])
-        
-    # Triangulate at each of the nTimesteps
-    # We here need to turn the lists back into dicts.
-    CamParamListCopy_dict = {}
-    keypoints2D_dict = {}
-    conf_dict = {}
-    for iCam, cam in enumerate(cameras2Use):
-        CamParamListCopy_dict[cam] = CamParamListCopy[iCam]
-        keypoints2D_dict[cam] = keypoints2D[iCam]
-        conf_dict[cam] = conf[iCam]
-    cameras2UseReproj = [cameras2Use[i] for i in cams2UseReproj]
-    keypoints3D, _ = triangulateMultiviewVideo(
-        CamParamListCopy_dict, keypoints2D_dict, ignoreMissingMarkers=False, 
-        cams2Use=cameras2UseReproj, confidenceDict=conf_dict,trimTrial=False)
-    
-    # Make list of camera objects
-    cameraObjList = []       
-    for camParams in cameraListSelected:
-        c = Camera()
-        c.set_K(camParams['intrinsicMat'])
-        c.set_R(camParams['rotation'])
-        c.set_t(np.reshape(camParams['translation'],(3,1)))
-        cameraObjList.append(c)
-        
-    # Compute confidence-weighted reprojection error for each of nTimesteps
-    reprojErrorVec = []
-    for tStep in range(nTimesteps):
-       
-        # Organize points for reprojectionError function
-        stackedPoints = np.stack([k[:,None,tStep,:] for k in keypoints2DSelected])
-        pointsInput = []
-        for i in range(stackedPoints.shape[1]):
-            pointsInput.append(stackedPoints[:,i,0,:].T)
-        
-        confForWeights = [c[:,None,tStep].T for c in confListSelected] # needs transpose for reprojection error function
-        confForWeights = [np.nan_to_num(c,nan=0) for c in confForWeights] # sometimes confidence has nans, don't want to use as weights in this case
-        
-        # Calculate combined reprojection error
-        key3D = np.squeeze(keypoints3D[:,:,tStep])
-        reprojErrors = calcReprojectionError(cameraObjList,pointsInput,key3D,
-                                             weights=confForWeights,normalizeError=True)
-        
-        # multiply minimum confidence between cameras times marker-wise reproj errors
-        # so we don't include errors for markers that had low confidence in one of the cameras
-        minConfVec = np.min(np.asarray(confForWeights), axis=0)
-        minConfVec[np.where(minConfVec<0.5)] = 0 # Set low conf markers to 0
-        weightedReprojErrors = np.multiply(reprojErrors,minConfVec)
-        if np.any(weightedReprojErrors):
-            reprojErrorVec.append(np.mean(weightedReprojErrors[minConfVec>0]))
-        else:
-            reprojErrorVec.append(1000) # in cases where no position is confident set to large reproj error. typical values are on the order of  0.1
-        
-    reprojErrorAcrossFrames = np.mean(reprojErrorVec)
-    reprojSuccess = True    
+    reprojErrorForSync = ReprojectionErrorForSync(
+        CamParamList, keypointList, cams2UseReproj, confidence, cameras2Use,
+        nTimesteps=nTimesteps)
+    reprojErrorAcrossFrames, reprojSuccess = reprojErrorForSync(lagVal)
     
     return reprojErrorAcrossFrames, reprojSuccess
 
@@ -2966,36 +3205,18 @@ def findOverlap(confidenceList, markers4VertVel):
 def loadPklVideo(pklPath, videoFullPath, imageBasedTracker=False, poseDetector='OpenPose',
                  confidenceThresholdForBB=0.3, visualizeKeypointAnimation=False):
     
-    open_file = open(pklPath, "rb")
-    frames = pickle.load(open_file)
-    open_file.close()
-
-    nFrames = len(frames)
+    # Loads the keypoint store if it exists, otherwise the legacy pickle.
+    # keypoints is nFrames x nPeople x 25 x 3, with nans for people that are
+    # not detected in a frame.
+    keypoints = loadPoseKeypoints(pklPath)
+    nFrames, nPeople = keypoints.shape[:2]
 
-    # Read in JSON files.
-    allPeople = []
-    iPerson = 0
-    anotherPerson = True
-    
-    while anotherPerson is True:             
-        anotherPerson = False
-        res = np.zeros((nFrames, 75))
-        res[:] = np.nan
-        
-        for c_frame, frame in enumerate(frames):    
-            # Get this persons keypoints if they exist.
-            if len(frame) > iPerson:
-                person = frame[iPerson]
-                keypoints = person['pose_keypoints_2d']
-                res[c_frame,:] = keypoints
-            
-            # See if there are more people.
-            if len(frame) > iPerson+1:
-                # If there was someone else in any frame, loop again.
-                anotherPerson = True 
-        
-        allPeople.append(res.copy())
-        iPerson +=1     
+    # One nFrames x 75 array per person, there is at least one person.
+    if nPeople == 0:
+        allPeople = [np.full((nFrames, 75), np.nan)]
+    else:
+        allPeople = [keypoints[:,iPerson].reshape(nFrames, 75).astype(float)
+                     for iPerson in range(nPeople)]
         
     # Creates a browser animation of the data in each person detected. This
     # may not be continuous yet. That happens later with person tracking.
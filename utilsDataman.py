@@ -5,13 +5,62 @@ import warnings
 from scipy.spatial.transform import Rotation as R
 
 import numpy as np
-from numpy.lib.recfunctions import append_fields
+import pandas as pd
 
+# %%
+def readTRCData(fpath, num_markers, skiprows=5):
+    """Reads the data rows of a TRC file in a single vectorized pass.
+
+    Returns
+    -------
+    time : (num_frames,) array
+    marker_data : (num_frames x num_markers x 3) array
+
+    """
+    # The C parser of pandas is much faster than np.loadtxt; blank lines and
+    # trailing tabs are ignored.
+    data = pd.read_csv(fpath, sep='\t', header=None, skiprows=skiprows,
+                       usecols=range(3 * num_markers + 2), dtype=np.float64,
+                       engine='c', skip_blank_lines=True).to_numpy()
+    time = np.ascontiguousarray(data[:, 1])
+    marker_data = np.ascontiguousarray(
+        data[:, 2:].reshape(data.shape[0], num_markers, 3))
+
+    return time, marker_data
+
+# %%
+def writeTRCData(f, time, marker_data, timeFormat='%.7f', dataFormat='%.7f',
+                 trailingTab=False, chunkSize=2048):
+    """Writes the data rows of a TRC file, ie frame number, time, and marker
+    coordinates, formatting blocks of rows at once.
+
+    """
+    num_frames = marker_data.shape[0]
+    num_columns = 3 * marker_data.shape[1]
+    if trailingTab:
+        rowFormat = ('%i\t' + timeFormat + '\t' +
+                     (dataFormat + '\t') * num_columns + '\n')
+    else:
+        rowFormat = ('%i\t' + timeFormat +
+                     ('\t' + dataFormat) * num_columns + '\n')
+    data = np.empty((num_frames, num_columns + 2))
+    data[:, 0] = np.arange(1, num_frames + 1)
+    data[:, 1] = time
+    data[:, 2:] = marker_data.reshape(num_frames, num_columns)
+    for start in range(0, num_frames, chunkSize):
+        block = data[start:start + chunkSize]
+        f.write((rowFormat * block.shape[0]) % tuple(block.ravel().tolist()))
+
+# %%
 class TRCFile(object):
     """A plain-text file format for storing motion capture marker trajectories.
     TRC stands for Track Row Column.
 
-    The metadata for the file is stored in attributes of this object.
+    The metadata for the file is stored in attributes of this object. The
+    marker trajectories are stored in a contiguous
+    (num_frames x num_markers x 3) array, see `marker_data`, that is
+    over-allocated along the marker axis such that markers can be added
+    without reallocating the array for each marker.
 
     See
     http://simtk-confluence.stanford.edu:8080/display/OpenSim/Marker+(.trc)+Files
@@ -39,6 +88,8 @@ class TRCFile(object):
 
         """
         self.marker_names = []
+        self._marker_index = {}
+        self._marker_data = None
         if fpath != None:
             self.read_from_file(fpath)
         else:
@@ -77,9 +128,9 @@ class TRCFile(object):
 
         # Marker names.
         # The first and second column names are 'Frame#' and 'Time'.
-        self.marker_names = fourth_line[2:]
+        marker_names = fourth_line[2:]
 
-        len_marker_names = len(self.marker_names)
+        len_marker_names = len(marker_names)
         if len_marker_names != self.num_markers:
             warnings.warn('Header entry NumMarkers, %i, does not '
                     'match actual number of markers, %i. Changing '
@@ -89,17 +140,10 @@ class TRCFile(object):
 
         # Load the actual data.
         # ---------------------
-        col_names = ['frame_num', 'time']
-        # This naming convention comes from OpenSim's Inverse Kinematics tool,
-        # when it writes model marker locations.
-        for mark in self.marker_names:
-            col_names += [mark + '_tx', mark + '_ty', mark + '_tz']
-        dtype = {'names': col_names,
-                'formats': ['int'] + ['float64'] * (3 * self.num_markers + 1)}
-        usecols = [i for i in range(3 * self.num_markers + 1 + 1)]
-        self.data = np.loadtxt(fpath, delimiter='\t', skiprows=5, dtype=dtype,
-                               usecols=usecols)
-        self.time = self.data['time']
+        self.time, marker_data = readTRCData(fpath, self.num_markers)
+        self.marker_names = marker_names
+        self._marker_index = {name: i for i, name in enumerate(marker_names)}
+        self._marker_data = marker_data
 
         # Check the number of rows.
         n_rows = self.time.shape[0]
@@ -110,30 +154,66 @@ class TRCFile(object):
                         self.num_frames, n_rows))
             self.num_frames = n_rows
 
+    @property
+    def marker_data(self):
+        """The trajectories of all markers, given as a
+        `self.num_frames` x `self.num_markers` x 3 array (view).
+
+        """
+        if self._marker_data is None:
+            return np.empty((getattr(self, 'num_frames', 0), 0, 3))
+        return self._marker_data[:, :len(self.marker_names)]
+
+    @property
+    def data(self):
+        """Structured view of the marker trajectories, with fields
+        '<marker>_tx', '<marker>_ty', and '<marker>_tz', kept for backward
+        compatibility. Writing to the view modifies the marker trajectories.
+
+        """
+        names, offsets = [], []
+        for imark, mark in enumerate(self.marker_names):
+            for icoord, coord in enumerate('xyz'):
+                names.append('%s_t%s' % (mark, coord))
+                offsets.append(8 * (3 * imark + icoord))
+        capacity = self._marker_data.shape[1]
+        dtype = np.dtype({'names': names, 'formats': ['float64'] * len(names),
+                          'offsets': offsets, 'itemsize': 8 * 3 * capacity})
+        return self._marker_data.reshape(
+            self._marker_data.shape[0], 3 * capacity).view(dtype)[:, 0]
+
     def __getitem__(self, key):
         """See `marker()`.
 
         """
         return self.marker(key)
-    
+
     def units(self):
         return self.units
-    
+
     def time(self):
         this_dat = np.empty((self.num_frames, 1))
         this_dat[:, 0] = self.time
-        return this_dat        
+        return this_dat
 
     def marker(self, name):
         """The trajectory of marker `name`, given as a `self.num_frames` x 3
         array. The order of the columns is x, y, z.
 
         """
-        this_dat = np.empty((self.num_frames, 3))
-        this_dat[:, 0] = self.data[name + '_tx']
-        this_dat[:, 1] = self.data[name + '_ty']
-        this_dat[:, 2] = self.data[name + '_tz']
-        return this_dat
+        return self._marker_data[:, self._marker_index[name]].copy()
+
+    def _reserve(self, num_new_markers):
+        # Grows the marker axis geometrically when the capacity is exceeded.
+        num_markers = len(self.marker_names)
+        if self._marker_data is None:
+            self._marker_data = np.empty((self.num_frames, num_new_markers, 3))
+        elif num_markers + num_new_markers > self._marker_data.shape[1]:
+            capacity = max(num_markers + num_new_markers,
+                           2 * self._marker_data.shape[1])
+            marker_data = np.empty((self.num_frames, capacity, 3))
+            marker_data[:, :num_markers] = self._marker_data[:, :num_markers]
+            self._marker_data = marker_data
 
     def add_marker(self, name, x, y, z):
         """Add a marker, with name `name` to the TRCFile.
@@ -151,22 +231,40 @@ class TRCFile(object):
                 self.num_frames):
             raise Exception('Length of data (%i, %i, %i) is not '
                     'NumFrames (%i).', len(x), len(y), len(z), self.num_frames)
-        self.marker_names += [name]
-        self.num_markers += 1
-        if not hasattr(self, 'data'):
-            self.data = np.array(x, dtype=[('%s_tx' % name, 'float64')])
-            self.data = append_fields(self.data,
-                    ['%s_t%s' % (name, s) for s in 'yz'],
-                    [y, z], usemask=False)
-        else:
-            self.data = append_fields(self.data,
-                    ['%s_t%s' % (name, s) for s in 'xyz'],
-                    [x, y, z], usemask=False)
+        self.add_markers([name], np.stack((x, y, z), axis=1)[:, np.newaxis, :])
+
+    def add_markers(self, names, marker_data):
+        """Add several markers at once to the TRCFile.
+
+        Parameters
+        ----------
+        names : list of str
+            Names of the markers.
+        marker_data: array_like
+            Marker trajectories, given as a `self.num_frames` x `len(names)`
+            x 3 array.
+
+        """
+        marker_data = np.asarray(marker_data, dtype=np.float64)
+        if marker_data.shape != (self.num_frames, len(names), 3):
+            raise Exception('Shape of data %s is not (NumFrames, %i, 3).' % (
+                str(marker_data.shape), len(names)))
+        for name in names:
+            if name in self._marker_index:
+                raise ValueError('Marker %s already exists.' % name)
+        self._reserve(len(names))
+        num_markers = len(self.marker_names)
+        self._marker_data[:, num_markers:num_markers+len(names)] = marker_data
+        for name in names:
+            self._marker_index[name] = len(self.marker_names)
+            self.marker_names.append(name)
+        self.num_markers = len(self.marker_names)
 
     def marker_at(self, name, time):
-        x = np.interp(time, self.time, self.data[name + '_tx'])
-        y = np.interp(time, self.time, self.data[name + '_ty'])
-        z = np.interp(time, self.time, self.data[name + '_tz'])
+        trajectory = self._marker_data[:, self._marker_index[name]]
+        x = np.interp(time, self.time, trajectory[:, 0])
+        y = np.interp(time, self.time, trajectory[:, 1])
+        z = np.interp(time, self.time, trajectory[:, 2])
         return [x, y, z]
 
     def marker_exists(self, name):
@@ -205,28 +303,21 @@ class TRCFile(object):
 
         # Line 4.
         f.write('Frame#\tTime\t')
-        for imark in range(self.num_markers):
-            f.write('%s\t\t\t' % self.marker_names[imark])
+        f.write(''.join('%s\t\t\t' % self.marker_names[imark]
+                        for imark in range(self.num_markers)))
         f.write('\n')
 
         # Line 5.
         f.write('\t\t')
-        for imark in np.arange(self.num_markers) + 1:
-            f.write('X%i\tY%s\tZ%s\t' % (imark, imark, imark))
+        f.write(''.join('X%i\tY%s\tZ%s\t' % (imark, imark, imark)
+                        for imark in np.arange(self.num_markers) + 1))
         f.write('\n')
 
         # Line 6.
         f.write('\n')
 
         # Data.
-        for iframe in range(self.num_frames):
-            f.write('%i' % (iframe + 1))
-            f.write('\t%.7f' % self.time[iframe])
-            for mark in self.marker_names:
-                idxs = [mark + '_tx', mark + '_ty', mark + '_tz']
-                f.write('\t%.7f\t%.7f\t%.7f' % tuple(
-                    self.data[coln][iframe] for coln in idxs))
-            f.write('\n')
+        writeTRCData(f, self.time, self.marker_data)
 
         f.close()
 
@@ -237,46 +328,36 @@ class TRCFile(object):
 
             noise_width : int
         """
-        for imarker in range(self.num_markers):
-            components = ['_tx', '_ty', '_tz']
-            for iComponent in range(3):
-                # generate noise
-                noise = np.random.normal(0, noise_width, self.num_frames)
-                # add noise to each component of marker data.
-                self.data[self.marker_names[imarker] + components[iComponent]] += noise
-                
+        # Noise is drawn in the same order as when looping over markers and
+        # components.
+        noise = np.random.normal(0, noise_width,
+                                 (self.num_markers, 3, self.num_frames))
+        self._marker_data[:, :self.num_markers] += noise.transpose(2, 0, 1)
+
     def rotate(self, axis, value):
         """ rotate the data.
 
             axis : rotation axis
             value : angle in degree
         """
-        for imarker in range(self.num_markers):   
-            
-            temp = np.zeros((self.num_frames, 3))
-            temp[:,0] = self.data[self.marker_names[imarker] + '_tx']
-            temp[:,1] = self.data[self.marker_names[imarker] + '_ty']
-            temp[:,2] = self.data[self.marker_names[imarker] + '_tz']          
-            
-            r = R.from_euler(axis, value, degrees=True)            
-            temp_rot = r.apply(temp)
-            
-            self.data[self.marker_names[imarker] + '_tx'] = temp_rot[:,0]
-            self.data[self.marker_names[imarker] + '_ty'] = temp_rot[:,1]
-            self.data[self.marker_names[imarker] + '_tz'] = temp_rot[:,2]
-            
+        marker_data = self.marker_data
+        if marker_data.size == 0:
+            return
+        r = R.from_euler(axis, value, degrees=True)
+        marker_data[:] = r.apply(marker_data.reshape(-1, 3)).reshape(
+            marker_data.shape)
+
     def offset(self, axis, value):
         """ offset the data.
 
             axis : rotation axis
             value : offset in m
         """
-        for imarker in range(self.num_markers):            
-            if axis.lower() == 'x':
-                self.data[self.marker_names[imarker] + '_tx'] += value
-            elif axis.lower() == 'y':
-                self.data[self.marker_names[imarker] + '_ty'] += value       
-            elif axis.lower() == 'z':
-                self.data[self.marker_names[imarker] + '_tz'] += value          
-            else:
-                raise ValueError("Axis not recognized")
+        if axis.lower() == 'x':
+            self.marker_data[:, :, 0] += value
+        elif axis.lower() == 'y':
+            self.marker_data[:, :, 1] += value
+        elif axis.lower() == 'z':
+            self.marker_data[:, :, 2] += value
+        else:
+            raise ValueError("Axis not recognized")
@@ -7,18 +7,39 @@ import json
 import sys
 import time
 import platform # To check for windows/Linux
+import subprocess
+import threading
+from contextlib import nullcontext
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from decouple import config
 
 from utils import getOpenPoseMarkerNames, getMMposeMarkerNames, getVideoExtension
 from utilsChecker import getVideoRotation
+from utilsPoseServer import isPoseServerAvailable, runPoseServerJob
+from utilsKeypointStore import (getKeypointStorePath, findPoseKeypointsPath,
+                                isKeypointStore, savePoseKeypoints,
+                                OpenPoseJsonIngestor)
+
+# The docker-compose handoff goes through fixed file names in /data, which the
+# pose detection containers watch. Videos are handed off one at a time, since
+# cameras and trials may be processed concurrently.
+_dockerHandoffLock = threading.Lock()
 
 # %%
 def runPoseDetector(CameraDirectories, trialRelativePath, pathPoseDetector,
                     trialName,
                     CamParamDict=None, resolutionPoseDetection='default',
                     generateVideo=True, cams2Use=['all'],
-                    poseDetector='OpenPose', bbox_thr=0.8, forceRedoPoseEstimation=False ):
+                    poseDetector='OpenPose', bbox_thr=0.8, forceRedoPoseEstimation=False,
+                    parallelCameras=True, detectorConcurrency=1, nProcesses=None,
+                    returnMetadata=False):
          
+    # If parallelCameras, cameras are processed concurrently: the CPU-bound
+    # stages (video rotation, pose post-processing) run in a process pool of
+    # nProcesses workers, whereas at most detectorConcurrency cameras run the
+    # pose detector at the same time. The docker-compose handoff only 
+    # supports detectorConcurrency=1. If returnMetadata, also returns a dict
+    # with the per-camera, per-stage timings.
     
     # Create list of cameras.
     if cams2Use[0] == 'all':
@@ -39,24 +60,93 @@ def runPoseDetector(CameraDirectories, trialRelativePath, pathPoseDetector,
     extension = getVideoExtension(pathVideoWithoutExtension)            
     trialRelativePath += extension
         
-    for camName in CameraDirectories_selectedCams:
-        cameraDirectory = CameraDirectories_selectedCams[camName]
+    timings = {camName: {} for camName in CameraDirectories_selectedCams}
+    
+    def runCamera(camName, processPool=None, detectorSemaphore=None):
+        # Absolute path, since OpenPose runs from its own directory.
+        cameraDirectory = os.path.abspath(
+            CameraDirectories_selectedCams[camName])
         print('Running {} for {}'.format(poseDetector, camName))
         if poseDetector == 'OpenPose':
             runOpenPoseVideo(
                 cameraDirectory,trialRelativePath,pathPoseDetector, trialName,
                 resolutionPoseDetection=resolutionPoseDetection,
-                generateVideo=generateVideo, forceRedoPoseEstimation = forceRedoPoseEstimation)
+                generateVideo=generateVideo, forceRedoPoseEstimation = forceRedoPoseEstimation,
+                processPool=processPool, detectorSemaphore=detectorSemaphore,
+                timings=timings[camName])
         elif poseDetector == 'mmpose':
             runMMposeVideo(
                 cameraDirectory,trialRelativePath,pathPoseDetector, trialName,
-                generateVideo=generateVideo, bbox_thr=bbox_thr, forceRedoPoseEstimation = forceRedoPoseEstimation)
+                generateVideo=generateVideo, bbox_thr=bbox_thr, forceRedoPoseEstimation = forceRedoPoseEstimation,
+                processPool=processPool, detectorSemaphore=detectorSemaphore,
+                timings=timings[camName])
+    
+    start = time.time()
+    nCams = len(CameraDirectories_selectedCams)
+    if parallelCameras and nCams > 1:
+        if nProcesses is None:
+            nProcesses = min(nCams, os.cpu_count() or 1)
+        detectorSemaphore = threading.Semaphore(detectorConcurrency)
+        with ProcessPoolExecutor(max_workers=nProcesses) as processPool:
+            # The first task forks all worker processes. Run it before the
+            # camera threads start, as forking while other threads run can
+            # copy locks they hold into the workers.
+            processPool.submit(os.getpid).result()
+            with ThreadPoolExecutor(max_workers=nCams) as cameraPool:
+                futures = [cameraPool.submit(runCamera, camName, processPool,
+                                             detectorSemaphore)
+                           for camName in CameraDirectories_selectedCams]
+                # Raise the first exception, if any.
+                for future in futures:
+                    future.result()
+    else:
+        for camName in CameraDirectories_selectedCams:
+            runCamera(camName)
+    wallTime = time.time() - start
+    
+    for camName, camTimings in timings.items():
+        print('{} timings (s): {}'.format(camName, ', '.join(
+            ['{} {:.1f}'.format(stage, t) for stage, t in camTimings.items()])))
+    print('Pose detection took {:.1f} s.'.format(wallTime))
             
+    if returnMetadata:
+        return extension, {'timings': timings, 'wallTime': wallTime}
+    
     return extension
+
+# %%
+def runStage(func, *args, processPool=None, timings=None, stage=None):
+    # Runs func(*args), in processPool if provided, and stores its duration.
+    start = time.time()
+    if processPool is None:
+        out = func(*args)
+    else:
+        out = processPool.submit(func, *args).result()
+    if timings is not None:
+        timings[stage] = time.time() - start
+    
+    return out
+
+# %%
+def rotateVideo(videoFullPath, pathVideoRot):
+    # The video is rewritten, unrotated. There is no need to do anything
+    # specific for the rotation, just rewriting the video unrotates it.
+    cmd_fr = ' '
+    CMD = "ffmpeg -loglevel error -y -i {}{}-q 0 {}".format(
+        videoFullPath, cmd_fr, pathVideoRot)
+    
+    if not os.path.exists(pathVideoRot):
+        os.system(CMD)
             
 # %%
 def runOpenPoseVideo(cameraDirectory,fileName,pathOpenPose, trialName,
-                     resolutionPoseDetection='default', generateVideo=True, forceRedoPoseEstimation=False):
+                     resolutionPoseDetection='default', generateVideo=True, forceRedoPoseEstimation=False,
+                     streamJsons=True, processPool=None, detectorSemaphore=None,
+                     timings=None):
+    
+    # If streamJsons, the OpenPose JSONs are parsed while OpenPose writes
+    # them, instead of once OpenPose is done. See runPoseDetector for 
+    # processPool, detectorSemaphore, and timings.
     
     trialPrefix, _ = os.path.splitext(os.path.basename(fileName)) 
     videoFullPath = os.path.normpath(os.path.join(cameraDirectory, fileName))
@@ -94,63 +184,76 @@ def runOpenPoseVideo(cameraDirectory,fileName,pathOpenPose, trialName,
     trialPath, _ = os.path.splitext(fileName)        
     fileName = trialPath + "_rotated.avi"
     pathVideoRot = os.path.normpath(os.path.join(cameraDirectory, fileName))
-    cmd_fr = ' '
     # frameRate = np.round(thisVideo.get(cv2.CAP_PROP_FPS))
     # if frameRate > 60.0: # previously downsampled for efficiency
     #     cmd_fr = ' -r 60 '
     #     frameRate = 60.0  
-    CMD = "ffmpeg -loglevel error -y -i {}{}-q 0 {}".format(
-        videoFullPath, cmd_fr, pathVideoRot)
+    runStage(rotateVideo, videoFullPath, pathVideoRot, 
+             processPool=processPool, timings=timings, stage='rotation')
         
     videoFullPath = pathVideoRot
     trialPrefix = trialPrefix + "_rotated"
-    
-    if not os.path.exists(pathVideoRot):
-        os.system(CMD)
 
     # Run OpenPose if this file doesn't exist in outputs
     ppPklPath = os.path.join(pathOutputPkl, trialPrefix + '_pp.pkl')   
-    if not os.path.exists(ppPklPath) or forceRedoPoseEstimation:
+    ppStorePath = getKeypointStorePath(ppPklPath)
+    if findPoseKeypointsPath(ppPklPath) is None or forceRedoPoseEstimation:
         print("path does not already exists...")
-        c_path = os.getcwd()
-        command = runOpenPoseCMD(
-            pathOpenPose, resolutionPoseDetection, cameraDirectory,
-            fileName, openposeJsonDir, pathOutputVideo, trialPrefix,
-            generateVideo, videoFullPath, pathOutputJsons)
-        
-        if not pathOpenPose == "docker":
-            os.chdir(c_path)            
-        # Get number of frames output video. We count the number of jsons, as
-        # videos are not written on server.
-        nFrameOut = len([f for f in os.listdir(pathOutputJsons) 
-                         if f.endswith('.json')])
-        # At high resolution, sometimes OpenPose does not process the full
-        # video, let's check here and try max 5 times. If still bad, then raise
-        # an exception.
-        checknFrames = False
-        if not resolutionPoseDetection == 'default' and checknFrames:
-            countFrames = 0
-            while nFrameIn != nFrameOut:
-                # Need to get command again, as there is os.chdir(pathOpenPose)
-                # in the function.
-                command = runOpenPoseCMD(pathOpenPose, resolutionPoseDetection,
-                                         cameraDirectory, fileName, 
-                                         openposeJsonDir, pathOutputVideo,
-                                         trialPrefix, generateVideo,
-                                         videoFullPath, pathOutputJsons)
-
-                if not pathOpenPose == "docker":
-                    os.chdir(c_path)
-                nFrameOut = len([f for f in os.listdir(pathOutputJsons) 
-                                 if f.endswith('.json')])
-                if countFrames > 4:
-                    print('# frames in {} - # frames out {}'.format(nFrameIn,
-                                                                    nFrameOut))
-                    raise ValueError('OpenPose did not process the full video')
-                countFrames += 1
+        if streamJsons:
+            jsonIngestor = OpenPoseJsonIngestor(pathOutputJsons, 
+                                                nFrames=nFrameIn)
+        else:
+            jsonIngestor = None
+        # Leaving the with block stops the parsing threads, also if OpenPose
+        # or the parsing fails.
+        with jsonIngestor or nullcontext():
+            with detectorSemaphore or nullcontext():
+                startDetection = time.time()
+                command = runOpenPoseCMD(
+                    pathOpenPose, resolutionPoseDetection, cameraDirectory,
+                    fileName, openposeJsonDir, pathOutputVideo, trialPrefix,
+                    generateVideo, videoFullPath, pathOutputJsons,
+                    jsonIngestor=jsonIngestor)
+            if timings is not None:
+                timings['detection'] = time.time() - startDetection
+            # Get number of frames output video. We count the number of jsons, as
+            # videos are not written on server.
+            nFrameOut = len([f for f in os.listdir(pathOutputJsons) 
+                             if f.endswith('.json')])
+            # At high resolution, sometimes OpenPose does not process the full
+            # video, let's check here and try max 5 times. If still bad, then raise
+            # an exception.
+            checknFrames = False
+            if not resolutionPoseDetection == 'default' and checknFrames:
+                countFrames = 0
+                # Re-runs write the JSONs again, parse them once done.
+                if jsonIngestor is not None and nFrameIn != nFrameOut:
+                    jsonIngestor.finish()
+                    jsonIngestor = None
+                while nFrameIn != nFrameOut:
+                    command = runOpenPoseCMD(pathOpenPose, resolutionPoseDetection,
+                                             cameraDirectory, fileName, 
+                                             openposeJsonDir, pathOutputVideo,
+                                             trialPrefix, generateVideo,
+                                             videoFullPath, pathOutputJsons)
+                    nFrameOut = len([f for f in os.listdir(pathOutputJsons) 
+                                     if f.endswith('.json')])
+                    if countFrames > 4:
+                        print('# frames in {} - # frames out {}'.format(nFrameIn,
+                                                                        nFrameOut))
+                        raise ValueError('OpenPose did not process the full video')
+                    countFrames += 1
             
-        # Gather data from jsons in pkl file.    
-        saveJsonsAsPkl(pathOutputJsons, ppPklPath, trialPrefix)
+            # Gather data from jsons in keypoint store.    
+            if jsonIngestor is not None:
+                runStage(lambda: savePoseKeypoints(
+                    ppStorePath, keypoints=jsonIngestor.finish(), 
+                    poseDetector='OpenPose', markerNames=getOpenPoseMarkerNames()),
+                    timings=timings, stage='postprocessing')
+            else:
+                runStage(saveJsonsAsPkl, pathOutputJsons, ppStorePath, trialPrefix,
+                         processPool=processPool, timings=timings, 
+                         stage='postprocessing')
         
         # Delete jsons
         shutil.rmtree(pathJsonDir)
@@ -160,7 +263,11 @@ def runOpenPoseVideo(cameraDirectory,fileName,pathOpenPose, trialName,
 # %%
 def runOpenPoseCMD(pathOpenPose, resolutionPoseDetection, cameraDirectory,
                    fileName, openposeJsonDir, pathOutputVideo, trialPrefix, 
-                   generateVideo, videoFullPath, pathOutputJsons):
+                   generateVideo, videoFullPath, pathOutputJsons,
+                   jsonIngestor=None):
+    
+    # jsonIngestor (OpenPoseJsonIngestor) is started before OpenPose runs,
+    # such that the JSONs get parsed while OpenPose writes them.
     
     rotation = getVideoRotation(videoFullPath)
     if rotation in [0,180]: 
@@ -169,6 +276,7 @@ def runOpenPoseCMD(pathOpenPose, resolutionPoseDetection, cameraDirectory,
         horizontal = False
     
     command = None
+    commandDirectory = None
     if resolutionPoseDetection == 'default':
         cmd_hr = ' '
     elif resolutionPoseDetection == '1x1008_4scales':
@@ -188,36 +296,49 @@ def runOpenPoseCMD(pathOpenPose, resolutionPoseDetection, cameraDirectory,
             cmd_hr = ' --net_resolution "736x-1" --scale_number 2 --scale_gap 0.75 '
         
     if config("DOCKERCOMPOSE", cast=bool, default=False):
-        vid_path_tmp = "/data/tmp-video.mov"
-        vid_path = "/data/video_openpose.mov"
+        with _dockerHandoffLock:
+            vid_path_tmp = "/data/tmp-video.mov"
+            vid_path = "/data/video_openpose.mov"
+        
+            # copy the video to vid_path_tmp
+            shutil.copy(f"{cameraDirectory}/{fileName}", vid_path_tmp)
         
-        # copy the video to vid_path_tmp
-        shutil.copy(f"{cameraDirectory}/{fileName}", vid_path_tmp)
+            # Parse the JSONs directly from the shared output folder. Ignore the
+            # JSONs from the previous video, which are only removed once the 
+            # OpenPose container picks up this video.
+            if jsonIngestor is not None:
+                jsonIngestor.start("/data/output_openpose", minMtime=time.time())
         
-        # rename the video to vid_path
-        os.rename(vid_path_tmp, vid_path)
+            # rename the video to vid_path
+            os.rename(vid_path_tmp, vid_path)
 
-        try:
-            # wait until the video is processed (i.e. until the video is removed -- then json should be ready)
-            start = time.time()
-            while True:
-                if not os.path.isfile(vid_path):
-                    break
+            try:
+                # wait until the video is processed (i.e. until the video is removed -- then json should be ready)
+                start = time.time()
+                while True:
+                    if not os.path.isfile(vid_path):
+                        break
                 
-                if start + 60*60 < time.time():
-                    raise Exception("Pose detection timed out. This is unlikely to be your fault, please report this issue on the forum. You can proceed with your data collection (videos are uploaded to the server) and later reprocess errored trials.", 'timeout - openpose')
+                    if start + 60*60 < time.time():
+                        raise Exception("Pose detection timed out. This is unlikely to be your fault, please report this issue on the forum. You can proceed with your data collection (videos are uploaded to the server) and later reprocess errored trials.", 'timeout - openpose')
                 
-                time.sleep(0.1)
+                    time.sleep(0.1)
             
-            # copy /data/output to openposeJsonDir
-            os.system("cp /data/output_openpose/* {cameraDirectory}/{openposeJsonDir}/".format(cameraDirectory=cameraDirectory, openposeJsonDir=openposeJsonDir))
+                # Parse the remaining JSONs before the next video is handed
+                # off, which clears /data/output_openpose.
+                if jsonIngestor is not None:
+                    jsonIngestor.stop()
+                
+                # copy /data/output to openposeJsonDir, unless already parsed
+                if jsonIngestor is None:
+                    os.system("cp /data/output_openpose/* {cameraDirectory}/{openposeJsonDir}/".format(cameraDirectory=cameraDirectory, openposeJsonDir=openposeJsonDir))
         
-        except Exception as e:
-            if len(e.args) == 2: # specific exception
-                raise Exception(e.args[0], e.args[1])
-            elif len(e.args) == 1: # generic exception
-                exception = "Pose detection failed. Verify your setup and try again. Visit https://www.opencap.ai/best-pratices to learn more about data collection and https://www.opencap.ai/troubleshooting for potential causes for a failed neutral pose."
-                raise Exception(exception, exception)   
+            except Exception as e:
+                if len(e.args) == 2: # specific exception
+                    raise Exception(e.args[0], e.args[1])
+                elif len(e.args) == 1: # generic exception
+                    exception = "Pose detection failed. Verify your setup and try again. Visit https://www.opencap.ai/best-pratices to learn more about data collection and https://www.opencap.ai/troubleshooting for potential causes for a failed neutral pose."
+                    raise Exception(exception, exception)   
             
     elif pathOpenPose == "docker":
         print("for some reason path is docker")
@@ -230,7 +351,9 @@ def runOpenPoseCMD(pathOpenPose, resolutionPoseDetection, cameraDirectory,
                                         openposeJsonDir, cmd_hr)
     else:
         print('"pathOpenPose" is {}'.format(pathOpenPose))
-        os.chdir(pathOpenPose)
+        # OpenPose runs from its own directory. The working directory of
+        # this process is left unchanged, as other cameras may be running.
+        commandDirectory = pathOpenPose
         pathVideoOut = os.path.join(pathOutputVideo,
                                     trialPrefix + 'withKeypoints.avi')
         
@@ -246,7 +369,9 @@ def runOpenPoseCMD(pathOpenPose, resolutionPoseDetection, cameraDirectory,
     if command:
         print("Command is: ")
         print(command)
-        os.system(command)
+        if jsonIngestor is not None:
+            jsonIngestor.start()
+        subprocess.run(command, shell=True, cwd=commandDirectory)
     
     return
 
@@ -258,9 +383,12 @@ def runMMposeVideo(
         model_ckpt_person='faster_rcnn_r50_fpn_1x_coco_20200130-047c8118.pth',                  
         model_config_pose='hrnet_w48_coco_wholebody_384x288_dark_plus.py',
         model_ckpt_pose='hrnet_w48_coco_wholebody_384x288_dark-f5726563_20200918.pth',
-        forceRedoPoseEstimation = False
+        forceRedoPoseEstimation = False, processPool=None, detectorSemaphore=None,
+        timings=None
         ):
     
+    # See runPoseDetector for processPool, detectorSemaphore, and timings.
+    
     trialPrefix, _ = os.path.splitext(os.path.basename(fileName))
     videoFullPath = os.path.normpath(os.path.join(cameraDirectory, fileName))    
     
@@ -288,95 +416,135 @@ def runMMposeVideo(
     trialPath, _ = os.path.splitext(fileName)        
     fileName = trialPath + "_rotated.avi"
     pathVideoRot = os.path.normpath(os.path.join(cameraDirectory, fileName))  
-    cmd_fr = ' '
     # if frameRate > 60.0:
     #     cmd_fr = ' -r 60 '
     #     frameRate = 60.0  
-    CMD = "ffmpeg -loglevel error -y -i {}{}-q 0 {}".format(
-        videoFullPath, cmd_fr, pathVideoRot)
+    runStage(rotateVideo, videoFullPath, pathVideoRot, 
+             processPool=processPool, timings=timings, stage='rotation')
         
     videoFullPath = pathVideoRot
     trialPrefix = trialPrefix + "_rotated"
-    
-    if not os.path.exists(pathVideoRot):
-        os.system(CMD)
  
     pklPath = os.path.join(pathOutputPkl, trialPrefix + '.pkl')
     ppPklPath = os.path.join(pathOutputPkl, trialPrefix + '_pp.pkl')
+    ppStorePath = getKeypointStorePath(ppPklPath)
     # Run pose detector if this file doesn't exist in outputs
-    if not os.path.exists(ppPklPath) or forceRedoPoseEstimation:
-        if config("DOCKERCOMPOSE", cast=bool, default=False):
+    if findPoseKeypointsPath(ppPklPath) is None or forceRedoPoseEstimation:
+        with detectorSemaphore or nullcontext():
+            startDetection = time.time()
+            runMMposeDetector(cameraDirectory, fileName, pathMMpose, 
+                              videoFullPath, pathOutputBox, pathOutputPkl,
+                              pathOutputVideo, trialPrefix, pklPath, 
+                              generateVideo, bbox_thr, model_config_person,
+                              model_ckpt_person, model_config_pose, 
+                              model_ckpt_pose)
+        if timings is not None:
+            timings['detection'] = time.time() - startDetection
+            
+        # Post-process data to have OpenPose-like file structure.        
+        runStage(arrangeMMposePkl, pklPath, ppStorePath, 
+                 processPool=processPool, timings=timings, 
+                 stage='postprocessing')
+
+    # This is a hack to be able to use pose pickle files already saved in the
+    # database. In some cases, we saved pklPath instead of ppPklPath:
+    # https://github.com/stanfordnmbl/opencap-core/pull/100/files.
+    # We here identify these cases and re-run post processing. 
+    elif not isKeypointStore(findPoseKeypointsPath(ppPklPath)):
+        print(f"pickle file already exists: {ppPklPath}. using that.")
+        open_file = open(ppPklPath, "rb")
+        frames = pickle.load(open_file)
+        open_file.close()
+        isData = any([('pose_keypoints_2d' in element[0].keys()) for element in frames if len(element)>0])
+        if not isData:
+            os.rename(ppPklPath, pklPath)
+            arrangeMMposePkl(pklPath, ppStorePath)
+    else:
+        print(f"keypoint store already exists: {ppStorePath}. using that.")
+
+# %%
+def runMMposeDetector(cameraDirectory, fileName, pathMMpose, videoFullPath,
+                      pathOutputBox, pathOutputPkl, pathOutputVideo, 
+                      trialPrefix, pklPath, generateVideo, bbox_thr,
+                      model_config_person, model_ckpt_person,
+                      model_config_pose, model_ckpt_pose):
+    # Runs mmpose, through the pose server, the docker-compose handoff, or in
+    # this process, and writes the raw pose pickle to pklPath.
+    poseServerURL = config("POSE_SERVER_URL", default='')
+    if poseServerURL and isPoseServerAvailable(poseServerURL):
+        # The server keeps the models loaded between videos; the handoff
+        # below is the fallback when it cannot be reached.
+        def onProgress(message):
+            if message['status'] == 'running' and 'total' in message:
+                print('Pose server: {} {}/{}'.format(
+                    message['stage'], message['done'], message['total']))
+        try:
+            frames = runPoseServerJob(poseServerURL, videoFullPath, bbox_thr,
+                                      onProgress=onProgress)
+        except Exception as e:
+            if len(e.args) == 2: # specific exception
+                raise Exception(e.args[0], e.args[1])
+            exception = "Pose detection failed. Verify your setup and try again. Visit https://www.opencap.ai/best-pratices to learn more about data collection and https://www.opencap.ai/troubleshooting for potential causes for a failed neutral pose."
+            raise Exception(exception, exception)
+        with open(pklPath, 'wb') as f:
+            pickle.dump(frames, f)
+
+    elif config("DOCKERCOMPOSE", cast=bool, default=False):
+        with _dockerHandoffLock:
             vid_path_tmp = "/data/tmp-video.mov"
             vid_path = "/data/video_mmpose.mov"
-            
+        
             # copy the video to vid_path_tmp
             shutil.copy(f"{cameraDirectory}/{fileName}", vid_path_tmp)
-            
+        
             # rename the video to vid_path
             os.rename(vid_path_tmp, vid_path)
-    
+
             try:
                 # wait until the video is processed (i.e. until the video is removed -- then json should be ready)
                 start = time.time()
                 while True:
                     if not os.path.isfile(vid_path):
                         break
-                    
+                
                     if start + 60*60 < time.time():
                         raise Exception("Pose detection timed out. This is unlikely to be your fault, please report this issue on the forum. You can proceed with your data collection (videos are uploaded to the server) and later reprocess errored trials.", 'timeout - hrnet')
-                
+            
                     time.sleep(0.1)
-                      
+                  
                 # copy /data/output to pathOutputPkl
                 os.system("cp /data/output_mmpose/* {pathOutputPkl}/".format(pathOutputPkl=pathOutputPkl))
                 pkl_path_tmp = os.path.join(pathOutputPkl, 'human.pkl')            
                 os.rename(pkl_path_tmp, pklPath)
-            
+        
             except Exception as e:
                 if len(e.args) == 2: # specific exception
                     raise Exception(e.args[0], e.args[1])
                 elif len(e.args) == 1: # generic exception
                     exception = "Pose detection failed. Verify your setup and try again. Visit https://www.opencap.ai/best-pratices to learn more about data collection and https://www.opencap.ai/troubleshooting for potential causes for a failed neutral pose."
                     raise Exception(exception, exception)            
-        else:           
-            c_path = os.path.dirname(os.path.abspath(__file__))
-            sys.path.append(os.path.join(c_path, 'mmpose'))
-            from utilsMMpose import detection_inference, pose_inference
-            # Run human detection.
-            print(f"path to mmpose is {pathMMpose}")
-            pathModelCkptPerson = os.path.join(pathMMpose, model_ckpt_person)
-            bboxPath = os.path.join(pathOutputBox, trialPrefix + '.pkl')
-            full_model_config_person = os.path.join(c_path, 'mmpose',
-                                                    model_config_person)
-            detection_inference(full_model_config_person, pathModelCkptPerson,
-                                videoFullPath, bboxPath)        
-            
-            # Run pose detection.     
-            pathModelCkptPose = os.path.join(pathMMpose, model_ckpt_pose)
-            videoOutPath = os.path.join(pathOutputVideo,
-                                        trialPrefix + 'withKeypoints.mp4')
-            full_model_config_pose = os.path.join(c_path, 'mmpose',
-                                                  model_config_pose)
-            pose_inference(full_model_config_pose, pathModelCkptPose, 
-                            videoFullPath, bboxPath, pklPath, videoOutPath, 
-                            bbox_thr=bbox_thr, visualize=generateVideo)
-            
-        # Post-process data to have OpenPose-like file structure.        
-        arrangeMMposePkl(pklPath, ppPklPath)
-
-    # This is a hack to be able to use pose pickle files already saved in the
-    # database. In some cases, we saved pklPath instead of ppPklPath:
-    # https://github.com/stanfordnmbl/opencap-core/pull/100/files.
-    # We here identify these cases and re-run post processing. 
-    else:
-        print(f"pickle file already exists: {ppPklPath}. using that.")
-        open_file = open(ppPklPath, "rb")
-        frames = pickle.load(open_file)
-        open_file.close()
-        isData = any([('pose_keypoints_2d' in element[0].keys()) for element in frames if len(element)>0])
-        if not isData:
-            os.rename(ppPklPath, pklPath)
-            arrangeMMposePkl(pklPath, ppPklPath)
+    else:           
+        c_path = os.path.dirname(os.path.abspath(__file__))
+        sys.path.append(os.path.join(c_path, 'mmpose'))
+        from utilsMMpose import detection_inference, pose_inference
+        # Run human detection.
+        print(f"path to mmpose is {pathMMpose}")
+        pathModelCkptPerson = os.path.join(pathMMpose, model_ckpt_person)
+        bboxPath = os.path.join(pathOutputBox, trialPrefix + '.pkl')
+        full_model_config_person = os.path.join(c_path, 'mmpose',
+                                                model_config_person)
+        detection_inference(full_model_config_person, pathModelCkptPerson,
+                            videoFullPath, bboxPath)        
+        
+        # Run pose detection.     
+        pathModelCkptPose = os.path.join(pathMMpose, model_ckpt_pose)
+        videoOutPath = os.path.join(pathOutputVideo,
+                                    trialPrefix + 'withKeypoints.mp4')
+        full_model_config_pose = os.path.join(c_path, 'mmpose',
+                                              model_config_pose)
+        pose_inference(full_model_config_pose, pathModelCkptPose, 
+                        videoFullPath, bboxPath, pklPath, videoOutPath, 
+                        bbox_thr=bbox_thr, visualize=generateVideo)
 
 # %%
 def arrangeMMposePkl(poseInferencePklPath, outputPklPath):
@@ -388,46 +556,32 @@ def arrangeMMposePkl(poseInferencePklPath, outputPklPath):
     markersMMpose = getMMposeMarkerNames()
     markersOpenPose = getOpenPoseMarkerNames()    
     
-    data4pkl = []
+    # Index of the mmpose marker for each OpenPose marker. midHip and Neck
+    # are the mid points between both hips and both shoulders, with the
+    # lowest confidence of the two.
+    idxMid = {'midHip': [markersMMpose.index("LHip"), 
+                         markersMMpose.index("RHip")],
+              'Neck': [markersMMpose.index("LShoulder"), 
+                       markersMMpose.index("RShoulder")]}
+    idxMarkers = [markersMMpose.index(marker) if marker not in idxMid else 0
+                  for marker in markersOpenPose]
+    
+    nPeople = max([len(frame) for frame in frames], default=0)
+    keypoints = np.full((len(frames), nPeople, len(markersOpenPose), 3), 
+                        np.nan, dtype=np.float32)
     for c_frame, frame in enumerate(frames):
-        data4people = []
-        for c, person in enumerate(frame):        
-            coordinates = person['preds_with_flip'].tolist()        
-            c_coord_out = np.zeros((25*3,))  
-            for c_m, marker in enumerate(markersOpenPose):            
-                if marker == "midHip":
-                    leftHip = coordinates[markersMMpose.index("LHip")]
-                    rightHip = coordinates[markersMMpose.index("RHip")]
-                    c_coord = []
-                    # Mid point between both hips
-                    c_coord.append((leftHip[0] + rightHip[0]) / 2)
-                    c_coord.append((leftHip[1] + rightHip[1]) / 2)
-                    # Lowest confidence
-                    c_coord.append(np.min([leftHip[2], rightHip[2]]))                
-                elif marker == "Neck":                
-                    leftShoulder = coordinates[
-                        markersMMpose.index("LShoulder")]
-                    rightShoulder = coordinates[
-                        markersMMpose.index("RShoulder")]                
-                    c_coord = []
-                    # Mid point between both shoulders
-                    c_coord.append((leftShoulder[0] + rightShoulder[0]) / 2)
-                    c_coord.append((leftShoulder[1] + rightShoulder[1]) / 2)
-                    # Lowest confidence
-                    c_coord.append(np.min([leftShoulder[2],
-                                           rightShoulder[2]]))                
-                else:
-                    c_coord = coordinates[markersMMpose.index(marker)]            
-                idx_out = np.arange(c_m*3, c_m*3+3)
-                c_coord_out[idx_out,] = c_coord            
-            c_dict = {}
-            c_dict['person_id'] = [c]
-            c_dict['pose_keypoints_2d'] = c_coord_out.tolist()
-            data4people.append(c_dict)
-        data4pkl.append(data4people)
+        if len(frame) == 0:
+            continue
+        coordinates = np.stack([person['preds_with_flip'] for person in frame])
+        c_coord_out = coordinates[:, idxMarkers, :3]
+        for marker, idx in idxMid.items():
+            c_m = markersOpenPose.index(marker)
+            c_coord_out[:, c_m, :2] = np.mean(coordinates[:, idx, :2], axis=1)
+            c_coord_out[:, c_m, 2] = np.min(coordinates[:, idx, 2], axis=1)
+        keypoints[c_frame, :len(frame)] = c_coord_out
         
-    with open(outputPklPath, 'wb') as f:
-        pickle.dump(data4pkl, f)
+    savePoseKeypoints(outputPklPath, keypoints=keypoints, 
+                      poseDetector='mmpose', markerNames=markersOpenPose)
     
     return
 
@@ -461,7 +615,9 @@ def saveJsonsAsPkl(json_directory, outputPklPath, videoName):
             data4people.append(c_dict)
         data4pkl.append(data4people)
         
-    with open(outputPklPath, 'wb') as f:
-        pickle.dump(data4pkl, f)
+    # Writes a keypoint store if outputPklPath ends with .npz, otherwise a
+    # legacy pickle.
+    savePoseKeypoints(outputPklPath, frames=data4pkl, poseDetector='OpenPose',
+                      markerNames=getOpenPoseMarkerNames())
                 
     return
@@ -0,0 +1,347 @@
+"""Columnar storage of 2D pose keypoints.
+
+Pose detector outputs used to be stored as pickles of per-frame lists of
+per-person dicts ({'person_id': [i], 'pose_keypoints_2d': [x0, y0, c0, ...]}).
+The keypoint store instead holds a single float32 array with a fixed
+[frame, person, joint, xyc] layout, and a small JSON header, in an
+uncompressed .npz file. Frames with fewer people than the maximum number of
+people detected are padded with nans.
+
+OpenPoseJsonIngestor parses the per-frame JSONs written by OpenPose directly
+into such an array, while OpenPose is still writing them.
+
+"""
+
+import os
+import re
+import json
+import pickle
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+try:
+    import orjson
+    has_orjson = True
+except ImportError:
+    has_orjson = False
+
+STORE_EXTENSION = '.npz'
+STORE_VERSION = 1
+
+# %%
+def getKeypointStorePath(pklPath):
+    # Path of the keypoint store corresponding to a (legacy) pose pickle path.
+    root, ext = os.path.splitext(pklPath)
+    if ext == STORE_EXTENSION:
+        return pklPath
+    return root + STORE_EXTENSION
+
+# %%
+def findPoseKeypointsPath(pklPath):
+    # Returns the keypoint store if it exists, otherwise the legacy pickle if
+    # it exists, otherwise None. If both exist, the most recently written one
+    # is returned, such that a store is not used once the pickle is rewritten.
+    storePath = getKeypointStorePath(pklPath)
+    hasStore = os.path.exists(storePath)
+    hasPickle = storePath != pklPath and os.path.exists(pklPath)
+    if hasStore and hasPickle:
+        if os.path.getmtime(pklPath) > os.path.getmtime(storePath):
+            return pklPath
+        return storePath
+    elif hasStore:
+        return storePath
+    elif hasPickle:
+        return pklPath
+    return None
+
+# %%
+def isKeypointStore(path):
+    # The .npz store is a zip archive, legacy pickles are not.
+    with open(path, 'rb') as f:
+        return f.read(4) == b'PK\x03\x04'
+
+# %%
+def saveKeypointStore(storePath, keypoints, poseDetector=None,
+                      markerNames=None):
+    # keypoints is a (nFrames x nPeople x nJoints x 3) array.
+    keypoints = np.asarray(keypoints, dtype=np.float32)
+    if keypoints.ndim != 4 or keypoints.shape[3] != 3:
+        raise ValueError('Keypoints should be nFrames x nPeople x nJoints x 3.')
+    header = {'version': STORE_VERSION,
+              'layout': ['frame', 'person', 'joint', 'xyc'],
+              'nFrames': keypoints.shape[0],
+              'nPeople': keypoints.shape[1],
+              'nJoints': keypoints.shape[2],
+              'poseDetector': poseDetector,
+              'markerNames': markerNames}
+    # Write to a temporary file first, np.savez adds the extension if missing.
+    tmpPath = storePath + '.tmp' + STORE_EXTENSION
+    np.savez(tmpPath, keypoints=keypoints, header=np.array(json.dumps(header)))
+    os.replace(tmpPath, storePath)
+
+    return header
+
+# %%
+def loadKeypointStore(storePath):
+    with np.load(storePath, allow_pickle=False) as data:
+        keypoints = data['keypoints']
+        header = json.loads(str(data['header']))
+
+    return keypoints, header
+
+# %%
+def framesToKeypoints(frames, nJoints=25):
+    # Converts legacy per-frame lists of per-person dicts to a
+    # (nFrames x nPeople x nJoints x 3) array.
+    nFrames = len(frames)
+    nPeople = max([len(frame) for frame in frames], default=0)
+    keypoints = np.full((nFrames, nPeople, nJoints*3), np.nan, dtype=np.float32)
+    for c_frame, frame in enumerate(frames):
+        if len(frame) > 0:
+            keypoints[c_frame, :len(frame)] = [
+                person['pose_keypoints_2d'] for person in frame]
+
+    return keypoints.reshape(nFrames, nPeople, nJoints, 3)
+
+# %%
+def keypointsToFrames(keypoints):
+    # Converts a (nFrames x nPeople x nJoints x 3) array to legacy per-frame
+    # lists of per-person dicts. People padded with nans are dropped.
+    nFrames, nPeople = keypoints.shape[:2]
+    flat = keypoints.reshape(nFrames, nPeople, -1)
+    isPerson = ~np.all(np.isnan(flat), axis=2)
+    frames = []
+    for c_frame in range(nFrames):
+        frames.append([{'person_id': [c],
+                        'pose_keypoints_2d': flat[c_frame, c].tolist()}
+                       for c in range(nPeople) if isPerson[c_frame, c]])
+
+    return frames
+
+# %%
+def savePoseKeypoints(path, frames=None, keypoints=None, poseDetector=None,
+                      markerNames=None):
+    # Writes pose keypoints, given either as legacy frames or as an array, to
+    # a keypoint store or to a legacy pickle depending on the extension.
+    if keypoints is None:
+        keypoints = framesToKeypoints(frames)
+    if path.endswith(STORE_EXTENSION):
+        saveKeypointStore(path, keypoints, poseDetector=poseDetector,
+                          markerNames=markerNames)
+    else:
+        if frames is None:
+            frames = keypointsToFrames(keypoints)
+        with open(path, 'wb') as f:
+            pickle.dump(frames, f)
+
+# %%
+def loadPoseKeypoints(path):
+    # Loads a (nFrames x nPeople x nJoints x 3) array from either a keypoint
+    # store or a legacy pose pickle. If path is a legacy pickle path and the
+    # corresponding keypoint store exists, the store is loaded.
+    existingPath = findPoseKeypointsPath(path)
+    if existingPath is None:
+        raise FileNotFoundError('No pose keypoints found for {}'.format(path))
+    if isKeypointStore(existingPath):
+        keypoints, _ = loadKeypointStore(existingPath)
+    else:
+        with open(existingPath, 'rb') as f:
+            frames = pickle.load(f)
+        keypoints = framesToKeypoints(frames)
+
+    return keypoints
+
+# %%
+def convertPosePickle(pklPath, storePath=None, poseDetector=None,
+                      deletePickle=False):
+    # Converts a legacy pose pickle to a keypoint store.
+    if storePath is None:
+        storePath = getKeypointStorePath(pklPath)
+    with open(pklPath, 'rb') as f:
+        frames = pickle.load(f)
+    saveKeypointStore(storePath, framesToKeypoints(frames),
+                      poseDetector=poseDetector)
+    if deletePickle:
+        os.remove(pklPath)
+
+    return storePath
+
+# %%
+def loadJsonFile(path):
+    # Uses orjson if available, it is several times faster than json.
+    if has_orjson:
+        with open(path, 'rb') as f:
+            return orjson.loads(f.read())
+    with open(path) as f:
+        return json.load(f)
+
+# %%
+class OpenPoseJsonIngestor(object):
+    """Parses OpenPose keypoint JSONs into a keypoint array as they appear.
+    
+    Call start() before OpenPose runs, and finish() once it is done. In
+    between, a background thread polls the JSON directory and parses new
+    files in parallel chunks into a preallocated
+    (nFrames x nPeople x nJoints x 3) array. Use it as a context manager, or
+    call close(), such that the threads are stopped if OpenPose fails. If
+    the JSON directory is reused once OpenPose is done, call stop() before,
+    finish() then only returns the array. The frame index is taken from
+    the OpenPose file names (<videoName>_<frame>_keypoints.json). ingest()
+    can also be called directly to parse the JSONs of a finished run.
+    
+    """
+    def __init__(self, json_directory, nFrames=0, nJoints=25, nWorkers=4,
+                 chunkSize=64, pollInterval=0.1):
+        """
+        Parameters
+        ----------
+        json_directory : str
+            Directory OpenPose writes the JSONs to.
+        nFrames : int
+            Expected number of frames, used to preallocate the array. The
+            array grows if there are more frames.
+        nWorkers, chunkSize : int
+            Number of parsing threads, and number of files per parsing task.
+        pollInterval : float
+            Time in seconds between directory scans.
+            
+        """
+        self.json_directory = os.path.abspath(json_directory)
+        self.nJoints = nJoints
+        self.chunkSize = chunkSize
+        self.pollInterval = pollInterval
+        self.minMtime = None
+        self.keypoints = np.full((max(nFrames, 1), 1, nJoints, 3), np.nan,
+                                 dtype=np.float32)
+        self.nFrames = 0
+        self.nPeople = 0
+        self.parsedFiles = set()
+        self._executor = ThreadPoolExecutor(max_workers=nWorkers)
+        self._stop = threading.Event()
+        self._thread = None
+        self._error = None
+        self._stopped = False
+        
+    def start(self, json_directory=None, minMtime=None):
+        # minMtime excludes older files, eg. left over from a previous video
+        # in a shared output directory.
+        if json_directory is not None:
+            self.json_directory = os.path.abspath(json_directory)
+        self.minMtime = minMtime
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        
+    def _run(self):
+        while not self._stop.wait(self.pollInterval):
+            try:
+                self.ingest(strict=False)
+            except Exception as e:
+                self._error = e
+                return
+    
+    def _listNewFiles(self):
+        try:
+            names = sorted(os.listdir(self.json_directory))
+        except FileNotFoundError: # not created yet or being recreated
+            return []
+        newFiles = []
+        for name in names:
+            if not name.endswith('.json') or name in self.parsedFiles:
+                continue
+            if self.minMtime is not None:
+                try:
+                    mtime = os.path.getmtime(
+                        os.path.join(self.json_directory, name))
+                except FileNotFoundError:
+                    continue
+                if mtime < self.minMtime:
+                    continue
+            newFiles.append(name)
+        return newFiles
+    
+    def _parseChunk(self, names, strict):
+        results = []
+        for name in names:
+            try:
+                data = loadJsonFile(os.path.join(self.json_directory, name))
+            except (ValueError, FileNotFoundError):
+                # OpenPose may still be writing this file, retry later.
+                if strict:
+                    raise
+                continue
+            people = np.array([person['pose_keypoints_2d'] 
+                               for person in data['people']], 
+                              dtype=np.float32).reshape(-1, self.nJoints, 3)
+            results.append((name, people))
+        return results
+    
+    def _frameIndex(self, name):
+        match = re.search(r'_(\d+)_keypoints\.json$', name)
+        if match is None:
+            return self.nFrames
+        return int(match.group(1))
+    
+    def _write(self, iFrame, people):
+        nFrames = self.keypoints.shape[0]
+        nPeople = max(self.keypoints.shape[1], people.shape[0])
+        if iFrame >= nFrames or nPeople > self.keypoints.shape[1]:
+            grown = np.full((max(nFrames, 2*(iFrame+1)), nPeople, 
+                             self.nJoints, 3), np.nan, dtype=np.float32)
+            grown[:nFrames, :self.keypoints.shape[1]] = self.keypoints
+            self.keypoints = grown
+        self.keypoints[iFrame, :people.shape[0]] = people
+        self.nFrames = max(self.nFrames, iFrame+1)
+        self.nPeople = max(self.nPeople, people.shape[0])
+        
+    def ingest(self, strict=True):
+        # Parses the JSONs that have not been parsed yet.
+        names = self._listNewFiles()
+        chunks = [names[i:i+self.chunkSize] 
+                  for i in range(0, len(names), self.chunkSize)]
+        for results in self._executor.map(
+                lambda chunk: self._parseChunk(chunk, strict), chunks):
+            for name, people in results:
+                self._write(self._frameIndex(name), people)
+                self.parsedFiles.add(name)
+        return len(names)
+    
+    def close(self):
+        # Stops polling and the parsing threads, without parsing the remaining
+        # JSONs. Safe to call more than once, eg. after finish().
+        if self._thread is not None:
+            self._stop.set()
+            self._thread.join()
+            self._thread = None
+        self._executor.shutdown()
+        
+    def stop(self):
+        # Stops polling and parses the remaining JSONs. The JSON directory is
+        # not read anymore afterwards, also not by finish().
+        if self._stopped:
+            return
+        if self._thread is not None:
+            self._stop.set()
+            self._thread.join()
+            self._thread = None
+        if self._error is not None:
+            raise self._error
+        self.ingest(strict=True)
+        self._stopped = True
+        
+    def finish(self):
+        # Stops polling, parses the remaining JSONs, and returns the
+        # (nFrames x nPeople x nJoints x 3) keypoint array.
+        try:
+            self.stop()
+        finally:
+            self.close()
+        
+        return self.keypoints[:self.nFrames, :self.nPeople]
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, *args):
+        self.close()
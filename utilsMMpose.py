@@ -1,9 +1,14 @@
 import cv2
+import queue
 import pickle
+import threading
+import numpy as np
+from contextlib import contextmanager
 import torch
 import mmdet
 # from tqdm import tqdm
 from mmpose_utils import process_mmdet_results, frame_iter, concat, convert_instance_to_frame
+from utilsBoxes import findClosestCorners
 try:
     #used to be from mmdet.apis
     from mmdet.apis import inference_detector, init_detector
@@ -14,13 +19,49 @@ except (ImportError, ModuleNotFoundError) as e:
     print(mmdet.__version__)
     has_mmdet = False
     
-from mmpose_data import CustomVideoDataset
+from mmpose_data import StreamingVideoDataset
 from mmpose_inference import init_pose_model, init_test_pipeline, run_pose_inference, run_pose_tracking
 from mmcv.parallel import collate
 from torch.utils.data import DataLoader
 from mmpose.apis import vis_pose_tracking_result
 from mmpose.datasets import DatasetInfo
 
+# Models initialized by detection_inference and pose_inference, kept for the
+# next videos processed by this process, eg by the pose server. One model is
+# kept per (model, config, checkpoint, device), and used by one video at a
+# time: concurrent videos wait for it rather than initializing copies. See
+# release_models to free the memory.
+_models = {}
+_modelLocks = {}
+_modelsLock = threading.Lock()
+
+# %%
+@contextmanager
+def loaded_model(init_model, model_config, model_ckpt, device):
+    key = (init_model.__name__, model_config, model_ckpt, device)
+    with _modelsLock:
+        lock = _modelLocks.setdefault(key, threading.Lock())
+    with lock:
+        model = _models.get(key)
+        if model is None:
+            model = init_model(model_config, model_ckpt, device=device)
+            _models[key] = model
+        yield model
+
+# %%
+def release_models():
+    """Drop the models kept by loaded_model and free the GPU memory they use.
+
+    Models in use are released once their video is done.
+    """
+    with _modelsLock:
+        locks = list(_modelLocks.items())
+    for key, lock in locks:
+        with lock:
+            _models.pop(key, None)
+    if torch.cuda.is_available():
+        torch.cuda.empty_cache()
+
 # %%
 def get_dataset_info():
     
@@ -34,59 +75,200 @@ def get_dataset_info():
     
     return dataset_info
 
+# %%
+def frame_batches(video_path, batch_size, detection_interval=1, queue_size=2):
+    """Decode the frames to run detection on in a background thread.
+
+    Every detection_interval-th frame is decoded, the others are only grabbed.
+    Decoding thus overlaps with detection on the previous batch.
+
+    Yields:
+        (list[int], list[np.ndarray]): Indices and images of a batch of frames.
+    """
+    batches = queue.Queue(maxsize=queue_size)
+    stop = threading.Event()
+    done = object()
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                batches.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def decode():
+        cap = cv2.VideoCapture(video_path)
+        try:
+            assert cap.isOpened(), f'Faild to load video file {video_path}'
+            indices, imgs = [], []
+            frame_idx = 0
+            while cap.grab():
+                if frame_idx % detection_interval == 0:
+                    indices.append(frame_idx)
+                    imgs.append(cap.retrieve()[1])
+                    if len(imgs) == batch_size:
+                        if not put((indices, imgs)):
+                            return
+                        indices, imgs = [], []
+                frame_idx += 1
+            if imgs and not put((indices, imgs)):
+                return
+            put((frame_idx, done))
+        except Exception as e:
+            put(e)
+        finally:
+            cap.release()
+
+    thread = threading.Thread(target=decode, daemon=True)
+    thread.start()
+    try:
+        while True:
+            item = batches.get()
+            if isinstance(item, Exception):
+                raise item
+            if item[1] is done:
+                return item[0] # number of frames
+            yield item
+    finally:
+        stop.set()
+        thread.join()
+
+# %%
+def propagate_boxes(start_results, end_results, alpha, image_size):
+    """Person boxes of a frame between two frames with detections.
+
+    Boxes are matched between both frames with findClosestCorners (the
+    criterion of utilsChecker.findClosestBox) and interpolated linearly,
+    including the score. Unmatched boxes are taken from the closest of both
+    frames.
+
+    Args:
+        start_results, end_results (list[dict]): Detections of both frames,
+            as returned by process_mmdet_results.
+        alpha (float): Position of the frame, 0 at start and 1 at end.
+        image_size (list): Width and height of the frames.
+    """
+    end_boxes = [person['bbox'] for person in end_results]
+    matched = set()
+    person_results = []
+    for person in start_results:
+        iPerson, samePerson = findClosestCorners(
+            person['bbox'], end_boxes, image_size)
+        if iPerson is not None and samePerson and iPerson not in matched:
+            matched.add(iPerson)
+            bbox = ((1 - alpha) * person['bbox'] +
+                    alpha * end_results[iPerson]['bbox'])
+            person_results.append({'bbox': bbox.astype(np.float32)})
+        elif alpha < 0.5:
+            person_results.append({'bbox': person['bbox'].copy()})
+    if alpha >= 0.5:
+        person_results += [{'bbox': person['bbox'].copy()}
+                           for i, person in enumerate(end_results)
+                           if i not in matched]
+    return person_results
+
 # %%
 def detection_inference(model_config, model_ckpt, video_path, bbox_path,
-                        device='cuda:0', det_cat_id=1):
+                        device='cuda:0', det_cat_id=1, batch_size=8,
+                        detection_interval=1, progress=None):
     
     """Visualize the demo images.
 
-    Using mmdet to detect the human.
+    Using mmdet to detect the human. Frames are decoded in a background
+    thread and detected in batches of batch_size. With detection_interval
+    k > 1, detection runs on every k-th frame only, and the boxes of the
+    frames in between are interpolated (propagate_boxes); frames after the
+    last detected frame keep its boxes. The output has one entry per frame
+    either way, as expected by pose_inference.
+
+    progress, if set, is called with ('detection', frames done, frames in
+    the video) after each batch.
     """
     print(f"MmPose pathis: {model_ckpt}")
     print(f"video path is: {video_path}")
 
-    det_model = init_detector(
-        model_config, model_ckpt, device=device.lower())
-
     cap = cv2.VideoCapture(video_path)
-    assert cap.isOpened(), f'Faild to load video file {video_path}'
+    nFramesEstimate = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+    cap.release()
 
-    output = []
-    nFrames = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
-    # for img in tqdm(frame_iter(cap), total=nFrames):
-    for img in frame_iter(cap):
-        # test a single image, the resulting box is (x1, y1, x2, y2)
-        mmdet_results = inference_detector(det_model, img)
+    detections = {}
+    image_size = None
+    with loaded_model(init_detector, model_config, model_ckpt,
+                      device.lower()) as det_model:
+        # for indices, imgs in tqdm(frame_batches(...)):
+        batches = frame_batches(video_path, batch_size, detection_interval)
+        while True:
+            try:
+                indices, imgs = next(batches)
+            except StopIteration as e:
+                nFrames = e.value
+                break
+            if image_size is None:
+                image_size = [imgs[0].shape[1], imgs[0].shape[0]]
+            # test a batch of images, the resulting boxes are (x1, y1, x2, y2)
+            mmdet_results = inference_detector(det_model, imgs)
+
+            # keep the person class bounding boxes.
+            for frame_idx, result in zip(indices, mmdet_results):
+                detections[frame_idx] = process_mmdet_results(result, det_cat_id)
+            if progress is not None:
+                progress('detection', min(indices[-1] + 1, nFramesEstimate),
+                         nFramesEstimate)
 
-        # keep the person class bounding boxes.
-        person_results = process_mmdet_results(mmdet_results, det_cat_id)
-        output.append(person_results)
+    output = []
+    for frame_idx in range(nFrames):
+        start = frame_idx - frame_idx % detection_interval
+        end = start + detection_interval
+        if frame_idx == start:
+            output.append(detections[frame_idx])
+        elif end not in detections:
+            output.append([{'bbox': person['bbox'].copy()}
+                           for person in detections[start]])
+        else:
+            alpha = (frame_idx - start) / detection_interval
+            output.append(propagate_boxes(detections[start], detections[end],
+                                          alpha, image_size))
 
     output_file = bbox_path
     pickle.dump(output, open(str(output_file), 'wb'))
-    cap.release()
     
 # %%
 def pose_inference(model_config, model_ckpt, video_path, bbox_path, pkl_path,
                    video_out_path, device='cuda:0', batch_size=64,
-                   bbox_thr=0.95, visualize=True, save_results=True):
-    """Run pose inference on custom video dataset"""
+                   bbox_thr=0.95, visualize=True, save_results=True,
+                   progress=None):
+    """Run pose inference on custom video dataset
 
-    # init model
-    model = init_pose_model(model_config, model_ckpt, device)
+    Returns the pose results, per frame. progress, if set, is called with
+    ('pose', instances done, instances in the video) after each batch.
+    """
+
+    # init model, or reuse the one of the previous video
+    with loaded_model(init_pose_model, model_config, model_ckpt,
+                      device) as model:
+        return _pose_inference(model, model_config, video_path, bbox_path,
+                               pkl_path, video_out_path, device, batch_size,
+                               bbox_thr, visualize, save_results, progress)
+
+def _pose_inference(model, model_config, video_path, bbox_path, pkl_path,
+                    video_out_path, device, batch_size, bbox_thr, visualize,
+                    save_results, progress):
     model_name = model_config.split("/")[1].split(".")[0]
     print("Initializing {} Model".format(model_name))
 
     # build data pipeline
     test_pipeline = init_test_pipeline(model)
 
-    # build dataset
+    # build dataset. Frames are decoded while batching, such that memory
+    # depends on the batch size rather than on the length of the video.
     video_basename = video_path.split("/")[-1].split(".")[0]
-    dataset = CustomVideoDataset(video_path=video_path,
-                                 bbox_path=bbox_path,
-                                 bbox_threshold=bbox_thr,
-                                 pipeline=test_pipeline,
-                                 config=model.cfg)
+    dataset = StreamingVideoDataset(video_path=video_path,
+                                    bbox_path=bbox_path,
+                                    bbox_threshold=bbox_thr,
+                                    pipeline=test_pipeline,
+                                    config=model.cfg)
     dataloader = DataLoader(dataset, batch_size=batch_size,
                             shuffle=False, collate_fn=collate)
     print("Building {} Custom Video Dataset".format(video_basename))
@@ -101,10 +283,14 @@ def pose_inference(model_config, model_ckpt, video_path, bbox_path, pkl_path,
         with torch.no_grad():
             result = run_pose_inference(model, batch)
         instances.append(result)
+        if progress is not None:
+            progress('pose', sum(len(r['preds']) for r in instances),
+                     len(dataset))
 
     # concat results and transform to per frame format
     results = concat(instances)
     results = convert_instance_to_frame(results, dataset.frame_to_instance)
+    dataset.frames.release()
 
     # run pose tracking
     results = run_pose_tracking(results)
@@ -142,3 +328,5 @@ def pose_inference(model_config, model_ckpt, video_path, bbox_path, pkl_path,
                                                show=False)
             videoWriter.write(vis_img)
         videoWriter.release()
+
+    return results
@@ -4,14 +4,47 @@ import opensim
 import numpy as np
 import glob
 import json
+import threading
 from utils import storage2numpy
+from utilsVisualizer import writeVisualizerBinary
+
+# Models prepared for inverse kinematics, keyed by scaled model. They are kept
+# across the static and dynamic trials of a session, such that the models are
+# parsed and prepared only once per session (and process).
+_ikModels = {}
+maxCachedIKModels = 4
+# A cached model is mutable (the IK tool sets its state), so it is prepared
+# and used by one thread at a time, holding the lock of its scaled model (see
+# getIKModelLock). _ikModelsLock guards the dicts.
+_ikModelLocks = {}
+_ikModelsLock = threading.Lock()
+
+# %% Run an OpenSim tool.
+def runOpenSimTool(tool, pathOutputSetup, inProcess=True):
+    # Runs the tool in-process through the Python bindings, which avoids the
+    # startup of opensim-cmd and re-parsing the model. Falls back to running
+    # the printed setup file with opensim-cmd if the in-process run fails.
+    if inProcess:
+        try:
+            if tool.run():
+                return
+            print('In-process {} failed, running opensim-cmd.'.format(
+                tool.getConcreteClassName()))
+        except Exception as e:
+            print('In-process {} failed ({}), running opensim-cmd.'.format(
+                tool.getConcreteClassName(), e))
+    command = 'opensim-cmd -o error' + ' run-tool ' + pathOutputSetup
+    os.system(command)
 
 # %% Scaling.
 def runScaleTool(pathGenericSetupFile, pathGenericModel, subjectMass,
                  pathTRCFile, timeRange, pathOutputFolder, 
                  scaledModelName='not_specified', subjectHeight=0,
                  createModelWithContacts=False, fixed_markers=False,
-                 suffix_model=''):
+                 suffix_model='', inProcess=True):
+    
+    # If inProcess, the scale tool runs through the Python bindings, with
+    # opensim-cmd as fallback (see runOpenSimTool).
     
     dirGenericModel, scaledModelNameA = os.path.split(pathGenericModel)
     
@@ -55,6 +88,7 @@ def runScaleTool(pathGenericSetupFile, pathGenericModel, subjectMass,
     genericModel = opensim.Model(pathGenericModel)
     markerSet = opensim.MarkerSet(pathMarkerSet)
     genericModel.set_MarkerSet(markerSet)
+    genericModel.finalizeFromProperties()
     genericModel.printToXML(pathUpdGenericModel)    
 
     # Time range.
@@ -81,7 +115,8 @@ def runScaleTool(pathGenericSetupFile, pathGenericModel, subjectMass,
     markerPlacer.setTimeRange(timeRange_os)
     
     # Disable tasks of dofs that are locked and markers that are not present.
-    model = opensim.Model(pathUpdGenericModel)
+    # The updated generic model does not need to be parsed again.
+    model = genericModel
     coordNames = []
     for coord in model.getCoordinateSet():
         if not coord.getDefaultLocked():
@@ -126,8 +161,7 @@ def runScaleTool(pathGenericSetupFile, pathGenericModel, subjectMass,
     print("running scaletool...")     
     print(f"to: {pathOutputSetup}")          
     scaleTool.printToXML(pathOutputSetup)            
-    command = 'opensim-cmd -o error' + ' run-tool ' + pathOutputSetup
-    os.system(command)
+    runOpenSimTool(scaleTool, pathOutputSetup, inProcess=inProcess)
     
     # Sanity check
     scaled_model = opensim.Model(pathOutputModel)
@@ -152,9 +186,90 @@ def runScaleTool(pathGenericSetupFile, pathGenericModel, subjectMass,
     print(pathOutputModel)
     return pathOutputModel
     
+# %% Model for inverse kinematics.
+def getIKModelLock(pathScaledModel):
+    # Lock to hold while preparing or using the IK model of pathScaledModel.
+    with _ikModelsLock:
+        return _ikModelLocks.setdefault(os.path.abspath(pathScaledModel),
+                                        threading.RLock())
+
+# %% Model for inverse kinematics, cached.
+def getIKModel(pathScaledModel):
+    # Returns the model prepared for inverse kinematics and its path. The
+    # model is prepared once per scaled model, and kept in memory for the
+    # following trials. A prepared model file that is more recent than the
+    # scaled model is loaded rather than prepared again. Callers using the
+    # returned model must hold getIKModelLock(pathScaledModel).
+    pathScaledModelWithoutPatella = pathScaledModel.replace('.osim', '_no_patella.osim')
+    key = (os.path.abspath(pathScaledModel), 
+           os.path.getmtime(pathScaledModel))
+    with getIKModelLock(pathScaledModel):
+        with _ikModelsLock:
+            model = _ikModels.get(key)
+        if model is None or not os.path.exists(pathScaledModelWithoutPatella):
+            model = prepareIKModel(pathScaledModel, 
+                                   pathScaledModelWithoutPatella)
+            # Keep the most recently used models only.
+            with _ikModelsLock:
+                for oldKey in list(_ikModels.keys()):
+                    if (oldKey[0] == key[0] or 
+                            len(_ikModels) >= maxCachedIKModels):
+                        _ikModels.pop(oldKey)
+                _ikModels[key] = model
+    
+    return model, pathScaledModelWithoutPatella
+
+# %% Prepare model for inverse kinematics.
+def prepareIKModel(pathScaledModel, pathScaledModelWithoutPatella):
+    opensim.Logger.setLevelString('error')
+    if (os.path.exists(pathScaledModelWithoutPatella) and 
+            os.path.getmtime(pathScaledModelWithoutPatella) >= 
+            os.path.getmtime(pathScaledModel)):
+        model = opensim.Model(pathScaledModelWithoutPatella)
+    else:
+        # To make IK faster, we remove the patellas and their constraints
+        # from the model. Constraints make the IK problem more difficult, and
+        # the patellas are not used in the IK solution for this particular
+        # model. Since muscles are attached to the patellas, we also remove
+        # all muscles.
+        model = opensim.Model(pathScaledModel)
+        # Remove all actuators.                                         
+        forceSet = model.getForceSet()
+        forceSet.setSize(0)
+        # Remove patellofemoral constraints.
+        constraintSet = model.getConstraintSet()
+        patellofemoral_constraints = [
+            'patellofemoral_knee_angle_r_con', 'patellofemoral_knee_angle_l_con']
+        for patellofemoral_constraint in patellofemoral_constraints:
+            i = constraintSet.getIndex(patellofemoral_constraint, 0)
+            constraintSet.remove(i)       
+        # Remove patella bodies.
+        bodySet = model.getBodySet()
+        patella_bodies = ['patella_r', 'patella_l']
+        for patella in patella_bodies:
+            i = bodySet.getIndex(patella, 0)
+            bodySet.remove(i)
+        # Remove patellofemoral joints.
+        jointSet = model.getJointSet()
+        patellofemoral_joints = ['patellofemoral_r', 'patellofemoral_l']
+        for patellofemoral in patellofemoral_joints:
+            i = jointSet.getIndex(patellofemoral, 0)
+            jointSet.remove(i)
+        # Print the model to a new file.
+        model.finalizeConnections
+        model.initSystem()
+        model.printToXML(pathScaledModelWithoutPatella)
+    
+    return model
+    
 # %% Inverse kinematics.
 def runIKTool(pathGenericSetupFile, pathScaledModel, pathTRCFile,
-              pathOutputFolder, timeRange=[], IKFileName='not_specified'):
+              pathOutputFolder, timeRange=[], IKFileName='not_specified',
+              inProcess=True):
+    
+    # If inProcess, the IK tool runs through the Python bindings with the
+    # cached model (see getIKModel), with opensim-cmd as fallback (see 
+    # runOpenSimTool).
     
     # Paths
     if IKFileName == 'not_specified':
@@ -165,59 +280,78 @@ def runIKTool(pathGenericSetupFile, pathScaledModel, pathTRCFile,
     pathOutputSetup =  os.path.join(
         pathOutputFolder, 'Setup_IK_' + IKFileName + '.xml')
     
-    # To make IK faster, we remove the patellas and their constraints from the
-    # model. Constraints make the IK problem more difficult, and the patellas
-    # are not used in the IK solution for this particular model. Since muscles
-    # are attached to the patellas, we also remove all muscles.
-    opensim.Logger.setLevelString('error')
-    model = opensim.Model(pathScaledModel)
-    # Remove all actuators.                                         
-    forceSet = model.getForceSet()
-    forceSet.setSize(0)
-    # Remove patellofemoral constraints.
-    constraintSet = model.getConstraintSet()
-    patellofemoral_constraints = [
-        'patellofemoral_knee_angle_r_con', 'patellofemoral_knee_angle_l_con']
-    for patellofemoral_constraint in patellofemoral_constraints:
-        i = constraintSet.getIndex(patellofemoral_constraint, 0)
-        constraintSet.remove(i)       
-    # Remove patella bodies.
-    bodySet = model.getBodySet()
-    patella_bodies = ['patella_r', 'patella_l']
-    for patella in patella_bodies:
-        i = bodySet.getIndex(patella, 0)
-        bodySet.remove(i)
-    # Remove patellofemoral joints.
-    jointSet = model.getJointSet()
-    patellofemoral_joints = ['patellofemoral_r', 'patellofemoral_l']
-    for patellofemoral in patellofemoral_joints:
-        i = jointSet.getIndex(patellofemoral, 0)
-        jointSet.remove(i)
-    # Print the model to a new file.
-    model.finalizeConnections
-    model.initSystem()
-    pathScaledModelWithoutPatella = pathScaledModel.replace('.osim', '_no_patella.osim')
-    model.printToXML(pathScaledModelWithoutPatella)   
-
-    # Setup IK tool.    
-    IKTool = opensim.InverseKinematicsTool(pathGenericSetupFile)            
-    IKTool.setName(IKFileName)
-    IKTool.set_model_file(pathScaledModelWithoutPatella)          
-    IKTool.set_marker_file(pathTRCFile)
-    if timeRange:
-        IKTool.set_time_range(0, timeRange[0])
-        IKTool.set_time_range(1, timeRange[-1])
-    IKTool.setResultsDir(pathOutputFolder)                        
-    IKTool.set_report_errors(True)
-    IKTool.set_report_marker_locations(False)
-    IKTool.set_output_motion_file(pathOutputMotion)
-    IKTool.printToXML(pathOutputSetup)
-    command = 'opensim-cmd -o error' + ' run-tool ' + pathOutputSetup
-    os.system(command)
+    # Trials of the same session share the cached model, run them one at a
+    # time.
+    with getIKModelLock(pathScaledModel):
+        # Model without patellas, muscles, and patellofemoral constraints.
+        model, pathScaledModelWithoutPatella = getIKModel(pathScaledModel)
+    
+        # Setup IK tool.    
+        IKTool = opensim.InverseKinematicsTool(pathGenericSetupFile)            
+        IKTool.setName(IKFileName)
+        IKTool.set_model_file(pathScaledModelWithoutPatella)          
+        IKTool.set_marker_file(pathTRCFile)
+        if timeRange:
+            IKTool.set_time_range(0, timeRange[0])
+            IKTool.set_time_range(1, timeRange[-1])
+        IKTool.setResultsDir(pathOutputFolder)                        
+        IKTool.set_report_errors(True)
+        IKTool.set_report_marker_locations(False)
+        IKTool.set_output_motion_file(pathOutputMotion)
+        IKTool.printToXML(pathOutputSetup)
+        if inProcess:
+            IKTool.setModel(model)
+        runOpenSimTool(IKTool, pathOutputSetup, inProcess=inProcess)
     
     return pathOutputMotion, pathScaledModelWithoutPatella
     
     
+# %% Range (max - min) of each column of data over all windows of nf frames,
+# returned as a (nFrames-nf+1 x nColumns) array. Uses running maxima and
+# minima over blocks of nf frames (van Herk/Gil-Werman), such that all windows
+# are evaluated in O(nFrames) rather than O(nFrames*nf). If nf exceeds the
+# number of frames, the range over all frames is returned.
+def getSlidingWindowRange(data, nf):
+    nFrames = data.shape[0]
+    if nf >= nFrames:
+        return np.max(data, axis=0, keepdims=True) - np.min(data, axis=0, 
+                                                             keepdims=True)
+    nBlocks = -(-nFrames // nf)
+    padded = np.full((nBlocks*nf,) + data.shape[1:], np.nan)
+    padded[:nFrames] = data
+    blocks = padded.reshape((nBlocks, nf) + data.shape[1:])
+    windowRange = []
+    for reduce in [np.maximum, np.minimum]:
+        # Running extrema from the start (prefix) and from the end (suffix)
+        # of each block. The window starting at frame i covers the suffix of
+        # its block from i and the prefix of the next block up to i+nf-1.
+        prefix = reduce.accumulate(blocks, axis=1).reshape(padded.shape)
+        suffix = reduce.accumulate(blocks[:, ::-1], axis=1)[:, ::-1].reshape(
+            padded.shape)
+        windowRange.append(reduce(suffix[:nFrames-nf+1], prefix[nf-1:nFrames]))
+    
+    return windowRange[0] - windowRange[1]
+
+# %% Looks for the first window of nf frames during which all columns of
+# trc_data vary by less than thresholdPosition. If there is none, nf is
+# reduced by 0.1s until the window would be shorter than thresholdTime. 
+# Returns the index of the first frame of the window and nf.
+def detectStaticWindow(trc_data, sf, nf, thresholdPosition=0.005, 
+                       thresholdTime=0.3):
+    nf_step = int(0.1*sf)
+    while True:
+        detectedWindows = np.all(
+            getSlidingWindowRange(trc_data, nf) < thresholdPosition, axis=1)
+        if np.round((nf-1)/sf,2) < thresholdTime:
+            # Only the first window was evaluated with nf this short.
+            detectedWindows = detectedWindows[:1]
+        if np.any(detectedWindows):
+            return int(np.argmax(detectedWindows)), nf
+        nf -= nf_step
+        if np.round((nf-1)/sf,2) < thresholdTime or nf_step < 1: # number of frames got too small without detecting a window
+            exception = "Musculoskeletal model scaling failed; could not detect a static phase of at least %.2fs. After you press record, make sure the subject stands still until the message tells you they can relax . Visit https://www.opencap.ai/best-pratices to learn more about data collection." % thresholdTime
+            raise Exception(exception, exception)
+
 # %% This function will look for a time window, of a minimum duration specified
 # by thresholdTime, during which the markers move at most by a distance
 # specified by thresholdPosition.
@@ -288,22 +422,8 @@ def getScaleTimeRange(pathTRCFile, thresholdPosition=0.005, thresholdTime=0.3,
     # Corresponding number of frames.
     nf = int(timeRange_min*sf + 1)
     
-    detectedWindow = False
-    i = 0
-    while not detectedWindow:
-        c_window = trc_data[i:i+nf,:]
-        c_window_max = np.max(c_window, axis=0)
-        c_window_min = np.min(c_window, axis=0)
-        c_window_diff = np.abs(c_window_max - c_window_min)
-        detectedWindow = np.alltrue(c_window_diff<thresholdPosition)
-        if not detectedWindow:
-            i += 1
-            if i > c_trc_time.shape[0]-nf:
-                i = 0
-                nf -= int(0.1*sf) 
-            if np.round((nf-1)/sf,2) < thresholdTime: # number of frames got too small without detecting a window
-                exception = "Musculoskeletal model scaling failed; could not detect a static phase of at least %.2fs. After you press record, make sure the subject stands still until the message tells you they can relax . Visit https://www.opencap.ai/best-pratices to learn more about data collection." % thresholdTime
-                raise Exception(exception, exception)
+    i, nf = detectStaticWindow(trc_data, sf, nf, thresholdPosition, 
+                               thresholdTime)
     
     timeRange = [c_trc_time[i], c_trc_time[i+nf-1]]
     timeRangeSpan = np.round(timeRange[1] - timeRange[0], 2)
@@ -597,8 +717,13 @@ def compareTRCAndForcesTime(pathTRC,pathForces):
 
 # %% This takes model and IK and generates a json of body transforms that can 
 # be passed to the webapp visualizer
+# If outputFormat is 'binary', the transforms are written to a compact binary
+# file instead (see utilsVisualizer), with optional quantization steps (in m
+# for translations and in quaternion units for rotations) and delta encoding.
 def generateVisualizerJson(modelPath,ikPath,jsonOutputPath,statesInDegrees=True,
-                           vertical_offset=None):
+                           vertical_offset=None, outputFormat='json',
+                           translationStep=None, rotationStep=None,
+                           delta=False):
     
     opensim.Logger.setLevelString('error')
     model = opensim.Model(modelPath)
@@ -631,13 +756,12 @@ def generateVisualizerJson(modelPath,ikPath,jsonOutputPath,statesInDegrees=True,
             if col[0] == '/': # if full state path
                 temp = col[:col.rfind('/')]
                 coordName = temp[temp.rfind('/')+1:]
-            for t in range(len(stateTime)):
-                qTemp = np.asarray(stateTable.getDependentColumn(col)[t])
-                if coords.get(coordName).getMotionType() == 1 and inDegrees: # rotation
-                    qTemp = np.deg2rad(qTemp)
-                if 'pelvis_ty' in col and not (vertical_offset is None):
-                    qTemp -= (vertical_offset - 0.01)
-                q[t,coordCol] = qTemp
+            qTemp = stateTable.getDependentColumn(col).to_numpy()
+            if coords.get(coordName).getMotionType() == 1 and inDegrees: # rotation
+                qTemp = np.deg2rad(qTemp)
+            if 'pelvis_ty' in col and not (vertical_offset is None):
+                qTemp = qTemp - (vertical_offset - 0.01)
+            q[:,coordCol] = qTemp
             stateNamesOut.append(coordName) # This is always just coord - never full path
     
     # We may have deleted some columns
@@ -657,7 +781,8 @@ def generateVisualizerJson(modelPath,ikPath,jsonOutputPath,statesInDegrees=True,
     visualizeDict['time'] = stateTime
     visualizeDict['bodies'] = {}
     
-    for body in bodyset:
+    bodies = list(bodyset)
+    for body in bodies:
         visualizeDict['bodies'][body.getName()] = {}
         attachedGeometries = []
         
@@ -676,27 +801,46 @@ def generateVisualizerJson(modelPath,ikPath,jsonOutputPath,statesInDegrees=True,
         scale_factors = attached_geometry.get_scale_factors().to_numpy() 
         visualizeDict['bodies'][body.getName()]['scaleFactors'] = scale_factors.tolist()
         
-        # init body translation and rotations dictionaries
-          
-        visualizeDict['bodies'][body.getName()]['rotation'] = []
-        visualizeDict['bodies'][body.getName()]['translation'] = []
+    # Body translations and rotations in ground, filled over time.
+    rotations = np.zeros((len(bodies), len(stateTime), 3))
+    translations = np.zeros((len(bodies), len(stateTime), 3))
+    
+    # State vectors of all time steps at once.
+    yAll = np.zeros((len(stateTime), state.getNY()))
+    yAll[:, np.asarray(systemStateInds[:nCoords], dtype=int)] = q
     
     for iTime, time in enumerate(stateTime): 
-        yVec = np.zeros((state.getNY())).tolist()
-        for i in range(nCoords):
-            yVec[systemStateInds[i]] = q[iTime,i]
-        state.setY(opensim.Vector(yVec))
+        state.setY(opensim.Vector(yAll[iTime].tolist()))
         
         model.realizePosition(state)
         
         # get body translations and rotations in ground
-        for body in bodyset:
+        for iBody, body in enumerate(bodies):
             # This gives us body transform to opensim body frame, which isn't nec. 
             # geometry origin. Ayman said getting transform to Geometry::Mesh is safest
             # but we don't have access to it thru API and Ayman said what we're doing
             # is OK for now
-            visualizeDict['bodies'][body.getName()]['rotation'].append(body.getTransformInGround(state).R().convertRotationToBodyFixedXYZ().to_numpy().tolist())
-            visualizeDict['bodies'][body.getName()]['translation'].append(body.getTransformInGround(state).T().to_numpy().tolist())
+            transform = body.getTransformInGround(state)
+            rotations[iBody, iTime] = transform.R().convertRotationToBodyFixedXYZ().to_numpy()
+            translations[iBody, iTime] = transform.T().to_numpy()
+    
+    for iBody, body in enumerate(bodies):
+        visualizeDict['bodies'][body.getName()]['rotation'] = rotations[iBody]
+        visualizeDict['bodies'][body.getName()]['translation'] = translations[iBody]
+    
+    if outputFormat == 'binary':
+        writeVisualizerBinary(jsonOutputPath, stateTime, 
+                              visualizeDict['bodies'],
+                              translationStep=translationStep,
+                              rotationStep=rotationStep, delta=delta)
+        return
+    elif outputFormat != 'json':
+        raise ValueError('Unknown visualizer output format ' + outputFormat)
+    
+    for body in bodies:
+        for field in ['rotation', 'translation']:
+            visualizeDict['bodies'][body.getName()][field] = (
+                visualizeDict['bodies'][body.getName()][field].tolist())
             
     with open(jsonOutputPath, 'w') as f:
         json.dump(visualizeDict, f)
@@ -0,0 +1,413 @@
+"""Long-lived pose inference server.
+
+The pose detection daemons used to poll a shared folder for a video and
+initialize the detector and pose models again for every video. The server
+keeps the models loaded and accepts jobs over HTTP instead:
+
+    POST /jobs?bbox_thr=0.8    body: the video
+    GET /health
+
+A video that cannot be received or read is rejected with a 4xx status.
+Otherwise the response to a job is streamed as JSON lines: the position in
+the queue, progress while the video is processed, and finally the
+keypoints, as arrays (see framesToArrays), or an error. Videos are processed one at a time.
+Sending the video in the request, rather than its path, makes the server
+usable across containers without a shared folder.
+
+runPoseServerJob is the client, used by utilsDetector when POSE_SERVER_URL
+is set; the file handoff remains the fallback when the server cannot be
+reached. StandInPoseModel is a CPU-only model with the output format of
+mmpose, to test the server without a GPU:
+
+    python utilsPoseServer.py --stand-in
+
+"""
+
+import io
+import os
+import json
+import time
+import base64
+import shutil
+import argparse
+import tempfile
+import threading
+from urllib.parse import urlparse, parse_qs
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import cv2
+import numpy as np
+
+DEFAULT_HOST = '127.0.0.1'
+DEFAULT_PORT = 8090
+PROGRESS_INTERVAL = 1. # s between progress messages of a job
+CHUNK_SIZE = 1 << 20 # bytes
+TIMEOUT = (10, 60*60) # s, (connect, read) for jobs
+
+# %% Models.
+class MMposeModel(object):
+    # HRNet with the Faster R-CNN person detector, as in runMMposeDetector.
+    # The models stay loaded between videos (utilsMMpose.loaded_model).
+    name = 'mmpose'
+
+    def __init__(self, model_config_person, model_ckpt_person,
+                 model_config_pose, model_ckpt_pose, device='cuda:0'):
+        self.model_config_person = model_config_person
+        self.model_ckpt_person = model_ckpt_person
+        self.model_config_pose = model_config_pose
+        self.model_ckpt_pose = model_ckpt_pose
+        self.device = device
+
+    def load(self):
+        from utilsMMpose import loaded_model, init_detector, init_pose_model
+        with loaded_model(init_detector, self.model_config_person,
+                          self.model_ckpt_person, self.device.lower()):
+            pass
+        with loaded_model(init_pose_model, self.model_config_pose,
+                          self.model_ckpt_pose, self.device):
+            pass
+
+    def infer(self, videoPath, bboxThr, progress=None):
+        from utilsMMpose import detection_inference, pose_inference
+        outputDir = tempfile.mkdtemp()
+        try:
+            bboxPath = os.path.join(outputDir, 'box.pkl')
+            detection_inference(self.model_config_person,
+                                self.model_ckpt_person, videoPath, bboxPath,
+                                device=self.device, progress=progress)
+            return pose_inference(self.model_config_pose, self.model_ckpt_pose,
+                                  videoPath, bboxPath, None, '',
+                                  device=self.device, bbox_thr=bboxThr,
+                                  visualize=False, save_results=False,
+                                  progress=progress)
+        finally:
+            shutil.rmtree(outputDir, ignore_errors=True)
+
+class StandInPoseModel(object):
+    # CPU-only stand-in: decodes the video and returns one person per frame
+    # with 133 keypoints on a circle around the center of the frame, moving
+    # with the frame index. loadTime simulates initializing a real model.
+    name = 'stand-in'
+    nKeypoints = 133
+
+    def __init__(self, loadTime=0.):
+        self.loadTime = loadTime
+        self.loaded = False
+
+    def load(self):
+        if not self.loaded:
+            time.sleep(self.loadTime)
+            self.loaded = True
+
+    def infer(self, videoPath, bboxThr, progress=None):
+        self.load()
+        cap = cv2.VideoCapture(videoPath)
+        if not cap.isOpened():
+            raise Exception('Failed to load video file {}'.format(videoPath))
+        nFrames = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+        angles = 2 * np.pi * np.arange(self.nKeypoints) / self.nKeypoints
+        results = []
+        while cap.grab():
+            img = cap.retrieve()[1]
+            height, width = img.shape[:2]
+            iFrame = len(results)
+            keypoints = np.zeros((self.nKeypoints, 3), dtype=np.float32)
+            keypoints[:, 0] = width / 2 + iFrame + 0.25 * height * np.cos(angles)
+            keypoints[:, 1] = height / 2 + 0.25 * height * np.sin(angles)
+            keypoints[:, 2] = 0.9
+            bbox = np.array([keypoints[:, 0].min(), keypoints[:, 1].min(),
+                             keypoints[:, 0].max(), keypoints[:, 1].max(),
+                             0.99], dtype=np.float32)
+            results.append([] if bbox[4] < bboxThr else
+                           [{'bbox': bbox, 'preds_with_flip': keypoints,
+                             'track_id': 0}])
+            if progress is not None:
+                progress('pose', iFrame + 1, nFrames)
+        cap.release()
+        return results
+
+# %% Result format.
+def framesToArrays(frames):
+    # Per-frame pose results (lists of dicts with bbox, preds_with_flip and
+    # track_id) to arrays padded with NaN (-1 for track IDs):
+    # keypoints [frames, people, keypoints, 3], bboxes [frames, people, 5],
+    # trackIds [frames, people].
+    nPeople = max([len(frame) for frame in frames], default=0)
+    nKeypoints = 0
+    for frame in frames:
+        if len(frame) > 0:
+            nKeypoints = len(frame[0]['preds_with_flip'])
+            break
+    keypoints = np.full((len(frames), nPeople, nKeypoints, 3), np.nan,
+                        dtype=np.float32)
+    bboxes = np.full((len(frames), nPeople, 5), np.nan, dtype=np.float32)
+    trackIds = np.full((len(frames), nPeople), -1, dtype=np.int64)
+    for c_frame, frame in enumerate(frames):
+        for c_person, person in enumerate(frame):
+            keypoints[c_frame, c_person] = person['preds_with_flip'][:, :3]
+            bboxes[c_frame, c_person, :len(person['bbox'])] = person['bbox']
+            trackIds[c_frame, c_person] = person.get('track_id', -1)
+    return {'keypoints': keypoints, 'bboxes': bboxes, 'trackIds': trackIds}
+
+def arraysToFrames(arrays):
+    # Inverse of framesToArrays, in the format of the pose pickle that
+    # utilsDetector.arrangeMMposePkl reads.
+    frames = []
+    for keypoints, bboxes, trackIds in zip(
+            arrays['keypoints'], arrays['bboxes'], arrays['trackIds']):
+        frames.append([{'bbox': bbox, 'preds_with_flip': keypoint,
+                        'track_id': int(trackId)}
+                       for keypoint, bbox, trackId in zip(
+                           keypoints, bboxes, trackIds)
+                       if not np.all(np.isnan(bbox))])
+    return frames
+
+def encodeArrays(arrays):
+    buffer = io.BytesIO()
+    np.savez(buffer, **arrays)
+    return base64.b64encode(buffer.getvalue()).decode('ascii')
+
+def decodeArrays(data):
+    with np.load(io.BytesIO(base64.b64decode(data)),
+                 allow_pickle=False) as arrays:
+        return {key: arrays[key] for key in arrays.files}
+
+# %% Server.
+class _Handler(BaseHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+    def sendJSON(self, code, message):
+        body = json.dumps(message).encode()
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        server = self.server.poseServer
+        if urlparse(self.path).path.rstrip('/') == '/health':
+            self.sendJSON(200, {'status': 'ok', 'model': server.model.name,
+                                'queue': server.waiting})
+        else:
+            self.sendJSON(404, {'error': 'Not found.'})
+
+    def do_POST(self):
+        server = self.server.poseServer
+        url = urlparse(self.path)
+        if url.path.rstrip('/') != '/jobs':
+            self.sendJSON(404, {'error': 'Not found.'})
+            return
+        query = parse_qs(url.query)
+        try:
+            bboxThr = float(query.get('bbox_thr', ['0.8'])[0])
+            size = int(self.headers['Content-Length'])
+        except (TypeError, ValueError):
+            self.sendJSON(400, {'error': 'Expected the video as body and a '
+                                         'numeric bbox_thr.'})
+            return
+
+        # The video is received and checked before the response starts, such
+        # that a bad request gets an error status. Once the job is queued, 
+        # the response is streamed as JSON lines until the connection closes,
+        # and errors of the job are reported in the stream.
+        suffix = os.path.splitext(query.get('name', ['video.mov'])[0])[1]
+        try:
+            fd, videoPath = tempfile.mkstemp(suffix=suffix or '.mov',
+                                             dir=server.dataDir)
+        except OSError as e:
+            self.sendJSON(500, {'error': 'Could not store the video: '
+                                         '{}'.format(e)})
+            return
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                while size > 0:
+                    chunk = self.rfile.read(min(CHUNK_SIZE, size))
+                    if not chunk:
+                        self.sendJSON(400, {'error': 'Connection closed '
+                                                     'during upload.'})
+                        return
+                    f.write(chunk)
+                    size -= len(chunk)
+            if not isReadableVideo(videoPath):
+                self.sendJSON(400, {'error': 'The body is not a readable '
+                                             'video.'})
+                return
+
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/x-ndjson')
+            self.end_headers()
+
+            def send(message):
+                self.wfile.write((json.dumps(message) + '\n').encode())
+                self.wfile.flush()
+
+            server.runJob(videoPath, bboxThr, send)
+        except (BrokenPipeError, ConnectionResetError):
+            pass # Client is gone.
+        finally:
+            os.remove(videoPath)
+
+def isReadableVideo(videoPath):
+    cap = cv2.VideoCapture(videoPath)
+    try:
+        return cap.isOpened() and cap.grab()
+    finally:
+        cap.release()
+
+class PoseServer(object):
+    """
+    Serves pose inference jobs with a model loaded once.
+
+    Parameters
+    ----------
+    model : MMposeModel or StandInPoseModel
+        Model with load() and infer(videoPath, bboxThr, progress).
+    dataDir : str
+        Folder for the videos received; the temporary folder by default.
+
+    """
+    def __init__(self, model, host=DEFAULT_HOST, port=DEFAULT_PORT,
+                 dataDir=None):
+        self.model = model
+        self.dataDir = dataDir
+        # One video at a time on the GPU; also taken by the file handoff.
+        self.lock = threading.Lock()
+        self.waiting = 0
+        self.queueLock = threading.Lock()
+        self.httpServer = ThreadingHTTPServer((host, port), _Handler)
+        self.httpServer.daemon_threads = True
+        self.httpServer.poseServer = self
+
+    @property
+    def url(self):
+        host, port = self.httpServer.server_address[:2]
+        return 'http://{}:{}/'.format(host, port)
+
+    def runJob(self, videoPath, bboxThr, send):
+        with self.queueLock:
+            self.waiting += 1
+            position = self.waiting
+        try:
+            send({'status': 'queued', 'position': position})
+            self.lock.acquire()
+        finally:
+            with self.queueLock:
+                self.waiting -= 1
+        try:
+            start = time.time()
+            lastSent = [0.]
+
+            def progress(stage, done, total):
+                now = time.time()
+                if now - lastSent[0] >= PROGRESS_INTERVAL or done >= total:
+                    lastSent[0] = now
+                    send({'status': 'running', 'stage': stage,
+                          'done': int(done), 'total': int(total)})
+
+            send({'status': 'running', 'stage': 'start'})
+            try:
+                frames = self.model.infer(videoPath, bboxThr, progress)
+            except (BrokenPipeError, ConnectionResetError):
+                raise
+            except Exception as e:
+                send({'status': 'error',
+                      'error': str(e.args[0] if e.args else e)})
+                return
+        finally:
+            self.lock.release()
+        send({'status': 'done', 'time': time.time() - start,
+              'arrays': encodeArrays(framesToArrays(frames))})
+
+    def start(self):
+        # Loads the model and serves in a background thread.
+        self.model.load()
+        threading.Thread(target=self.httpServer.serve_forever,
+                         daemon=True).start()
+        return self
+
+    def serve_forever(self):
+        self.model.load()
+        self.httpServer.serve_forever()
+
+    def shutdown(self):
+        self.httpServer.shutdown()
+        self.httpServer.server_close()
+
+# %% Client.
+def isPoseServerAvailable(serverURL, timeout=2):
+    from utilsTransfer import getHTTPSession
+    try:
+        r = getHTTPSession().get(serverURL.rstrip('/') + '/health',
+                                 timeout=timeout)
+        return r.status_code == 200
+    except Exception:
+        return False
+
+def runPoseServerJob(serverURL, videoPath, bboxThr, onProgress=None,
+                     timeout=TIMEOUT):
+    """
+    Sends a video to the pose server and waits for the keypoints.
+
+    Returns
+    -------
+    list
+        Pose results per frame, as in the pickle written by pose_inference
+        (bbox, preds_with_flip and track_id of each person).
+
+    """
+    from utilsTransfer import getHTTPSession
+    url = '{}/jobs'.format(serverURL.rstrip('/'))
+    params = {'bbox_thr': bboxThr, 'name': os.path.basename(videoPath)}
+    with open(videoPath, 'rb') as f:
+        r = getHTTPSession().post(url, params=params, data=f, stream=True,
+                                  timeout=timeout)
+    with r:
+        if r.status_code >= 400:
+            try:
+                error = r.json()['error']
+            except (ValueError, KeyError):
+                error = r.reason
+            raise Exception('Pose server error {}: {}'.format(
+                r.status_code, error), 'pose server')
+        for line in r.iter_lines():
+            if not line:
+                continue
+            message = json.loads(line)
+            if message['status'] == 'done':
+                return arraysToFrames(decodeArrays(message['arrays']))
+            if message['status'] == 'error':
+                raise Exception(message['error'], 'pose server')
+            if onProgress is not None:
+                onProgress(message)
+    raise Exception('Pose server closed the connection before the job was '
+                    'done.', 'pose server')
+
+# %%
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Pose inference server.')
+    parser.add_argument('--host', default=DEFAULT_HOST)
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT)
+    parser.add_argument('--stand-in', action='store_true',
+                        help='CPU-only stand-in model, for testing.')
+    parser.add_argument('--model_config_person',
+                        default='mmpose/faster_rcnn_r50_fpn_coco.py')
+    parser.add_argument('--model_ckpt_person',
+                        default='mmpose/faster_rcnn_r50_fpn_1x_coco_20200130-047c8118.pth')
+    parser.add_argument('--model_config_pose',
+                        default='mmpose/hrnet_w48_coco_wholebody_384x288_dark_plus.py')
+    parser.add_argument('--model_ckpt_pose',
+                        default='mmpose/hrnet_w48_coco_wholebody_384x288_dark-f5726563_20200918.pth')
+    parser.add_argument('--device', default='cuda:0')
+    args = parser.parse_args()
+
+    if args.stand_in:
+        model = StandInPoseModel()
+    else:
+        model = MMposeModel(args.model_config_person, args.model_ckpt_person,
+                            args.model_config_pose, args.model_ckpt_pose,
+                            device=args.device)
+    server = PoseServer(model, host=args.host, port=args.port)
+    print('Serving {} pose model at {}'.format(model.name, server.url))
+    server.serve_forever()
@@ -40,14 +40,46 @@ def processTrial(session_id, trial_id, trial_type = 'dynamic',
                  hasWritePermissions = True,
                  use_existing_pose_pickle = False,
                  batchProcess = False,
-                 cameras_to_use=['all']):
+                 cameras_to_use=['all'],
+                 useStageCache = False):
+    
+    # The three phases are also run separately by the pipelined worker
+    # (utilsWorker), which downloads the next trial and uploads the previous
+    # one while a trial is processed.
+    trial = prepareTrial(session_id, trial_id, trial_type=trial_type,
+                         poseDetector=poseDetector, isDocker=isDocker,
+                         resolutionPoseDetection=resolutionPoseDetection,
+                         bbox_thr=bbox_thr,
+                         use_existing_pose_pickle=use_existing_pose_pickle,
+                         batchProcess=batchProcess)
+    
+    runTrial(trial, imageUpsampleFactor=imageUpsampleFactor,
+             cameras_to_use=cameras_to_use, useStageCache=useStageCache)
+        
+    if not hasWritePermissions:
+        print('You are not the owner of this session, so do not have permission to write results to database.')
+        return
+    
+    uploadTrialResults(trial, extrinsicTrialName=extrinsicTrialName)
+    
+    # Remove data
+    if deleteLocalFolder:
+        shutil.rmtree(trial['session_path'])
 
+# %% Download phase: deletes stale outputs, downloads the videos and, 
+# depending on the trial type, the calibration, model, and metadata. Returns
+# the trial state used by runTrial and uploadTrialResults.
+def prepareTrial(session_id, trial_id, trial_type = 'dynamic',
+                 poseDetector = 'OpenPose', isDocker = True,
+                 resolutionPoseDetection = 'default', bbox_thr = 0.8,
+                 use_existing_pose_pickle = False, batchProcess = False):
+    
     # Get session directory
     session_name = session_id 
     data_dir = getDataDirectory(isDocker=isDocker)
     session_path = os.path.join(data_dir,'Data',session_name)    
-    trial_url = "{}{}{}/".format(API_URL, "trials/", trial_id)
-    metadata_path = os.path.join(session_path, 'sessionMetadata.yaml')        
+    metadata_path = os.path.join(session_path, 'sessionMetadata.yaml')
+    calibrationOptions = None
        
     # Process the 3 different types of trials
     if trial_type == 'calibration':
@@ -58,31 +90,6 @@ def processTrial(session_id, trial_id, trial_type = 'dynamic',
         trial_name = downloadVideosFromServer(session_id,trial_id,isDocker=isDocker,
                                  isCalibration=True,isStaticPose=False)
         
-        # run calibration
-        try:
-            main(session_name, trial_name, trial_id, isDocker=isDocker, extrinsicsTrial=True,
-                 imageUpsampleFactor=imageUpsampleFactor,genericFolderNames = True,
-                 cameras_to_use=cameras_to_use)
-        except Exception as e:
-            error_msg = {}
-            error_msg['error_msg'] = e.args[0]
-            error_msg['error_msg_dev'] = e.args[1]
-            _ = requests.patch(trial_url, data={"meta": json.dumps(error_msg)},
-                   headers = {"Authorization": "Token {}".format(API_TOKEN)})   
-            raise Exception('Calibration failed', e.args[0], e.args[1])
-        
-        if not hasWritePermissions:
-            print('You are not the owner of this session, so do not have permission to write results to database.')
-            return
-            
-        # Write calibration images to django
-        images_path = os.path.join(session_path,'CalibrationImages')
-        writeMediaToAPI(API_URL,images_path,trial_id,tag="calibration-img",deleteOldMedia=True)
-        
-        # Write calibration solutions to django
-        writeCalibrationOptionsToAPI(session_path,session_id,calibration_id = trial_id,
-                                     trialName = extrinsicTrialName)
-        
     elif trial_type == 'static':
         # delete static files if they exist.
         deleteStaticFiles(session_path, staticTrialName = 'neutral')
@@ -94,88 +101,6 @@ def processTrial(session_id, trial_id, trial_type = 'dynamic',
         trial_name = downloadVideosFromServer(session_id,trial_id,isDocker=isDocker,
                                  isCalibration=False,isStaticPose=True)
         
-        # Download the pose pickles to avoid re-running pose estimation.
-        if batchProcess and use_existing_pose_pickle:
-            checkAndGetPosePickles(trial_id, session_path, poseDetector, resolutionPoseDetection, bbox_thr)
-
-        # If processTrial is run from app.py, poseDetector is set based on what
-        # users select in the webapp, which is saved in metadata. Based on this,
-        # we set resolutionPoseDetection or bbox_thr to the webapp defaults. If
-        # processTrial is run from batchReprocess.py, then the settings used are
-        # those passed as arguments to processTrial.
-        if not batchProcess:
-            sessionMetadata = importMetadata(metadata_path)
-            poseDetector = sessionMetadata['posemodel']
-            file_dir = os.path.dirname(os.path.abspath(__file__))
-            with open(os.path.join(file_dir,'defaultOpenCapSettings.json')) as f:
-                defaultOpenCapSettings = json.load(f)
-            if poseDetector.lower() == 'openpose':
-                resolutionPoseDetection = defaultOpenCapSettings['openpose']
-            elif poseDetector.lower() == 'hrnet':
-                bbox_thr = defaultOpenCapSettings['hrnet']            
-
-        # run static
-        try:
-            main(session_name, trial_name, trial_id, isDocker=isDocker, extrinsicsTrial=False,
-                 poseDetector=poseDetector,
-                 imageUpsampleFactor=imageUpsampleFactor,
-                 scaleModel = True,
-                 resolutionPoseDetection = resolutionPoseDetection,
-                 genericFolderNames = True,
-                 bbox_thr = bbox_thr,
-                 calibrationOptions = calibrationOptions,
-                 cameras_to_use=cameras_to_use)
-        except Exception as e:       
-            # Try to post pose pickles so can be used offline. This function will 
-            # error at kinematics most likely, but if pose estimation completed,
-            # pickles will get posted
-            try:
-                # Write results to django
-                if not batchProcess:
-                    print('trial failed. posting pose pickles')
-                    postMotionData(trial_id,session_path,trial_name=trial_name,isNeutral=True,
-                                    poseDetector=poseDetector, 
-                                    resolutionPoseDetection=resolutionPoseDetection,
-                                    bbox_thr=bbox_thr)
-            except:
-                pass
-            
-            error_msg = {}
-            error_msg['error_msg'] = e.args[0]
-            error_msg['error_msg_dev'] = e.args[1]
-            _ = requests.patch(trial_url, data={"meta": json.dumps(error_msg)},
-                   headers = {"Authorization": "Token {}".format(API_TOKEN)})
-            raise Exception('Static trial failed', e.args[0], e.args[1])
-        
-        if not hasWritePermissions:
-            print('You are not the owner of this session, so do not have permission to write results to database.')
-            return
-        
-        # Write videos to django
-        video_path = getResultsPath(session_id, trial_id,
-                                    resultType='neutralVideo', isDocker=isDocker)
-        writeMediaToAPI(API_URL,video_path,trial_id, tag='video-sync',deleteOldMedia=True)
-        
-        # Write neutral pose images to django
-        images_path = os.path.join(session_path,'NeutralPoseImages')
-        writeMediaToAPI(API_URL,images_path,trial_id,tag="neutral-img",deleteOldMedia=True)
-        
-        # Write visualizer jsons to django
-        visualizerJson_path = getResultsPath(session_id, trial_id, 
-                                             resultType='visualizerJson', 
-                                             isDocker=isDocker)
-        writeMediaToAPI(API_URL,visualizerJson_path,trial_id,
-                        tag="visualizerTransforms-json",deleteOldMedia=True)
-        
-        # Write results to django
-        postMotionData(trial_id,session_path,trial_name=trial_name,isNeutral=True,
-                       poseDetector=poseDetector, 
-                       resolutionPoseDetection=resolutionPoseDetection,
-                       bbox_thr=bbox_thr)
-        
-        # Write calibration options to django
-        postCalibrationOptions(session_path,session_id,overwrite=True)
-        
     elif trial_type == 'dynamic':
         # download calibration, model, and metadata if not existing
         getCalibration(session_id,session_path,trial_type=trial_type)   
@@ -186,6 +111,10 @@ def processTrial(session_id, trial_id, trial_type = 'dynamic',
             session_id, trial_id, isDocker=isDocker, isCalibration=False,
             isStaticPose=False)
         
+    else:
+        raise Exception('Wrong trial type. Options: calibration, static, dynamic.', 'TODO', 'TODO')
+        
+    if trial_type in ['static', 'dynamic']:
         # Download the pose pickles to avoid re-running pose estimation.
         if batchProcess and use_existing_pose_pickle:
             checkAndGetPosePickles(trial_id, session_path, poseDetector, resolutionPoseDetection, bbox_thr)
@@ -204,67 +133,130 @@ def processTrial(session_id, trial_id, trial_type = 'dynamic',
             if poseDetector.lower() == 'openpose':
                 resolutionPoseDetection = defaultOpenCapSettings['openpose']
             elif poseDetector.lower() == 'hrnet':
-                bbox_thr = defaultOpenCapSettings['hrnet'] 
-        
-        # run dynamic
-        try:
+                bbox_thr = defaultOpenCapSettings['hrnet']
+    
+    trial = {'session_id': session_id, 'trial_id': trial_id,
+             'trial_type': trial_type, 'trial_name': trial_name,
+             'session_path': session_path, 'isDocker': isDocker,
+             'poseDetector': poseDetector,
+             'resolutionPoseDetection': resolutionPoseDetection,
+             'bbox_thr': bbox_thr, 'calibrationOptions': calibrationOptions,
+             'batchProcess': batchProcess}
+    
+    return trial
+
+# %% Processing phase: runs main on a trial returned by prepareTrial. On
+# failure, the error is posted to the trial and re-raised.
+def runTrial(trial, imageUpsampleFactor = 4, cameras_to_use=['all'],
+             useStageCache = False):
+    
+    session_name = trial['session_id']
+    trial_id = trial['trial_id']
+    trial_type = trial['trial_type']
+    trial_name = trial['trial_name']
+    session_path = trial['session_path']
+    isDocker = trial['isDocker']
+    poseDetector = trial['poseDetector']
+    resolutionPoseDetection = trial['resolutionPoseDetection']
+    bbox_thr = trial['bbox_thr']
+    trial_url = "{}{}{}/".format(API_URL, "trials/", trial_id)
+    
+    try:
+        if trial_type == 'calibration':
+            # run calibration
+            main(session_name, trial_name, trial_id, isDocker=isDocker, extrinsicsTrial=True,
+                 imageUpsampleFactor=imageUpsampleFactor,genericFolderNames = True,
+                 cameras_to_use=cameras_to_use)
+        else:
+            # run static (scaling) or dynamic
             main(session_name, trial_name, trial_id, isDocker=isDocker, extrinsicsTrial=False,
                  poseDetector=poseDetector,
                  imageUpsampleFactor=imageUpsampleFactor,
+                 scaleModel = trial_type == 'static',
                  resolutionPoseDetection = resolutionPoseDetection,
                  genericFolderNames = True,
                  bbox_thr = bbox_thr,
-                 cameras_to_use=cameras_to_use)
-        except Exception as e:
+                 calibrationOptions = trial['calibrationOptions'],
+                 cameras_to_use=cameras_to_use,
+                 useStageCache=useStageCache)
+    except Exception as e:
+        if trial_type != 'calibration':
             # Try to post pose pickles so can be used offline. This function will 
             # error at kinematics most likely, but if pose estimation completed,
             # pickles will get posted
             try:
                 # Write results to django
-                if not batchProcess:
+                if not trial['batchProcess']:
                     print('trial failed. posting pose pickles')
-                    postMotionData(trial_id,session_path,trial_name=trial_name,isNeutral=False,
-                                    poseDetector=poseDetector, 
-                                    resolutionPoseDetection=resolutionPoseDetection,
-                                    bbox_thr=bbox_thr)
+                    postMotionData(trial_id,session_path,trial_name=trial_name,
+                                   isNeutral=trial_type == 'static',
+                                   poseDetector=poseDetector, 
+                                   resolutionPoseDetection=resolutionPoseDetection,
+                                   bbox_thr=bbox_thr)
             except:
                 pass
-            
-            error_msg = {}
-            error_msg['error_msg'] = e.args[0]
-            error_msg['error_msg_dev'] = e.args[1]
-            _ = requests.patch(trial_url, data={"meta": json.dumps(error_msg)},
-                   headers = {"Authorization": "Token {}".format(API_TOKEN)})   
-            raise Exception('Dynamic trial failed.\n' + error_msg['error_msg_dev'], e.args[0], e.args[1])
-        
-        if not hasWritePermissions:
-            print('You are not the owner of this session, so do not have permission to write results to database.')
-            return
-        
-        # Write videos to django
-        video_path = getResultsPath(session_id, trial_id,
-                                    resultType='sync_video', isDocker=isDocker)
-        writeMediaToAPI(API_URL,video_path,trial_id, tag='video-sync',deleteOldMedia=True)
         
-        # Write visualizer jsons to django
-        visualizerJson_path = getResultsPath(session_id, trial_id, 
-                                             resultType='visualizerJson', 
-                                             isDocker=isDocker)
-        writeMediaToAPI(API_URL,visualizerJson_path,trial_id,
-                        tag="visualizerTransforms-json",deleteOldMedia=True)
-        
-        # Write results to django
-        postMotionData(trial_id,session_path,trial_name=trial_name,isNeutral=False,
-                       poseDetector=poseDetector, 
-                       resolutionPoseDetection=resolutionPoseDetection,
-                       bbox_thr=bbox_thr)
+        error_msg = {}
+        error_msg['error_msg'] = e.args[0]
+        error_msg['error_msg_dev'] = e.args[1]
+        _ = requests.patch(trial_url, data={"meta": json.dumps(error_msg)},
+               headers = {"Authorization": "Token {}".format(API_TOKEN)})
+        if trial_type == 'calibration':
+            raise Exception('Calibration failed', e.args[0], e.args[1])
+        elif trial_type == 'static':
+            raise Exception('Static trial failed', e.args[0], e.args[1])
+        else:
+            raise Exception('Dynamic trial failed.\n' + error_msg['error_msg_dev'], e.args[0], e.args[1])
+
+# %% Upload phase: writes the results of a trial processed by runTrial to 
+# the database.
+def uploadTrialResults(trial, extrinsicTrialName = 'calibration'):
+    
+    session_id = trial['session_id']
+    trial_id = trial['trial_id']
+    trial_type = trial['trial_type']
+    trial_name = trial['trial_name']
+    session_path = trial['session_path']
+    isDocker = trial['isDocker']
+    
+    if trial_type == 'calibration':
+        # Write calibration images to django
+        images_path = os.path.join(session_path,'CalibrationImages')
+        writeMediaToAPI(API_URL,images_path,trial_id,tag="calibration-img",deleteOldMedia=True)
         
-    else:
-        raise Exception('Wrong trial type. Options: calibration, static, dynamic.', 'TODO', 'TODO')
+        # Write calibration solutions to django
+        writeCalibrationOptionsToAPI(session_path,session_id,calibration_id = trial_id,
+                                     trialName = extrinsicTrialName)
+        return
     
-    # Remove data
-    if deleteLocalFolder:
-        shutil.rmtree(session_path)
+    # Write videos to django
+    video_path = getResultsPath(
+        session_id, trial_id, isDocker=isDocker,
+        resultType='neutralVideo' if trial_type == 'static' else 'sync_video')
+    writeMediaToAPI(API_URL,video_path,trial_id, tag='video-sync',deleteOldMedia=True)
+    
+    if trial_type == 'static':
+        # Write neutral pose images to django
+        images_path = os.path.join(session_path,'NeutralPoseImages')
+        writeMediaToAPI(API_URL,images_path,trial_id,tag="neutral-img",deleteOldMedia=True)
+    
+    # Write visualizer jsons to django
+    visualizerJson_path = getResultsPath(session_id, trial_id, 
+                                         resultType='visualizerJson', 
+                                         isDocker=isDocker)
+    writeMediaToAPI(API_URL,visualizerJson_path,trial_id,
+                    tag="visualizerTransforms-json",deleteOldMedia=True)
+    
+    # Write results to django
+    postMotionData(trial_id,session_path,trial_name=trial_name,
+                   isNeutral=trial_type == 'static',
+                   poseDetector=trial['poseDetector'], 
+                   resolutionPoseDetection=trial['resolutionPoseDetection'],
+                   bbox_thr=trial['bbox_thr'])
+    
+    if trial_type == 'static':
+        # Write calibration options to django
+        postCalibrationOptions(session_path,session_id,overwrite=True)
         
         
 def getCalibrationImagePath(session_id,isDocker=True):
@@ -335,7 +327,7 @@ def newSessionSameSetup(session_id_old,session_id_new,extrinsicTrialName='calibr
 def batchReprocess(session_ids,calib_id,static_id,dynamic_trialNames,poseDetector='OpenPose', 
                    resolutionPoseDetection='1x736',deleteLocalFolder=True,
                    isServer=False, use_existing_pose_pickle=True,
-                   cameras_to_use=['all']):
+                   cameras_to_use=['all'], useStageCache=True):
 
     # extract trial ids from trial names
     if dynamic_trialNames is not None and len(dynamic_trialNames)>0:
@@ -398,7 +390,8 @@ def batchReprocess(session_ids,calib_id,static_id,dynamic_trialNames,poseDetecto
                               hasWritePermissions = hasWritePermissions,
                               use_existing_pose_pickle = use_existing_pose_pickle,
                               batchProcess = True,
-                              cameras_to_use=cameras_to_use)
+                              cameras_to_use=cameras_to_use,
+                              useStageCache=useStageCache)
                 statusData = {'status':'done'}
                 _ = requests.patch(API_URL + "trials/{}/".format(static_id_toProcess), data=statusData,
                          headers = {"Authorization": "Token {}".format(API_TOKEN)})
@@ -430,7 +423,8 @@ def batchReprocess(session_ids,calib_id,static_id,dynamic_trialNames,poseDetecto
                           hasWritePermissions = hasWritePermissions,
                           use_existing_pose_pickle = use_existing_pose_pickle,
                           batchProcess = True,
-                          cameras_to_use=cameras_to_use)
+                          cameras_to_use=cameras_to_use,
+                          useStageCache=useStageCache)
                 
                 statusData = {'status':'done'}
                 _ = requests.patch(API_URL + "trials/{}/".format(dID), data=statusData,
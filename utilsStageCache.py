@@ -0,0 +1,367 @@
+"""Content-addressed cache of the outputs of the stages of main().
+
+Each stage (pose detection, synchronization, triangulation, marker
+augmentation, OpenSim pipeline) is keyed by a hash of its inputs: video
+checksums, camera parameters, relevant settings, upstream stage keys, and
+hashes of the code and model files it depends on. The outputs of a stage,
+ie files of the session folder and optionally a picklable value, are stored
+under that key, and restored instead of re-running the stage when the key
+matches. A manifest per trial records the key used for each stage and
+whether it was a cache hit.
+
+Layout of the cache directory:
+    objects/<key[:2]>/<key>/entry.json
+    objects/<key[:2]>/<key>/value.pkl
+    objects/<key[:2]>/<key>/files/<path relative to the session folder>
+    manifests/<trial_id>.json
+
+Usage from the command line:
+    python utilsStageCache.py [--cacheDir DIR] list
+    python utilsStageCache.py [--cacheDir DIR] show <trial_id>
+    python utilsStageCache.py [--cacheDir DIR] gc [--maxAgeDays N] [--dryRun]
+
+"""
+
+import os
+import sys
+import glob
+import json
+import time
+import shutil
+import pickle
+import hashlib
+import argparse
+
+import numpy as np
+
+CACHE_VERSION = 1
+
+# Memoized file hashes, keyed by path, size, and modification time.
+_fileHashes = {}
+
+# %%
+def getStageCacheDirectory(dataDir):
+    return os.path.join(dataDir, 'StageCache')
+
+# %%
+def hashFile(path, chunkSize=1 << 20):
+    stat = os.stat(path)
+    memoKey = (os.path.abspath(path), stat.st_size, stat.st_mtime_ns)
+    if memoKey not in _fileHashes:
+        h = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(chunkSize), b''):
+                h.update(chunk)
+        _fileHashes[memoKey] = h.hexdigest()
+
+    return _fileHashes[memoKey]
+
+# %%
+def registerFileHash(path, digest):
+    # Records the sha256 hexdigest of a file computed while writing it, eg
+    # while receiving an upload, such that hashFile does not read it again.
+    stat = os.stat(path)
+    _fileHashes[(os.path.abspath(path), stat.st_size, stat.st_mtime_ns)] = digest
+
+# %%
+def _canonical(obj):
+    # JSON-serializable representation of obj, numpy arrays being replaced by
+    # a hash of their content.
+    if isinstance(obj, dict):
+        return {str(k): _canonical(v) for k, v in obj.items()}
+    elif isinstance(obj, (list, tuple)):
+        return [_canonical(v) for v in obj]
+    elif isinstance(obj, (set, frozenset)):
+        return sorted([_canonical(v) for v in obj], key=json.dumps)
+    elif isinstance(obj, np.ndarray):
+        return {'dtype': str(obj.dtype), 'shape': list(obj.shape),
+                'sha256': hashlib.sha256(
+                    np.ascontiguousarray(obj).tobytes()).hexdigest()}
+    elif isinstance(obj, np.generic):
+        return obj.item()
+    elif obj is None or isinstance(obj, (str, int, float, bool)):
+        return obj
+    return repr(obj)
+
+# %%
+def hashObject(obj):
+    return hashlib.sha256(json.dumps(
+        _canonical(obj), sort_keys=True).encode()).hexdigest()
+
+# %%
+def getCodeVersion(paths):
+    # Hash of the content of files and directories (eg, source files, model
+    # weights, setup files).
+    hashes = {}
+    for path in paths:
+        if os.path.isdir(path):
+            for root, _, fileNames in sorted(os.walk(path)):
+                for fileName in sorted(fileNames):
+                    filePath = os.path.join(root, fileName)
+                    hashes[os.path.relpath(filePath, os.path.dirname(path))] = (
+                        hashFile(filePath))
+        elif os.path.isfile(path):
+            hashes[os.path.basename(path)] = hashFile(path)
+        else:
+            hashes[os.path.basename(path)] = None
+
+    return hashObject(hashes)
+
+# %%
+class StageCache(object):
+    """Stores and restores the outputs of the stages of a trial.
+
+    """
+    def __init__(self, cacheDir, sessionDir, trial_id):
+        self.cacheDir = os.path.abspath(cacheDir)
+        self.sessionDir = os.path.abspath(sessionDir)
+        self.trial_id = trial_id
+        self.manifestPath = os.path.join(self.cacheDir, 'manifests',
+                                         trial_id + '.json')
+        self.manifest = loadManifest(self.manifestPath)
+        if self.manifest is None:
+            self.manifest = {'trial_id': trial_id, 'stages': {}}
+        self.manifest['sessionDir'] = self.sessionDir
+
+    def getKey(self, stage, inputs):
+        return hashObject({'cacheVersion': CACHE_VERSION, 'stage': stage,
+                           'inputs': inputs})
+
+    def getObjectDir(self, key):
+        return os.path.join(self.cacheDir, 'objects', key[:2], key)
+
+    def restore(self, stage, key):
+        # Copies the files of the stage back to the session folder and returns
+        # the cached entry, with its value, or None if there is no entry.
+        objectDir = self.getObjectDir(key)
+        entry = loadEntry(objectDir)
+        if entry is None:
+            self._record(stage, key, hit=False)
+            return None
+        for relPath in entry['files']:
+            pathOut = os.path.join(self.sessionDir, relPath)
+            os.makedirs(os.path.dirname(pathOut), exist_ok=True)
+            shutil.copy2(os.path.join(objectDir, 'files', relPath), pathOut)
+        entry['value'] = None
+        if os.path.exists(os.path.join(objectDir, 'value.pkl')):
+            with open(os.path.join(objectDir, 'value.pkl'), 'rb') as f:
+                entry['value'] = pickle.load(f)
+        # Used for garbage collection.
+        os.utime(os.path.join(objectDir, 'entry.json'))
+        self._record(stage, key, hit=True)
+        print('Restored {} from stage cache.'.format(stage))
+
+        return entry
+
+    def save(self, stage, key, files=[], value=None, since=None):
+        # Stores the files of the stage, given as paths or glob patterns within
+        # the session folder, and the value. If since, only files modified
+        # after that time are stored.
+        paths = []
+        for pattern in files:
+            paths += sorted(glob.glob(pattern, recursive=True))
+        if since is not None:
+            paths = [path for path in paths if os.path.isfile(path) and
+                     os.path.getmtime(path) >= since]
+        relPaths = []
+        for path in paths:
+            relPath = os.path.relpath(os.path.abspath(path), self.sessionDir)
+            if relPath.startswith(os.pardir):
+                raise ValueError(
+                    '{} is not in the session folder.'.format(path))
+            if os.path.isfile(path) and relPath not in relPaths:
+                relPaths.append(relPath)
+
+        objectDir = self.getObjectDir(key)
+        tmpDir = objectDir + '.tmp{}'.format(os.getpid())
+        if os.path.exists(tmpDir):
+            shutil.rmtree(tmpDir)
+        for relPath in relPaths:
+            pathOut = os.path.join(tmpDir, 'files', relPath)
+            os.makedirs(os.path.dirname(pathOut), exist_ok=True)
+            shutil.copy2(os.path.join(self.sessionDir, relPath), pathOut)
+        os.makedirs(tmpDir, exist_ok=True)
+        if value is not None:
+            with open(os.path.join(tmpDir, 'value.pkl'), 'wb') as f:
+                pickle.dump(value, f)
+        entry = {'stage': stage, 'key': key, 'created': time.time(),
+                 'files': relPaths, 'size': getDirectorySize(tmpDir)}
+        with open(os.path.join(tmpDir, 'entry.json'), 'w') as f:
+            json.dump(entry, f, indent=2)
+        # Another process may have stored the same entry in the meantime.
+        if os.path.exists(objectDir):
+            shutil.rmtree(tmpDir)
+        else:
+            os.replace(tmpDir, objectDir)
+        self._record(stage, key, hit=False)
+
+        return entry
+
+    def _record(self, stage, key, hit):
+        self.manifest['stages'][stage] = {'key': key, 'hit': hit,
+                                          'time': time.time()}
+        os.makedirs(os.path.dirname(self.manifestPath), exist_ok=True)
+        tmpPath = self.manifestPath + '.tmp'
+        with open(tmpPath, 'w') as f:
+            json.dump(self.manifest, f, indent=2)
+        os.replace(tmpPath, self.manifestPath)
+
+# %%
+def loadEntry(objectDir):
+    try:
+        with open(os.path.join(objectDir, 'entry.json'), 'r') as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return None
+
+# %%
+def loadManifest(manifestPath):
+    try:
+        with open(manifestPath, 'r') as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return None
+
+# %%
+def getDirectorySize(directory):
+    size = 0
+    for root, _, fileNames in os.walk(directory):
+        for fileName in fileNames:
+            size += os.path.getsize(os.path.join(root, fileName))
+    return size
+
+# %%
+def getObjectDirs(cacheDir):
+    return sorted([path for path in glob.glob(
+        os.path.join(cacheDir, 'objects', '*', '*'))
+        if os.path.isdir(path) and '.tmp' not in os.path.basename(path)])
+
+# %%
+def getExtrinsicsCacheFiles(cacheDir):
+    return sorted(glob.glob(os.path.join(cacheDir, 'extrinsics', '*.json')))
+
+# %%
+def getManifests(cacheDir):
+    manifests = []
+    for manifestPath in sorted(glob.glob(
+            os.path.join(cacheDir, 'manifests', '*.json'))):
+        manifest = loadManifest(manifestPath)
+        if manifest is not None:
+            manifests.append((manifestPath, manifest))
+    return manifests
+
+# %%
+def listStageCache(cacheDir):
+    # Prints the number and size of the cached entries per stage.
+    summary = {}
+    for objectDir in getObjectDirs(cacheDir):
+        entry = loadEntry(objectDir)
+        if entry is None:
+            continue
+        count, size = summary.get(entry['stage'], (0, 0))
+        summary[entry['stage']] = (count + 1, size + entry['size'])
+    for stage, (count, size) in sorted(summary.items()):
+        print('{:<20} {:>6} entries {:>10.1f} MB'.format(stage, count,
+                                                          size / 1e6))
+    extrinsicsFiles = getExtrinsicsCacheFiles(cacheDir)
+    print('{:<20} {:>6} entries {:>10.1f} MB'.format(
+        'extrinsics', len(extrinsicsFiles),
+        sum([os.path.getsize(path) for path in extrinsicsFiles]) / 1e6))
+    print('{} trial manifests.'.format(len(getManifests(cacheDir))))
+
+    return summary
+
+# %%
+def showManifest(cacheDir, trial_id):
+    manifest = loadManifest(os.path.join(cacheDir, 'manifests',
+                                         trial_id + '.json'))
+    if manifest is None:
+        raise FileNotFoundError('No manifest for trial {}.'.format(trial_id))
+    print('Trial {} ({})'.format(trial_id, manifest['sessionDir']))
+    for stage, record in manifest['stages'].items():
+        isCached = os.path.exists(os.path.join(
+            cacheDir, 'objects', record['key'][:2], record['key']))
+        print('{:<20} {} {:<4} {} {}'.format(
+            stage, record['key'][:12], 'hit' if record['hit'] else 'miss',
+            time.strftime('%Y-%m-%d %H:%M', time.localtime(record['time'])),
+            '' if isCached else '(evicted)'))
+
+    return manifest
+
+# %%
+def collectStageCacheGarbage(cacheDir, maxAgeDays=None, dryRun=False):
+    # Removes entries that no trial manifest references, and, if maxAgeDays,
+    # entries that were not used for that many days. Manifests that no longer
+    # reference any entry are removed as well.
+    referencedKeys = set()
+    manifests = getManifests(cacheDir)
+    for _, manifest in manifests:
+        referencedKeys.update(
+            [record['key'] for record in manifest['stages'].values()])
+
+    now = time.time()
+    removedKeys, freedSize = set(), 0
+    for objectDir in getObjectDirs(cacheDir):
+        key = os.path.basename(objectDir)
+        pathEntry = os.path.join(objectDir, 'entry.json')
+        lastUsed = (os.path.getmtime(pathEntry) if os.path.exists(pathEntry)
+                    else 0)
+        isStale = (maxAgeDays is not None and
+                   now - lastUsed > maxAgeDays * 24 * 3600)
+        if key not in referencedKeys or isStale:
+            removedKeys.add(key)
+            freedSize += getDirectorySize(objectDir)
+            if not dryRun:
+                shutil.rmtree(objectDir)
+
+    # Cached extrinsic checkerboard detections (see 
+    # utilsChecker.calcExtrinsicsFromVideo) are not referenced by manifests,
+    # they are removed once stale.
+    if maxAgeDays is not None:
+        for path in getExtrinsicsCacheFiles(cacheDir):
+            if now - os.path.getmtime(path) > maxAgeDays * 24 * 3600:
+                removedKeys.add('extrinsics/' + os.path.basename(path))
+                freedSize += os.path.getsize(path)
+                if not dryRun:
+                    os.remove(path)
+
+    remainingKeys = set([os.path.basename(objectDir)
+                         for objectDir in getObjectDirs(cacheDir)])
+    if dryRun:
+        remainingKeys -= removedKeys
+    for manifestPath, manifest in manifests:
+        keys = [record['key'] for record in manifest['stages'].values()]
+        if not any([key in remainingKeys for key in keys]) and not dryRun:
+            os.remove(manifestPath)
+    print('{} {} entries, {:.1f} MB.'.format(
+        'Would remove' if dryRun else 'Removed', len(removedKeys),
+        freedSize / 1e6))
+
+    return removedKeys, freedSize
+
+# %%
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Inspect and garbage-collect the stage cache.')
+    parser.add_argument('--cacheDir',
+                        default=getStageCacheDirectory(os.getcwd()))
+    subparsers = parser.add_subparsers(dest='command')
+    subparsers.add_parser('list', help='Summarize cached entries per stage.')
+    parserShow = subparsers.add_parser('show', help='Show a trial manifest.')
+    parserShow.add_argument('trial_id')
+    parserGC = subparsers.add_parser(
+        'gc', help='Remove unreferenced and stale entries.')
+    parserGC.add_argument('--maxAgeDays', type=float, default=None)
+    parserGC.add_argument('--dryRun', action='store_true')
+    args = parser.parse_args()
+
+    if args.command == 'list':
+        listStageCache(args.cacheDir)
+    elif args.command == 'show':
+        showManifest(args.cacheDir, args.trial_id)
+    elif args.command == 'gc':
+        collectStageCacheGarbage(args.cacheDir, maxAgeDays=args.maxAgeDays,
+                                 dryRun=args.dryRun)
+    else:
+        parser.print_help()
+        sys.exit(1)
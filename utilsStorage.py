@@ -0,0 +1,166 @@
+"""Reading and writing of OpenSim storage files (.sto and .mot).
+
+The text files are parsed in a single pass with the pandas C parser, and
+written formatting blocks of rows at once. Parsed data can be cached in a
+binary sidecar next to the text file (<storage_file>.npz, a structured
+array), which readers load instead of the text file as long as the text file
+has the size and modification time it had when the sidecar was written.
+
+"""
+
+import io
+import os
+
+import numpy as np
+import pandas as pd
+
+SIDECAR_EXTENSION = '.npz'
+
+# %%
+def readStorageHeader(storage_file):
+    # Returns the header lines up to and including the line that says
+    # 'endheader', and the column names of the following line.
+    header = []
+    column_names = None
+    with open(storage_file, 'r') as f:
+        for line in f:
+            if header and header[-1].count('endheader') != 0:
+                column_names = line.split()
+                break
+            header.append(line)
+    if column_names is None:
+        raise ValueError('No endheader found in {}.'.format(storage_file))
+
+    return header, column_names
+
+# %%
+def getValidNames(column_names):
+    # Same sanitization of the column names as np.genfromtxt(names=True),
+    # such that fields are named as they used to be (eg, 'r.ASIS' -> 'rASIS').
+    # genfromtxt parses the names line followed by a row of zeros.
+    text = ' '.join(column_names) + '\n' + ' '.join(['0'] * len(column_names))
+    return list(np.genfromtxt(io.StringIO(text), names=True).dtype.names)
+
+# %%
+def getStorageSidecarPath(storage_file):
+    return storage_file + SIDECAR_EXTENSION
+
+# %%
+def getStorageSignature(storage_file):
+    # Size and modification time (ns) of the text file, stored in the sidecar.
+    stat = os.stat(storage_file)
+    return np.array([stat.st_size, stat.st_mtime_ns], dtype=np.int64)
+
+# %%
+def loadStorageSidecar(storage_file):
+    # Returns the cached structured array, or None if there is no up-to-date
+    # sidecar.
+    sidecarPath = getStorageSidecarPath(storage_file)
+    try:
+        with np.load(sidecarPath, allow_pickle=False) as sidecar:
+            if not np.array_equal(sidecar['signature'], 
+                                  getStorageSignature(storage_file)):
+                return None
+            return sidecar['data']
+    except (OSError, ValueError, KeyError):
+        return None
+
+# %%
+def saveStorageSidecar(storage_file, data=None):
+    # Caches the structured array of a storage file. Failing to write the
+    # sidecar, eg in a read-only data directory, is not an error.
+    if data is None:
+        data = readStorage(storage_file, useSidecar=False)
+    sidecarPath = getStorageSidecarPath(storage_file)
+    tmpPath = sidecarPath + '.tmp' + SIDECAR_EXTENSION
+    try:
+        np.savez(tmpPath, data=data, 
+                 signature=getStorageSignature(storage_file))
+        os.replace(tmpPath, sidecarPath)
+    except OSError:
+        if os.path.exists(tmpPath):
+            os.remove(tmpPath)
+        return None
+
+    return sidecarPath
+
+# %%
+def readStorage(storage_file, excess_header_entries=0, useSidecar=True,
+                writeSidecar=False):
+    """Returns the data from a storage file as a structured array, indexable
+    by column name, like np.genfromtxt(names=True) does.
+
+    Parameters
+    ----------
+    storage_file : str
+        Path to an OpenSim Storage (.sto or .mot) file.
+    excess_header_entries : int, optional
+        Number of header row entries to ignore from the end of the header
+        row, see utils.storage2numpy.
+    useSidecar : bool, optional
+        Load the binary sidecar instead of the text file if it is up to date.
+    writeSidecar : bool, optional
+        Write the binary sidecar after parsing the text file.
+
+    """
+    useCache = excess_header_entries == 0
+    if useCache and useSidecar:
+        data = loadStorageSidecar(storage_file)
+        if data is not None:
+            return data
+
+    header, column_names = readStorageHeader(storage_file)
+    if excess_header_entries != 0:
+        column_names = column_names[:-excess_header_entries]
+    names = getValidNames(column_names)
+    values = pd.read_csv(storage_file, sep=r'\s+', header=None,
+                         skiprows=len(header) + 1,
+                         usecols=range(len(names)), dtype=np.float64,
+                         engine='c').to_numpy()
+    dtype = np.dtype([(name, np.float64) for name in names])
+    data = np.ascontiguousarray(values).view(dtype).reshape(-1)
+
+    if useCache and writeSidecar:
+        saveStorageSidecar(storage_file, data)
+
+    return data
+
+# %%
+def readStorageDataFrame(storage_file, headers=None, useSidecar=True,
+                         writeSidecar=False):
+    # Returns a DataFrame with time and the columns in headers (all columns if
+    # headers is None).
+    data = readStorage(storage_file, useSidecar=useSidecar,
+                       writeSidecar=writeSidecar)
+    if headers is None:
+        headers = [name for name in data.dtype.names if name != 'time']
+    out = pd.DataFrame({'time': data['time']})
+    for count, header in enumerate(headers):
+        out.insert(count + 1, header, data[header])
+
+    return out
+
+# %%
+def writeStorage(storage_file, labels, data, writeSidecar=False,
+                 chunkSize=2048):
+    # Writes a (nRows x nColumns) array to a storage file, time being the
+    # first column.
+    assert data.shape[1] == len(labels), "# labels doesn't match columns"
+    assert labels[0] == "time"
+
+    rowFormat = '%20.8f\t' * data.shape[1] + '\n'
+    with open(storage_file, 'w') as f:
+        f.write('name %s\n' %storage_file)
+        f.write('datacolumns %d\n' %data.shape[1])
+        f.write('datarows %d\n' %data.shape[0])
+        f.write('range %f %f\n' %(np.min(data[:, 0]), np.max(data[:, 0])))
+        f.write('endheader \n')
+        f.write(''.join('%s\t' %label for label in labels))
+        f.write('\n')
+        for start in range(0, data.shape[0], chunkSize):
+            block = np.asarray(data[start:start + chunkSize], dtype=np.float64)
+            f.write((rowFormat * block.shape[0]) % tuple(block.ravel().tolist()))
+
+    if writeSidecar:
+        # Cache what readers of the text file get, ie the rounded values.
+        saveStorageSidecar(storage_file)
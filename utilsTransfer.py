@@ -0,0 +1,162 @@
+"""HTTP transfers with the API and S3.
+
+All requests go through a shared requests.Session, such that connections are
+reused across calls and threads. Idempotent requests are retried by the
+session on connection errors and on 429/5xx responses, with exponential
+backoff. Downloads are streamed to disk in chunks, retried as a whole if the
+stream breaks once the response started, and can be run concurrently, eg one
+per camera. Uploads to S3 are POSTs, which the session does not retry; they
+are retried by uploadFile. Each failure is thus retried by one layer only.
+
+The settings below can be changed at runtime, eg to point tests at a local
+stand-in HTTP server with fast retries; call resetHTTPSession() after
+changing the pool or retry settings.
+
+"""
+
+import os
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+CHUNK_SIZE = 1 << 20 # bytes
+POOL_SIZE = 16 # connections kept per host
+MAX_WORKERS = 8 # concurrent transfers
+MAX_RETRIES = 3
+BACKOFF_FACTOR = 0.5 # s, doubled after each retry
+TIMEOUT = (10, 300) # s, (connect, read) for file transfers
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+_session = None
+_sessionLock = threading.Lock()
+
+# %%
+def getRetry():
+    # POST is not retried by the session, since creating results is not
+    # idempotent; uploads handle their own retries.
+    methods = frozenset(['HEAD', 'GET', 'PUT', 'PATCH', 'DELETE', 'OPTIONS'])
+    kwargs = dict(total=MAX_RETRIES, backoff_factor=BACKOFF_FACTOR,
+                  status_forcelist=RETRY_STATUSES, raise_on_status=False)
+    try:
+        return Retry(allowed_methods=methods, **kwargs)
+    except TypeError: # urllib3 < 1.26
+        return Retry(method_whitelist=methods, **kwargs)
+
+# %%
+def getHTTPSession():
+    # Returns the process-wide session, created on first use.
+    global _session
+    with _sessionLock:
+        if _session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=POOL_SIZE,
+                                  pool_maxsize=POOL_SIZE,
+                                  max_retries=getRetry())
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            _session = session
+
+    return _session
+
+# %%
+def resetHTTPSession():
+    global _session
+    with _sessionLock:
+        if _session is not None:
+            _session.close()
+        _session = None
+
+# %%
+class BrokenStreamError(requests.RequestException):
+    # The connection broke while a response body was streamed, after the
+    # session (and its retries) returned the response.
+    pass
+
+# %%
+def withRetries(func, args, retryExceptions, retryStatuses=()):
+    # Calls func(*args), retrying on retryExceptions, and on HTTP errors
+    # (raised by func through raise_for_status) whose status is in
+    # retryStatuses. The last exception is raised once retries are exhausted.
+    for attempt in range(MAX_RETRIES + 1):
+        try:
+            return func(*args)
+        except (requests.HTTPError,) + tuple(retryExceptions) as e:
+            retryable = not isinstance(e, requests.HTTPError) or (
+                e.response is not None and
+                e.response.status_code in retryStatuses)
+            if not retryable or attempt == MAX_RETRIES:
+                raise
+            time.sleep(BACKOFF_FACTOR * 2**attempt)
+
+# %%
+def _downloadFile(url, filePath, chunkSize):
+    tmpPath = filePath + '.part'
+    try:
+        with getHTTPSession().get(url, stream=True, timeout=TIMEOUT) as r:
+            r.raise_for_status()
+            try:
+                with open(tmpPath, 'wb') as f:
+                    for chunk in r.iter_content(chunk_size=chunkSize):
+                        f.write(chunk)
+            except (requests.ConnectionError, 
+                    requests.exceptions.ChunkedEncodingError) as e:
+                raise BrokenStreamError(e)
+        os.replace(tmpPath, filePath)
+    finally:
+        if os.path.exists(tmpPath):
+            os.remove(tmpPath)
+
+def downloadFile(url, filePath, chunkSize=None):
+    # Streams url to filePath. The file only appears once complete. 
+    # Connection errors and error statuses are retried by the session, broken
+    # streams here.
+    if chunkSize is None:
+        chunkSize = CHUNK_SIZE
+    withRetries(_downloadFile, (url, filePath, chunkSize),
+                retryExceptions=(BrokenStreamError,))
+
+    return filePath
+
+# %%
+def downloadFiles(urlsAndPaths, chunkSize=None, maxWorkers=None):
+    # Downloads (url, filePath) pairs concurrently.
+    return runConcurrently(
+        downloadFile, [(url, filePath, chunkSize)
+                       for url, filePath in urlsAndPaths],
+        maxWorkers=maxWorkers)
+
+# %%
+def _uploadFile(url, fields, filePath):
+    with open(filePath, 'rb') as f:
+        r = getHTTPSession().post(url, data=fields, files={'file': f},
+                                  timeout=TIMEOUT)
+    r.raise_for_status()
+    return r
+
+def uploadFile(url, fields, filePath):
+    # Uploads filePath with a (presigned S3) form POST. Re-posting the same
+    # object is idempotent, so the upload is retried, here only since the 
+    # session does not retry POSTs. Raises requests.HTTPError if it failed.
+    return withRetries(_uploadFile, (url, fields, filePath),
+                       retryExceptions=(requests.ConnectionError, 
+                                        requests.Timeout),
+                       retryStatuses=RETRY_STATUSES)
+
+# %%
+def runConcurrently(func, argsList, maxWorkers=None):
+    # Runs func on each tuple of arguments in a thread pool, and returns the
+    # results in order. The first exception, if any, is raised once all
+    # calls are done.
+    if maxWorkers is None:
+        maxWorkers = MAX_WORKERS
+    maxWorkers = max(1, min(maxWorkers, len(argsList)))
+    if maxWorkers == 1:
+        return [func(*args) for args in argsList]
+    with ThreadPoolExecutor(max_workers=maxWorkers) as pool:
+        futures = [pool.submit(func, *args) for args in argsList]
+
+    return [future.result() for future in futures]
@@ -0,0 +1,214 @@
+"""Compact binary storage of the body transforms used by the webapp visualizer.
+
+The visualizer JSON ({'time': [...], 'bodies': {<body>: {'attachedGeometries',
+'scaleFactors', 'rotation', 'translation'}}}) stores nested lists of floats,
+which for long trials results in files of tens of MB. The compact format
+stores a small JSON header followed by little-endian typed arrays:
+
+    magic (4 bytes) | header length (uint32) | header (JSON, utf-8) |
+    padding to 8 bytes | arrays
+
+Per body, the translation is stored as a (nFrames x 3) array and the rotation
+as a (nFrames x 4) quaternion array (w, x, y, z), either as float32 or
+quantized to integers, optionally delta-encoded over time. The header gives,
+for each array, its offset (relative to the start of the arrays), dtype,
+shape, quantization step (None if not quantized), and whether it is
+delta-encoded. loadVisualizerData returns the JSON schema for both formats.
+
+"""
+
+import os
+import json
+import struct
+
+import numpy as np
+from scipy.spatial.transform import Rotation as R
+
+VISUALIZER_MAGIC = b'OCVB'
+VISUALIZER_VERSION = 1
+VISUALIZER_BINARY_EXTENSION = '.bin'
+
+# %%
+def getVisualizerBinaryPath(jsonPath):
+    return os.path.splitext(jsonPath)[0] + VISUALIZER_BINARY_EXTENSION
+
+# %%
+def findVisualizerPath(jsonPath):
+    # Returns the visualizer JSON if it exists, otherwise the compact file if
+    # it exists, otherwise None.
+    if os.path.exists(jsonPath):
+        return jsonPath
+    binaryPath = getVisualizerBinaryPath(jsonPath)
+    if os.path.exists(binaryPath):
+        return binaryPath
+    return None
+
+# %%
+def isVisualizerBinary(path):
+    with open(path, 'rb') as f:
+        return f.read(len(VISUALIZER_MAGIC)) == VISUALIZER_MAGIC
+
+# %%
+def eulerToQuaternions(rotations):
+    # Converts (nFrames x 3) body-fixed XYZ angles to (nFrames x 4) unit
+    # quaternions (w, x, y, z). The sign of each quaternion is chosen such
+    # that consecutive quaternions are close, which keeps deltas small.
+    quaternions = R.from_euler('XYZ', rotations).as_quat()[:, [3, 0, 1, 2]]
+    flips = np.sum(quaternions[1:] * quaternions[:-1], axis=1) < 0
+    signs = np.cumprod(np.concatenate(([1.], np.where(flips, -1., 1.))))
+
+    return quaternions * signs[:, np.newaxis]
+
+# %%
+def quaternionsToEuler(quaternions):
+    # Inverse of eulerToQuaternions.
+    quaternions = np.asarray(quaternions, dtype=np.float64)
+
+    return R.from_quat(quaternions[:, [1, 2, 3, 0]]).as_euler('XYZ')
+
+# %%
+def encodeArray(data, step=None, delta=False, floatDtype='<f4'):
+    # Returns the encoded array and its header entry (without offset).
+    data = np.asarray(data, dtype=np.float64)
+    if step is None:
+        if delta:
+            raise ValueError('Delta encoding requires quantization.')
+        encoded = data.astype(floatDtype)
+    else:
+        encoded = np.round(data / step).astype(np.int64)
+        if delta and encoded.shape[0] > 1:
+            encoded[1:] = np.diff(encoded, axis=0)
+        maxAbs = np.max(np.abs(encoded)) if encoded.size else 0
+        if maxAbs <= np.iinfo(np.int16).max:
+            encoded = encoded.astype('<i2')
+        elif maxAbs <= np.iinfo(np.int32).max:
+            encoded = encoded.astype('<i4')
+        else:
+            raise ValueError('Quantization step {} is too small.'.format(step))
+    entry = {'dtype': encoded.dtype.str, 'shape': list(encoded.shape),
+             'step': step, 'delta': delta}
+
+    return encoded, entry
+
+# %%
+def decodeArray(buffer, entry):
+    count = int(np.prod(entry['shape']))
+    data = np.frombuffer(buffer, dtype=np.dtype(entry['dtype']), count=count,
+                         offset=entry['offset']).reshape(entry['shape'])
+    if entry['step'] is None:
+        return data.astype(np.float64)
+    data = data.astype(np.int64)
+    if entry['delta']:
+        data = np.cumsum(data, axis=0)
+
+    return data * entry['step']
+
+# %%
+def writeVisualizerBinary(path, time, bodies, translationStep=None,
+                          rotationStep=None, delta=False):
+    """Writes body transforms to a compact visualizer file.
+
+    Parameters
+    ----------
+    time : (nFrames,) array
+    bodies : dict
+        Per body name, a dict with 'attachedGeometries', 'scaleFactors',
+        'translation' ((nFrames x 3) array), and 'rotation' ((nFrames x 3)
+        body-fixed XYZ angles, as in the visualizer JSON).
+    translationStep, rotationStep : float, optional
+        Quantization steps in m and in quaternion units; float32 if None.
+    delta : bool, optional
+        Delta-encode the quantized arrays over time.
+
+    """
+    arrays = []
+    offset = [0]
+    def addArray(data, step=None, delta=False, floatDtype='<f4'):
+        encoded, entry = encodeArray(data, step=step, delta=delta,
+                                     floatDtype=floatDtype)
+        entry['offset'] = offset[0]
+        arrays.append(encoded)
+        offset[0] += encoded.nbytes + (-encoded.nbytes % 8)
+        return entry
+
+    # Time is kept in double precision.
+    header = {'version': VISUALIZER_VERSION,
+              'nFrames': len(time),
+              'rotationType': 'quaternion_wxyz',
+              'time': addArray(time, floatDtype='<f8'),
+              'bodies': {}}
+    for bodyName, body in bodies.items():
+        header['bodies'][bodyName] = {
+            'attachedGeometries': body['attachedGeometries'],
+            'scaleFactors': body['scaleFactors'],
+            'translation': addArray(body['translation'],
+                                    step=translationStep,
+                                    delta=delta and translationStep is not None),
+            'rotation': addArray(eulerToQuaternions(body['rotation']),
+                                 step=rotationStep,
+                                 delta=delta and rotationStep is not None)}
+
+    headerBytes = json.dumps(header).encode('utf-8')
+    headerBytes += b' ' * (-(len(VISUALIZER_MAGIC) + 4 + len(headerBytes)) % 8)
+    tmpPath = path + '.tmp'
+    with open(tmpPath, 'wb') as f:
+        f.write(VISUALIZER_MAGIC)
+        f.write(struct.pack('<I', len(headerBytes)))
+        f.write(headerBytes)
+        for array in arrays:
+            f.write(array.tobytes())
+            f.write(b'\0' * (-array.nbytes % 8))
+    os.replace(tmpPath, path)
+
+    return header
+
+# %%
+def readVisualizerBinary(path):
+    # Returns the header and the decoded arrays: time, and per body the
+    # (nFrames x 3) translations and (nFrames x 4) quaternions.
+    with open(path, 'rb') as f:
+        content = f.read()
+    if content[:len(VISUALIZER_MAGIC)] != VISUALIZER_MAGIC:
+        raise ValueError('{} is not a visualizer binary file.'.format(path))
+    start = len(VISUALIZER_MAGIC)
+    headerLength = struct.unpack('<I', content[start:start+4])[0]
+    header = json.loads(content[start+4:start+4+headerLength].decode('utf-8'))
+    if header['version'] > VISUALIZER_VERSION:
+        raise ValueError('Unsupported visualizer file version {}.'.format(
+            header['version']))
+    buffer = memoryview(content)[start+4+headerLength:]
+    time = decodeArray(buffer, header['time'])
+    bodies = {}
+    for bodyName, body in header['bodies'].items():
+        bodies[bodyName] = {
+            'attachedGeometries': body['attachedGeometries'],
+            'scaleFactors': body['scaleFactors'],
+            'translation': decodeArray(buffer, body['translation']),
+            'quaternion': decodeArray(buffer, body['rotation'])}
+
+    return header, time, bodies
+
+# %%
+def loadVisualizerData(path):
+    """Loads a visualizer file, given either as visualizer JSON or as compact
+    binary file, in the visualizer JSON schema. If path is a JSON path that
+    does not exist, the corresponding compact file is loaded.
+
+    """
+    existingPath = findVisualizerPath(path)
+    if existingPath is None:
+        raise FileNotFoundError('No visualizer data found for {}'.format(path))
+    if not isVisualizerBinary(existingPath):
+        with open(existingPath, 'r') as f:
+            return json.load(f)
+
+    _, time, bodies = readVisualizerBinary(existingPath)
+    visualizeDict = {'time': time.tolist(), 'bodies': {}}
+    for bodyName, body in bodies.items():
+        visualizeDict['bodies'][bodyName] = {
+            'attachedGeometries': body['attachedGeometries'],
+            'scaleFactors': body['scaleFactors'],
+            'rotation': quaternionsToEuler(body['quaternion']).tolist(),
+            'translation': body['translation'].tolist()}
+
+    return visualizeDict
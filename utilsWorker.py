@@ -0,0 +1,237 @@
+"""Pipelined processing of the trials dequeued by a worker.
+
+A trial is processed in three phases (see utilsServer): prepareTrial
+downloads its inputs, runTrial processes them, and uploadTrialResults writes
+the results to the database. Run one after the other, the GPU idles while
+trials are downloaded and uploaded. TrialPipeline runs the phases in
+separate stages, such that while trial N is processed, trial N+1 is dequeued
+and downloaded, the results of trial N-1 are uploaded, and the folders of
+finished trials are deleted:
+
+    fetch -> [queue of 1] -> process -> [queue of 1] -> upload -> cleanup
+
+Back-pressure: a trial is only claimed from the API once the previously
+claimed trial is being processed. At most one trial is thus claimed and
+waiting on disk ahead of processing, and only that one is marked as
+'error' if the pipeline stops. Processing waits if the results of the
+previous trial are not uploaded yet. Cleanup only deletes folders and is not bounded.
+
+Failure isolation: a trial that fails in any stage is marked as 'error' and
+passed on to cleanup, without affecting the other trials and stages. Only
+errors raised by dequeue or betweenTrials (eg failed status check, full
+disk) stop the pipeline: trials that are not processed yet are marked as
+'error', trials already processed are still uploaded, and run() re-raises
+the error.
+
+Trials of the same session share the session folder, and eg a dynamic trial
+relies on the calibration and model posted by the previous trials of its
+session. A trial is therefore only prepared once the previous trials of its
+session have been cleaned up.
+
+The stages are passed as functions, such that the pipeline can be run
+against a stand-in API server and stubbed processing, see
+Examples/benchmarkWorkerPipeline.py.
+
+"""
+
+import queue
+import logging
+import threading
+
+_STOP = object()
+
+# %%
+class TrialPipeline(object):
+    """Runs trials through the fetch, process, upload, and cleanup stages.
+
+    Parameters
+    ----------
+    dequeue : function
+        dequeue() claims the next trial from the API and returns it as a dict
+        with at least 'id' and 'session', or None if there is none. It waits
+        between polls itself.
+    prepare, process, upload : functions
+        prepare(trial) downloads the inputs of a trial and returns the state
+        passed to process(state) and upload(state).
+    setStatus : function
+        setStatus(trial, status) with status 'done' or 'error'.
+    cleanup : function, optional
+        cleanup(trial) deletes the local data of a trial.
+    betweenTrials : function, optional
+        Called on the processing thread before each trial, and every
+        idleInterval seconds while there is no trial to process.
+
+    """
+    def __init__(self, dequeue, prepare, process, upload, setStatus,
+                 cleanup=None, betweenTrials=None, idleInterval=1.):
+        self.dequeue = dequeue
+        self.prepare = prepare
+        self.process = process
+        self.upload = upload
+        self.setStatus = setStatus
+        self.cleanup = cleanup
+        self.betweenTrials = betweenTrials
+        self.idleInterval = idleInterval
+
+        self.processQueue = queue.Queue(maxsize=1)
+        # Taken before a trial is claimed, given back when processing of the
+        # claimed trial starts.
+        self.claims = threading.Semaphore(1)
+        self.uploadQueue = queue.Queue(maxsize=1)
+        self.cleanupQueue = queue.Queue()
+        self.stopEvent = threading.Event()
+        self.fatalError = None
+        self.counts = {'done': 0, 'error': 0}
+        # Sessions of the trials between fetch and the end of cleanup.
+        self.activeSessions = {}
+        self.sessionsCondition = threading.Condition()
+
+    def getNumberOfTrialsInFlight(self):
+        with self.sessionsCondition:
+            return sum(self.activeSessions.values())
+
+    def stop(self):
+        # Stops dequeuing; trials in flight are finished.
+        self.stopEvent.set()
+
+    def run(self, maxTrials=None):
+        # Processes trials on the calling thread until stop() is called, a
+        # fatal error occurs, or maxTrials trials have been dequeued.
+        threads = [
+            threading.Thread(target=self._fetch, args=(maxTrials,),
+                             name='fetch', daemon=True),
+            threading.Thread(target=self._uploadStage, name='upload',
+                             daemon=True),
+            threading.Thread(target=self._cleanupStage, name='cleanup',
+                             daemon=True)]
+        for thread in threads:
+            thread.start()
+        self._processStage()
+        for thread in threads:
+            thread.join()
+        if self.fatalError is not None:
+            raise self.fatalError
+
+        return self.counts
+
+    def _fail(self, e):
+        if self.fatalError is None:
+            self.fatalError = e
+        self.stopEvent.set()
+
+    def _finish(self, trial, status):
+        # Posts the final status of a trial and passes it on to cleanup.
+        try:
+            self.setStatus(trial, status)
+        except Exception:
+            logging.exception('Could not set status of trial {} to {}.'.format(
+                trial['id'], status))
+        with self.sessionsCondition:
+            self.counts[status] += 1
+        self.cleanupQueue.put(trial)
+
+    def _acquireSession(self, session):
+        with self.sessionsCondition:
+            while self.activeSessions.get(session, 0) > 0:
+                self.sessionsCondition.wait()
+            self.activeSessions[session] = 1
+
+    def _releaseSession(self, session):
+        with self.sessionsCondition:
+            self.activeSessions.pop(session, None)
+            self.sessionsCondition.notify_all()
+
+    def _fetch(self, maxTrials):
+        nTrials = 0
+        while not self.stopEvent.is_set() and (
+                maxTrials is None or nTrials < maxTrials):
+            # Waits while the previous trial waits to be processed.
+            if not self.claims.acquire(timeout=self.idleInterval):
+                continue
+            if self.stopEvent.is_set():
+                break
+            try:
+                trial = self.dequeue()
+            except Exception as e:
+                logging.exception('Dequeuing failed, stopping the worker.')
+                self._fail(e)
+                break
+            if trial is None:
+                self.claims.release()
+                continue
+            nTrials += 1
+            self._acquireSession(trial['session'])
+            if self.fatalError is not None:
+                self._finish(trial, 'error')
+                break
+            try:
+                state = self.prepare(trial)
+            except Exception:
+                logging.exception('Preparing trial {} failed.'.format(
+                    trial['id']))
+                self._finish(trial, 'error')
+                self.claims.release()
+                continue
+            self.processQueue.put((trial, state))
+        self.processQueue.put(_STOP)
+
+    def _processStage(self):
+        while True:
+            if self.betweenTrials is not None and not self.stopEvent.is_set():
+                try:
+                    self.betweenTrials()
+                except Exception as e:
+                    logging.exception('Status check failed, stopping the '
+                                      'worker.')
+                    self._fail(e)
+            try:
+                item = self.processQueue.get(timeout=self.idleInterval)
+            except queue.Empty:
+                continue
+            if item is _STOP:
+                break
+            self.claims.release()
+            trial, state = item
+            if self.fatalError is not None:
+                self._finish(trial, 'error')
+                continue
+            try:
+                self.process(state)
+            except Exception:
+                logging.exception('Processing trial {} failed.'.format(
+                    trial['id']))
+                self._finish(trial, 'error')
+                continue
+            # Blocks while the results of the previous trial are uploading.
+            self.uploadQueue.put(item)
+        self.uploadQueue.put(_STOP)
+
+    def _uploadStage(self):
+        while True:
+            item = self.uploadQueue.get()
+            if item is _STOP:
+                break
+            trial, state = item
+            try:
+                self.upload(state)
+            except Exception:
+                logging.exception('Uploading results of trial {} '
+                                  'failed.'.format(trial['id']))
+                self._finish(trial, 'error')
+                continue
+            self._finish(trial, 'done')
+        self.cleanupQueue.put(_STOP)
+
+    def _cleanupStage(self):
+        while True:
+            trial = self.cleanupQueue.get()
+            if trial is _STOP:
+                break
+            try:
+                if self.cleanup is not None:
+                    self.cleanup(trial)
+            except Exception:
+                logging.exception('Cleaning up trial {} failed.'.format(
+                    trial['id']))
+            finally:
+                self._releaseSession(trial['session'])
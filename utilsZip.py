@@ -0,0 +1,157 @@
+"""Streaming zip archives of session folders.
+
+The archive is produced in chunks while the folder is walked, instead of
+being built on disk first, so the first bytes can be sent right away and no
+temporary copy of the session is needed. The zip is written in streaming
+mode (sizes and CRCs follow each file in a data descriptor, the central
+directory comes last), which zipfile does when the output is not seekable.
+
+Already-compressed media (videos, images, archives) are stored as they are;
+deflating them costs time and saves nothing. Other files, eg TRC, MOT and
+JSON outputs, are deflated. The archive is produced in a background thread,
+such that compression overlaps with sending the previous chunks.
+
+"""
+
+import os
+import queue
+import threading
+import zipfile
+
+CHUNK_SIZE = 1 << 20 # bytes read from each file at a time
+QUEUE_SIZE = 8 # chunks buffered ahead of the consumer
+STORED_EXTENSIONS = {'.mp4', '.avi', '.mov', '.mkv', '.webm', '.jpg', '.jpeg',
+                     '.png', '.zip', '.gz', '.npz'}
+SKIPPED_EXTENSIONS = {'.part'} # uploads in progress
+
+# %%
+class _ChunkSink(object):
+    # Write-only file object collecting what zipfile writes. It has no tell()
+    # or seek(), so zipfile writes the archive in streaming mode.
+    def __init__(self):
+        self.chunks = []
+
+    def write(self, data):
+        if data:
+            self.chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def pop(self):
+        data = b''.join(self.chunks)
+        self.chunks = []
+        return data
+
+# %%
+def getCompression(path):
+    if os.path.splitext(path)[1].lower() in STORED_EXTENSIONS:
+        return zipfile.ZIP_STORED
+    return zipfile.ZIP_DEFLATED
+
+# %%
+def listFiles(folder, arcRoot=''):
+    # Returns (path, name in archive) of the files in folder, in a stable order.
+    files = []
+    for root, dirs, fileNames in os.walk(folder):
+        dirs.sort()
+        for fileName in sorted(fileNames):
+            if os.path.splitext(fileName)[1] in SKIPPED_EXTENSIONS:
+                continue
+            path = os.path.join(root, fileName)
+            arcName = os.path.relpath(path, folder).replace(os.sep, '/')
+            if arcRoot:
+                arcName = arcRoot + '/' + arcName
+            files.append((path, arcName))
+    return files
+
+# %%
+def generateZip(folder, arcRoot='', chunkSize=CHUNK_SIZE):
+    # Yields the zip archive of folder in chunks, in the calling thread.
+    sink = _ChunkSink()
+    with zipfile.ZipFile(sink, 'w') as zipf:
+        for path, arcName in listFiles(folder, arcRoot):
+            try:
+                f = open(path, 'rb')
+            except OSError: # Removed while walking.
+                continue
+            with f:
+                # The size from stat selects Zip64 headers for large files;
+                # the actual size and CRC are written after the data.
+                zinfo = zipfile.ZipInfo.from_file(path, arcName)
+                zinfo.compress_type = getCompression(path)
+                with zipf.open(zinfo, 'w') as dest:
+                    for data in iter(lambda: f.read(chunkSize), b''):
+                        dest.write(data)
+                        chunk = sink.pop()
+                        if chunk:
+                            yield chunk
+            chunk = sink.pop()
+            if chunk:
+                yield chunk
+    chunk = sink.pop() # Central directory.
+    if chunk:
+        yield chunk
+
+# %%
+def iterZip(folder, arcRoot='', chunkSize=CHUNK_SIZE, queueSize=QUEUE_SIZE):
+    """
+    Yields the zip archive of a folder in chunks, eg for a streaming HTTP
+    response. The archive is produced in a background thread, at most
+    queueSize chunks ahead. Closing the generator stops that thread.
+
+    Parameters
+    ----------
+    folder : str
+        Folder to archive, recursively.
+    arcRoot : str
+        Folder in the archive the files are placed in; '' for the root.
+
+    """
+    chunks = queue.Queue(maxsize=queueSize)
+    stop = threading.Event()
+    done = object()
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                chunks.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def produce():
+        try:
+            for chunk in generateZip(folder, arcRoot, chunkSize):
+                if not put(chunk):
+                    return
+            put(done)
+        except Exception as e:
+            put(e)
+
+    thread = threading.Thread(target=produce, daemon=True)
+    thread.start()
+    try:
+        while True:
+            item = chunks.get()
+            if item is done:
+                break
+            if isinstance(item, Exception):
+                raise item
+            yield item
+    finally:
+        stop.set()
+        thread.join()
+
+# %%
+def writeZip(folder, zipPath, arcRoot=''):
+    # Writes the archive of folder to zipPath, through a temporary file such
+    # that a partial archive never appears at zipPath.
+    tmpPath = zipPath + '.part'
+    with open(tmpPath, 'wb') as f:
+        for chunk in iterZip(folder, arcRoot):
+            f.write(chunk)
+    os.replace(tmpPath, zipPath)
+    return zipPath